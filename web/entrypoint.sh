@@ -49,7 +49,32 @@ if [ -z ${GUNICORN_PATH} ]; then
     fi
 fi
 
+# Routing proxy instead of one k8s service per tunnel
+if [[ "${TUNNEL_ROUTING_MODE}" == "proxy" ]]; then
+    echo "$(date) Start routing proxy on port ${TUNNEL_PROXY_PORT:-8081}"
+    su ${USERNAME} -c "python3 /home/${USERNAME}/web/manage.py runproxy" &
+    PROXY_PID=$!
+fi
+
 # Set Defaults for gunicorn and start
 export GUNICORN_PROCESSES=${GUNICORN_PROCESSES:-16}
 export GUNICORN_THREADS=${GUNICORN_THREADS:-1}
-gunicorn -c ${GUNICORN_PATH} jupyterjsc_tunneling.wsgi
+if [[ -z ${PROXY_PID} ]]; then
+    gunicorn -c ${GUNICORN_PATH} jupyterjsc_tunneling.wsgi
+    exit $?
+fi
+
+# Without the proxy no tunnel of this pod is reachable. If the proxy or
+# gunicorn exits, stop the other one too, so the container is restarted.
+gunicorn -c ${GUNICORN_PATH} jupyterjsc_tunneling.wsgi &
+GUNICORN_PID=$!
+trap 'kill -TERM ${PROXY_PID} ${GUNICORN_PID} 2>/dev/null' TERM INT
+wait -n ${PROXY_PID} ${GUNICORN_PID}
+EXIT_CODE=$?
+if [[ ${EXIT_CODE} -eq 0 ]]; then
+    EXIT_CODE=1
+fi
+echo "$(date) Routing proxy or gunicorn stopped (exit code ${EXIT_CODE}), stop container"
+kill -TERM ${PROXY_PID} ${GUNICORN_PID} 2>/dev/null
+wait
+exit ${EXIT_CODE}
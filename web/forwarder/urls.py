@@ -15,11 +15,14 @@ Including another URLconf
 """
 from django.urls import path
 
+from .views import DrainForwarderViewSet
 from .views import RestartForwarderViewSet
 from .views import TunnelForwarderViewSet
 
 
 urlpatterns = [
+    path("drain/", DrainForwarderViewSet.as_view(), name="drainforwarder"),
+    path("drain/<job_id>/", DrainForwarderViewSet.as_view(), name="drainforwarderjob"),
     path("restart/", RestartForwarderViewSet.as_view(), name="restartforwarder"),
     path("tunnel/", TunnelForwarderViewSet.as_view(), name="tunnelforwarder"),
     path("tunnel/<servername>/", TunnelForwarderViewSet.as_view(), name="tunnelforwarder"),
@@ -0,0 +1,239 @@
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+from jupyterjsc_tunneling.settings import LOGGER_NAME
+from tunnel.jobs import fail_orphaned_jobs
+from tunnel.jobs import start_job
+from tunnel.jobs import update_job
+from tunnel.models import JobModel
+from tunnel.models import TunnelModel
+from tunnel.pool import run_grouped
+from tunnel.proxy import get_routing_mode
+
+from .fanout import get_pod_timeout
+from .k8s import edit_service_selectors
+from .k8s import get_tunnel_sts_pod_names
+from .migrate import start_tunnel_on_pod
+from .migrate import stop_tunnel_on_pod
+from .placement import assign_pods
+from .placement import get_available_pods
+from .placement import get_tunnel_counts
+from .placement import NoPodAvailableError
+from .replicas import get_replicas_watcher
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+"""
+Drain a tunnel pod before scaling down the StatefulSet: all its tunnels
+are moved to the remaining active pods, spread by the placement policy.
+
+The tunnels are moved in batches of DRAIN_BATCH_SIZE. For each batch
+ 1. the tunnels are started on their new pods, at most
+    DRAIN_MAX_WORKERS at once and DRAIN_MAX_PER_POD per new pod
+ 2. the services of the started tunnels are retargeted, with one
+    PATCH per service, up to K8S_PATCH_MAX_WORKERS at once. Only the
+    selector is patched if a tunnel kept its local port.
+ 3. the tunnels are stopped on the drained pod
+A tunnel whose service could not be patched keeps running on the
+drained pod as well, so its users are not cut off.
+
+The progress is stored in the job after each batch.
+
+With FORWARDER_AUTO_DRAIN=true, pods removed from ACTIVE_REPLICAS_PATH
+are drained right away: the replicas watcher (see replicas.py) of the
+first tunnel pod starts a drain job for each removed pod with tunnels,
+unless one is running already.
+"""
+
+
+def get_drain_config():
+    return {
+        "batch_size": int(os.environ.get("DRAIN_BATCH_SIZE", "100")),
+        "max_workers": int(os.environ.get("DRAIN_MAX_WORKERS", "16")),
+        "max_per_pod": int(os.environ.get("DRAIN_MAX_PER_POD", "4")),
+    }
+
+
+def drain_pod(job, source, uuidcode="Drain"):
+    config = get_drain_config()
+    timeout = get_pod_timeout()
+    proxy_mode = get_routing_mode() == "proxy"
+    start = time.monotonic()
+    tunnels = list(TunnelModel.objects.filter(tunnel_pod=source).order_by("servername"))
+    pods = [pod for pod in get_available_pods() if pod != source]
+    if tunnels and not pods:
+        raise NoPodAvailableError(f"No tunnel pod available to drain {source}")
+    targets = assign_pods([tunnel.servername for tunnel in tunnels], pods)
+    log_extra = {"uuidcode": uuidcode, "source": source, "tunnels": len(tunnels)}
+    log.info(f"Drain {source}", extra=log_extra)
+    if job:
+        update_job(job, source=source, total=len(tunnels), done=0, failed=0)
+
+    results = {}
+    results_lock = threading.Lock()
+
+    def set_result(servername, **result):
+        with results_lock:
+            results.setdefault(servername, {}).update(result)
+
+    def collect_started(item, result, exception):
+        tunnel, target = item
+        if exception is None:
+            try:
+                local_port = result.json()["local_port"]
+            except (ValueError, KeyError, TypeError) as e:
+                exception = Exception(f"Unexpected response: {e}")
+        if exception is not None:
+            set_result(
+                tunnel.servername,
+                pod=target,
+                status="failed",
+                step="start",
+                error=str(exception),
+            )
+        else:
+            set_result(
+                tunnel.servername,
+                pod=target,
+                local_port=local_port,
+                status="started",
+            )
+
+    def collect_stopped(tunnel, result, exception):
+        set_result(
+            tunnel.servername,
+            status="moved",
+            error=f"Stop on {source}: {exception}" if exception else None,
+        )
+
+    batch_size = config["batch_size"]
+    for i in range(0, len(tunnels), batch_size):
+        batch = list(zip(tunnels[i : i + batch_size], targets[i : i + batch_size]))
+        run_grouped(
+            batch,
+            key=lambda item: item[1],
+            func=lambda item: start_tunnel_on_pod(
+                item[0], item[1], timeout, uuidcode=f"{uuidcode} {source}"
+            ),
+            max_workers=config["max_workers"],
+            max_per_key=config["max_per_pod"],
+            callback=collect_started,
+        )
+
+        tunnels_by_svc = {tunnel.svc_name: tunnel for tunnel, _ in batch}
+        services = defaultdict(list)
+        patched = set()
+        for tunnel, target in batch:
+            result = results.get(tunnel.servername, {})
+            if result.get("status", None) != "started":
+                continue
+            if proxy_mode:
+                # No service per tunnel, the routing proxy of target serves it
+                patched.add(tunnel.svc_name)
+                continue
+            port = result["local_port"]
+            if port == tunnel.local_port:
+                # Port kept on the new pod, the selector is enough
+                port = None
+            services[target].append((tunnel.svc_name, port))
+        for target, target_services in services.items():
+            for svc_name, error in edit_service_selectors(
+                target_services, target
+            ).items():
+                if error:
+                    tunnel = tunnels_by_svc[svc_name]
+                    set_result(
+                        tunnel.servername,
+                        status="failed",
+                        step="service",
+                        error=error,
+                    )
+                    # Still serving, stopped by a retried move (forwarder PUT)
+                    TunnelModel.objects.filter(servername=tunnel.servername).update(
+                        old_forwards=tunnel.old_forwards
+                        + [{"pod": source, "local_port": tunnel.local_port}]
+                    )
+                else:
+                    patched.add(svc_name)
+
+        run_grouped(
+            [tunnel for tunnel, _ in batch if tunnel.svc_name in patched],
+            key=lambda tunnel: source,
+            func=lambda tunnel: stop_tunnel_on_pod(
+                tunnel, timeout, uuidcode=f"{uuidcode} {source}"
+            ),
+            max_workers=config["max_workers"],
+            max_per_key=config["max_per_pod"],
+            callback=collect_stopped,
+        )
+
+        if job:
+            update_job(
+                job,
+                source=source,
+                total=len(tunnels),
+                done=min(i + batch_size, len(tunnels)),
+                failed=sum(1 for r in results.values() if r["status"] == "failed"),
+            )
+
+    summary = {
+        "source": source,
+        "total": len(tunnels),
+        "moved": sum(1 for r in results.values() if r["status"] == "moved"),
+        "failed": sorted(k for k, v in results.items() if v["status"] == "failed"),
+        "tunnels": results,
+        "duration": round(time.monotonic() - start, 3),
+    }
+    log.info(
+        f"Drain {source} done",
+        extra={
+            **log_extra,
+            "moved": summary["moved"],
+            "failed": len(summary["failed"]),
+            "duration": summary["duration"],
+        },
+    )
+    return summary
+
+
+def get_running_drains():
+    """Source pods of the running drain jobs"""
+    fail_orphaned_jobs(JobModel.objects.filter(kind="drain"))
+    return {
+        job.result.get("source", None)
+        for job in JobModel.objects.filter(kind="drain", status="running")
+    }
+
+
+def drain_removed_pods(old, new):
+    """
+    on_shrink listener of the replicas watcher. Drains every inactive pod
+    which still owns tunnels in the database, not only the ones between
+    old and new. So a shrink before the first poll (old=None) or one
+    missed during a restart is drained as well.
+    """
+    pods = get_tunnel_sts_pod_names()
+    # The first pod is never removed, only it starts the drains
+    if not pods or pods[0] != os.environ.get("HOSTNAME", "drf-tunnel-0"):
+        return []
+    removed = pods[new:]
+    counts = get_tunnel_counts()
+    running = get_running_drains()
+    jobs = []
+    for pod in removed:
+        if counts.get(pod, 0) and pod not in running:
+            log.info(f"Start drain of removed pod {pod}", extra={"pod": pod})
+            jobs.append(start_job("drain", drain_pod, pod, uuidcode="AutoDrain"))
+    return jobs
+
+
+def start_auto_drain():
+    if os.environ.get("FORWARDER_AUTO_DRAIN", "false").lower() != "true":
+        return None
+    watcher = get_replicas_watcher()
+    watcher.on_shrink(drain_removed_pods)
+    return watcher.start()
@@ -0,0 +1,126 @@
+import contextvars
+import logging
+import os
+import time
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from json import JSONDecodeError
+
+import requests
+from jupyterjsc_tunneling.retry import remaining_time
+from jupyterjsc_tunneling.settings import LOGGER_NAME
+
+from .sessions import pod_request
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+"""
+Concurrent requests from the forwarder to all tunnel pods. Each request
+has its own connect and read timeout (FORWARDER_CONNECT_TIMEOUT,
+FORWARDER_READ_TIMEOUT). All pods together must answer before an overall
+deadline (FORWARDER_FANOUT_DEADLINE, at most the remaining time of the
+current request). A fan-out takes as long as the slowest pod, not the
+sum of all pods, and a hung pod only costs the deadline.
+
+Each pod's outcome is reported as a dict:
+  {"pod", "status": "ok" | "error" | "timeout", "status_code", "detail",
+   "duration"}
+"""
+
+
+def get_fan_out_deadline():
+    deadline = float(os.environ.get("FORWARDER_FANOUT_DEADLINE", "20"))
+    remaining = remaining_time()
+    if remaining is not None:
+        deadline = min(deadline, remaining)
+    return deadline
+
+
+def get_pod_timeout(deadline=None):
+    """(connect, read) timeout for one request, limited by deadline"""
+    connect_timeout = float(os.environ.get("FORWARDER_CONNECT_TIMEOUT", "3"))
+    read_timeout = float(os.environ.get("FORWARDER_READ_TIMEOUT", "20"))
+    if deadline is not None:
+        connect_timeout = min(connect_timeout, deadline)
+        read_timeout = min(read_timeout, deadline)
+    return (connect_timeout, read_timeout)
+
+
+def pod_result(pod, status, status_code=None, detail=None, duration=0):
+    return {
+        "pod": pod,
+        "status": status,
+        "status_code": status_code,
+        "detail": detail,
+        "duration": round(duration, 3),
+    }
+
+
+def request_pod(pod, method, url, timeout, **kwargs):
+    """Send one request to a tunnel pod. Never raises."""
+    start = time.monotonic()
+    try:
+        r = pod_request(method, url, timeout=timeout, **kwargs)
+    except requests.exceptions.Timeout as e:
+        return pod_result(
+            pod, "timeout", detail=str(e), duration=time.monotonic() - start
+        )
+    except Exception as e:
+        return pod_result(
+            pod, "error", detail=str(e), duration=time.monotonic() - start
+        )
+    detail = None
+    if r.content:
+        try:
+            detail = r.json()
+        except (JSONDecodeError, ValueError):
+            detail = r.text
+    return pod_result(
+        pod,
+        "ok" if r.ok else "error",
+        status_code=r.status_code,
+        detail=detail,
+        duration=time.monotonic() - start,
+    )
+
+
+def fan_out(pods, func, deadline=None):
+    """
+    Run func(pod) for all pods concurrently and yield the results in the
+    order the pods finish. Pods without a result at the deadline yield a
+    "timeout" result, their threads are not waited for.
+    """
+    if deadline is None:
+        deadline = get_fan_out_deadline()
+    if not pods:
+        return
+    start = time.monotonic()
+    pool = ThreadPoolExecutor(max_workers=len(pods), thread_name_prefix="fan-out")
+    futures = {
+        # Tasks inherit the caller's context (e.g. request deadline)
+        pool.submit(contextvars.copy_context().run, func, pod): pod
+        for pod in pods
+    }
+    pending = set(futures.keys())
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            pending.discard(future)
+            pod = futures[future]
+            try:
+                yield future.result()
+            except Exception as e:
+                yield pod_result(
+                    pod, "error", detail=str(e), duration=time.monotonic() - start
+                )
+    except FuturesTimeoutError:
+        for future in pending:
+            yield pod_result(
+                futures[future],
+                "timeout",
+                detail=f"No response within {deadline}s",
+                duration=time.monotonic() - start,
+            )
+    finally:
+        pool.shutdown(wait=False)
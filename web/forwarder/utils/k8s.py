@@ -1,40 +1,270 @@
+import logging
 import os
+import re
+import threading
 
-from kubernetes import client
-from kubernetes import config
+from jupyterjsc_tunneling.k8s import get_core_v1_api
+from jupyterjsc_tunneling.k8s import get_k8s_client
+from jupyterjsc_tunneling.retry import RetryPolicy
+from jupyterjsc_tunneling.settings import LOGGER_NAME
+from kubernetes import watch
+from kubernetes.client.exceptions import ApiException
+from tunnel.pool import run_grouped
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+STS_POD_NAME_LABEL = "statefulset.kubernetes.io/pod-name"
+
+# Conflicts and temporary API server errors
+retry_statuses = [409, 429, 500, 503, 504]
 
 
 def _k8s_get_client_core():
-    config.load_incluster_config()
-    return client.CoreV1Api()
+    return get_core_v1_api()
 
 
 def _k8s_get_namespace():
     return os.environ.get("DEPLOYMENT_NAMESPACE", "default")
 
 
-def get_tunnel_sts_pod_names():
-    v1 = _k8s_get_client_core()
-    namespace = _k8s_get_namespace()
-    label = f"app={os.environ.get('DEPLOYMENT_NAME', 'drf-tunnel')}"
-    pods = v1.list_namespaced_pod(namespace=namespace, label_selector=label)
+def _k8s_get_label_selector():
+    return f"app={os.environ.get('DEPLOYMENT_NAME', 'drf-tunnel')}"
+
+
+def _pod_ordinal(name):
+    match = re.search(r"-(\d+)$", name)
+    return (int(match.group(1)) if match else -1, name)
+
+
+def _is_pod_ready(pod):
+    for condition in (pod.status and pod.status.conditions) or []:
+        if condition.type == "Ready":
+            return condition.status == "True"
+    return False
+
+
+def _sts_pod_name(pod):
+    # there might be other pods of drf-tunnel, such as the down scaler
+    return (pod.metadata.labels or {}).get(STS_POD_NAME_LABEL, None)
+
+
+class PodInformer:
+    """
+    Keeps the StatefulSet pods of this deployment in memory. The pods are
+    listed once, afterwards a watch from the list's resourceVersion keeps
+    them up to date. If the watch breaks, the pods are listed again.
+
+    Readers use `pods()` only while the informer is healthy, i.e. it has
+    synced and its watch is running.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._pods = {}  # uid -> (name, ready)
+        self._synced = False
+        self._stop = threading.Event()
+        self._watch = None
+        self.thread = threading.Thread(
+            target=self.run, name="pod-informer", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._watch:
+            self._watch.stop()
+
+    @property
+    def healthy(self):
+        return self._synced and self.thread.is_alive()
+
+    def pods(self):
+        with self._lock:
+            pods = list(self._pods.values())
+        return sorted(pods, key=lambda pod: _pod_ordinal(pod[0]))
+
+    def _set_synced(self, synced):
+        if self._synced != synced:
+            log.info(
+                f"Pod informer {'synced' if synced else 'not synced'}",
+                extra={"pods": len(self._pods)},
+            )
+        self._synced = synced
 
-    pod_names = []
+    def list(self):
+        v1 = get_k8s_client().core_v1_raw
+        pod_list = v1.list_namespaced_pod(
+            namespace=_k8s_get_namespace(),
+            label_selector=_k8s_get_label_selector(),
+        )
+        pods = {}
+        for pod in pod_list.items:
+            name = _sts_pod_name(pod)
+            if name:
+                pods[pod.metadata.uid] = (name, _is_pod_ready(pod))
+        with self._lock:
+            self._pods = pods
+        return pod_list.metadata.resource_version
+
+    def handle_event(self, event):
+        pod = event["object"]
+        name = _sts_pod_name(pod)
+        with self._lock:
+            if event["type"] == "DELETED" or not name:
+                self._pods.pop(pod.metadata.uid, None)
+            else:
+                self._pods[pod.metadata.uid] = (name, _is_pod_ready(pod))
+
+    def watch(self, resource_version):
+        watch_timeout = int(os.environ.get("K8S_WATCH_TIMEOUT", "300"))
+        v1 = get_k8s_client().core_v1_raw
+        while not self._stop.is_set():
+            self._watch = watch.Watch(return_type="V1Pod")
+            for event in self._watch.stream(
+                v1.list_namespaced_pod,
+                namespace=_k8s_get_namespace(),
+                label_selector=_k8s_get_label_selector(),
+                resource_version=resource_version,
+                timeout_seconds=watch_timeout,
+                _request_timeout=watch_timeout + 10,
+            ):
+                self.handle_event(event)
+            # The server ends each watch after timeout_seconds, continue
+            # where it stopped
+            resource_version = self._watch.resource_version or resource_version
+
+    def run(self):
+        backoff = 1
+        while not self._stop.is_set():
+            try:
+                resource_version = self.list()
+                self._set_synced(True)
+                backoff = 1
+                self.watch(resource_version)
+            except Exception as e:
+                self._set_synced(False)
+                if isinstance(e, ApiException) and e.status == 410:
+                    # resourceVersion too old, list again right away
+                    log.debug("Pod informer watch expired")
+                    continue
+                log.warning(
+                    f"Pod informer failed, retry in {backoff}s", exc_info=True
+                )
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 30)
+
+
+_informer = None
+_informer_lock = threading.Lock()
+
+
+def get_pod_informer():
+    global _informer
+    if os.environ.get("POD_INFORMER_ENABLED", "true").lower() != "true":
+        return None
+    if _informer is None or _informer.pid != os.getpid():
+        with _informer_lock:
+            if _informer is None or _informer.pid != os.getpid():
+                _informer = PodInformer().start()
+    return _informer
+
+
+def list_tunnel_sts_pods():
+    v1 = _k8s_get_client_core()
+    pods = v1.list_namespaced_pod(
+        namespace=_k8s_get_namespace(), label_selector=_k8s_get_label_selector()
+    )
+    ret = []
     for pod in pods.items:
-        # there might be other pods of drf-tunnel, such as the down scaler
-        if "statefulset.kubernetes.io/pod-name" in pod.metadata.labels:
-            name = pod.metadata.labels['statefulset.kubernetes.io/pod-name']
-            pod_names.append(name)
-    return pod_names
+        name = _sts_pod_name(pod)
+        if name:
+            ret.append((name, _is_pod_ready(pod)))
+    return sorted(ret, key=lambda pod: _pod_ordinal(pod[0]))
+
 
+def get_tunnel_sts_pods():
+    """
+    List of (pod name, ready) of all StatefulSet pods, ordered by ordinal.
+    Served from the pod informer, a list call is only made while the
+    informer is not healthy.
+    """
+    informer = get_pod_informer()
+    if informer is not None and informer.healthy:
+        return informer.pods()
+    return list_tunnel_sts_pods()
 
-def edit_service_selector(service_name, pod_name, port):
+
+def get_tunnel_sts_pod_names():
+    return [name for name, _ in get_tunnel_sts_pods()]
+
+
+def get_service_selector_patch(pod_name, port=None):
+    """
+    JSON patch (RFC 6902) for the pod selector and target port only.
+    "add" also replaces an existing selector label. Without port, the
+    target port stays as it is.
+    """
+    label = STS_POD_NAME_LABEL.replace("~", "~0").replace("/", "~1")
+    patch = [{"op": "add", "path": f"/spec/selector/{label}", "value": pod_name}]
+    if port is not None:
+        patch.append(
+            {"op": "replace", "path": "/spec/ports/0/targetPort", "value": int(port)}
+        )
+    return patch
+
+
+def edit_service_selector(service_name, pod_name, port=None):
+    """
+    Retarget a service to another pod and port with a single PATCH. A
+    list body is sent as application/json-patch+json by the client.
+    Conflicts and temporary API errors are retried with backoff.
+    """
     v1 = _k8s_get_client_core()
     namespace = _k8s_get_namespace()
-    service = v1.read_namespaced_service(service_name, namespace)
-    service.spec.selector["statefulset.kubernetes.io/pod-name"] = pod_name
-    service.spec.ports[0].target_port = port
-    v1.patch_namespaced_service(
-        service_name, namespace,
-        body=service
-    )
\ No newline at end of file
+    body = get_service_selector_patch(pod_name, port)
+    retry_policy = RetryPolicy(
+        max_attempts=int(os.environ.get("K8S_PATCH_MAX_ATTEMPTS", "5"))
+    )
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return v1.patch_namespaced_service(service_name, namespace, body)
+        except ApiException as e:
+            if e.status not in retry_statuses or not retry_policy.wait(attempt):
+                raise
+            log.debug(
+                f"Retry patch of service {service_name}",
+                extra={"status": e.status, "attempt": attempt},
+            )
+
+
+def edit_service_selectors(services, pod_name, max_workers=None):
+    """
+    Retarget many services (list of (service name, port)) to pod_name,
+    e.g. to drain a pod. A port of None keeps the target port.
+    Returns {service name: None or error}.
+    """
+    if max_workers is None:
+        max_workers = int(os.environ.get("K8S_PATCH_MAX_WORKERS", "16"))
+    results = {}
+    results_lock = threading.Lock()
+
+    def collect(service, result, exception):
+        with results_lock:
+            results[service[0]] = str(exception) if exception else None
+
+    run_grouped(
+        services,
+        key=lambda service: pod_name,
+        func=lambda service: edit_service_selector(service[0], pod_name, service[1]),
+        max_workers=max_workers,
+        max_per_key=max_workers,
+        callback=collect,
+    )
+    return results
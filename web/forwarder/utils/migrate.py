@@ -0,0 +1,97 @@
+import copy
+import logging
+import time
+
+from django.forms.models import model_to_dict
+from jupyterjsc_tunneling import metrics
+from jupyterjsc_tunneling.settings import LOGGER_NAME
+from tunnel.jobs import update_job
+
+from .common import get_service_url
+from .sessions import pod_request
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+"""
+Steps to move a tunnel to another tunnel pod, used by
+TunnelForwarderViewSet.put and the drain of a pod (see drain.py):
+ 1. start the ssh forward on the new pod, which updates the database.
+    The new pod keeps the tunnel's local port if it is free there.
+ 2. retarget the k8s service (k8s.edit_service_selector), only the pod
+    selector if the port was kept
+ 3. stop the ssh forward on the old pod. The users are on the new pod
+    already, so TunnelForwarderViewSet.put does this in a job
+    (teardown_tunnel) and answers right after step 2.
+
+If step 2 fails, the old forward keeps running and the users stay on it.
+TunnelForwarderViewSet.put remembers it in TunnelModel.old_forwards, so
+a retried request (the tunnel is on the new pod already) still stops it.
+"""
+
+
+class PodRequestError(Exception):
+    def __init__(self, response):
+        self.response = response
+        super().__init__(f"{response.status_code} {response.text}")
+
+
+def start_tunnel_on_pod(instance, pod, timeout, uuidcode="StartTunnel via PUT"):
+    """
+    Start the ssh forward of instance on pod. The pod takes over the
+    tunnel in the database. Returns the response of the pod.
+    """
+    data = model_to_dict(instance, exclude=["old_forwards"])
+    data["tunnel_pod"] = pod
+    data.update({"start_tunnel": True, "uuidcode": uuidcode})
+    r = pod_request(
+        "PUT",
+        get_service_url(pod, suffix=instance.servername),
+        data=data,
+        timeout=timeout,
+    )
+    if not r.ok:
+        raise PodRequestError(r)
+    return r
+
+
+def stop_tunnel_on_pod(instance, timeout, uuidcode="StopTunnel via PUT"):
+    """Stop the ssh forward of instance on instance.tunnel_pod"""
+    data = model_to_dict(instance, exclude=["old_forwards"])
+    data.update({"start_tunnel": False, "uuidcode": uuidcode})
+    r = pod_request(
+        "PUT",
+        get_service_url(instance.tunnel_pod, suffix=instance.servername),
+        data=data,
+        timeout=timeout,
+    )
+    if not r.ok:
+        raise PodRequestError(r)
+    return r
+
+
+def teardown_tunnel(job, instance, timeout, uuidcode="StopTunnel via PUT"):
+    """Job: stop the ssh forward of a moved tunnel on its old pod"""
+    start = time.monotonic()
+    # Shows which forward may still run, if the job gets orphaned
+    update_job(job, servername=instance.servername, pod=instance.tunnel_pod)
+    stop_tunnel_on_pod(instance, timeout, uuidcode=uuidcode)
+    duration = time.monotonic() - start
+    metrics.observe("migrate_step", duration, step="stop")
+    return {
+        "servername": instance.servername,
+        "pod": instance.tunnel_pod,
+        "duration": round(duration, 3),
+    }
+
+
+def get_old_instances(instance):
+    """Copies of instance for its forwards in instance.old_forwards"""
+    instances = []
+    for forward in instance.old_forwards:
+        old_instance = copy.copy(instance)
+        old_instance.tunnel_pod = forward["pod"]
+        old_instance.local_port = forward["local_port"]
+        old_instance.old_forwards = []
+        instances.append(old_instance)
+    return instances
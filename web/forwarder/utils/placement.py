@@ -0,0 +1,215 @@
+import datetime
+import hashlib
+import logging
+import os
+
+from django.db.models import Count
+from django.utils import timezone
+from jupyterjsc_tunneling.settings import LOGGER_NAME
+from tunnel.models import PodLoadModel
+from tunnel.models import TunnelModel
+
+from .k8s import get_tunnel_sts_pod_names
+from .replicas import get_replicas_watcher
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+"""
+Placement of new tunnels on the tunnel pods. All numbers needed for a
+decision come from one GROUP BY query on the tunnel table, one query
+for the pods' load reports and the pod list of the pod informer (see
+k8s.get_tunnel_sts_pod_names).
+
+The pod is chosen by the policy TUNNEL_PLACEMENT_POLICY:
+ - least_tunnels: the pod with the least tunnels
+ - weighted (default): the pod with the lowest weighted sum of its
+   tunnel count and its load report (see tunnel/load.py). The weights
+   are set in TUNNEL_PLACEMENT_WEIGHTS, e.g. "tunnels=1,cpu=10".
+   Reports older than TUNNEL_LOAD_REPORT_MAX_AGE seconds are ignored.
+   A pod without a recent report (or a value missing in it) gets the
+   highest value of the other pods, so a silent pod never looks like
+   the cheapest one.
+ - rendezvous: the active pod with the highest sha256 of
+   "<pod>/<servername>" (first 8 bytes, big endian). Anyone who knows
+   the active pods can compute it without the database. If the set of
+   active pods changes, only the tunnels of added or removed pods get
+   another pod. The tunnel_pod of the database stays authoritative, it
+   may differ after a migration or a drain.
+"""
+
+default_placement_weights = {
+    "tunnels": 1,
+    "ssh_masters": 2,
+    "connections": 0.5,
+    "open_fds": 0.01,
+    "cpu": 10,
+}
+
+
+class NoPodAvailableError(Exception):
+    pass
+
+
+def get_tunnel_counts():
+    """{tunnel pod: number of tunnels} with a single GROUP BY query"""
+    return dict(
+        TunnelModel.objects.order_by()
+        .values_list("tunnel_pod")
+        .annotate(count=Count("servername"))
+    )
+
+
+def get_active_replicas():
+    """
+    Content of ACTIVE_REPLICAS_PATH: "all" or the number of active pods.
+    Cached until the file changes, see replicas.py.
+    """
+    return get_replicas_watcher().get()
+
+
+def get_available_pods():
+    """Pods which may get new tunnels, ordered by ordinal"""
+    pods = get_tunnel_sts_pod_names()
+    active_replicas = get_active_replicas()
+    if active_replicas != "all":
+        pods = pods[0:active_replicas]
+    return pods
+
+
+def choose_least_loaded(pods, counts):
+    """
+    Pod with the least tunnels (or lowest score). Ties go to the pod with
+    the lower ordinal, so an empty pod is filled before the next one.
+    """
+    if not pods:
+        raise NoPodAvailableError("No tunnel pod available")
+    return min((counts.get(pod, 0), i, pod) for i, pod in enumerate(pods))[2]
+
+
+def get_pod_with_least_tunnels():
+    return choose_least_loaded(get_available_pods(), get_tunnel_counts())
+
+
+def get_load_reports(max_age=None):
+    """{tunnel pod: load report} of all recent reports"""
+    if max_age is None:
+        max_age = float(os.environ.get("TUNNEL_LOAD_REPORT_MAX_AGE", "60"))
+    min_updated_at = timezone.now() - datetime.timedelta(seconds=max_age)
+    return dict(
+        PodLoadModel.objects.filter(updated_at__gte=min_updated_at).values_list(
+            "pod", "report"
+        )
+    )
+
+
+def get_placement_weights():
+    weights = os.environ.get("TUNNEL_PLACEMENT_WEIGHTS", "")
+    if not weights:
+        return default_placement_weights
+    ret = {}
+    for weight in weights.split(","):
+        key, _, value = weight.partition("=")
+        ret[key.strip()] = float(value)
+    return ret
+
+
+def get_fallback_report(pods, reports):
+    """Highest value of each key over the recent reports of pods"""
+    fallback = {}
+    for pod in pods:
+        for key, value in reports.get(pod, {}).items():
+            fallback[key] = max(fallback.get(key, value), value)
+    return fallback
+
+
+def get_pod_score(pod, counts, reports, weights, fallback=None):
+    # The tunnel count of the database is more recent than the report's
+    score = weights.get("tunnels", 0) * counts.get(pod, 0)
+    report = reports.get(pod, {})
+    if fallback is None:
+        fallback = {}
+    for key, weight in weights.items():
+        if key != "tunnels":
+            score += weight * report.get(key, fallback.get(key, 0))
+    return score
+
+
+def least_tunnels_policy(pods, counts, reports, servername=None):
+    return choose_least_loaded(pods, counts)
+
+
+def weighted_policy(pods, counts, reports, servername=None, weights=None):
+    if weights is None:
+        weights = get_placement_weights()
+    fallback = get_fallback_report(pods, reports)
+    scores = {
+        pod: get_pod_score(pod, counts, reports, weights, fallback) for pod in pods
+    }
+    return choose_least_loaded(pods, scores)
+
+
+def rendezvous_weight(servername, pod):
+    digest = hashlib.sha256(f"{pod}/{servername}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+def rendezvous_pod(servername, pods):
+    """
+    Pod with the highest hash of (pod, servername). Without a database
+    lookup, anyone who knows the active pods gets the same pod.
+    """
+    if not pods:
+        raise NoPodAvailableError("No tunnel pod available")
+    return max(pods, key=lambda pod: (rendezvous_weight(servername, pod), pod))
+
+
+def rendezvous_policy(pods, counts, reports, servername=None):
+    if servername is None:
+        return least_tunnels_policy(pods, counts, reports)
+    return rendezvous_pod(servername, pods)
+
+
+placement_policies = {
+    "least_tunnels": least_tunnels_policy,
+    "weighted": weighted_policy,
+    "rendezvous": rendezvous_policy,
+}
+
+
+def get_placement_policy():
+    name = os.environ.get("TUNNEL_PLACEMENT_POLICY", "weighted")
+    if name not in placement_policies:
+        log.warning(
+            f"Unknown placement policy {name}, use least_tunnels",
+            extra={"policies": list(placement_policies.keys())},
+        )
+        name = "least_tunnels"
+    return placement_policies[name]
+
+
+def choose_pod(servername=None):
+    """Pod for a new tunnel, chosen by TUNNEL_PLACEMENT_POLICY"""
+    policy = get_placement_policy()
+    pods = get_available_pods()
+    if policy is rendezvous_policy and servername is not None:
+        # Needs no tunnel counts or load reports
+        return rendezvous_pod(servername, pods)
+    counts = get_tunnel_counts()
+    return policy(pods, counts, get_load_reports(), servername=servername)
+
+
+def assign_pods(servernames, pods):
+    """
+    Pods for new tunnels, e.g. to drain a pod. Each one is chosen by the
+    placement policy as if the ones before were already placed.
+    """
+    policy = get_placement_policy()
+    counts = get_tunnel_counts()
+    reports = get_load_reports()
+    ret = []
+    for servername in servernames:
+        pod = policy(pods, counts, reports, servername=servername)
+        counts[pod] = counts.get(pod, 0) + 1
+        ret.append(pod)
+    return ret
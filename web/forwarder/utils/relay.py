@@ -0,0 +1,117 @@
+import logging
+import os
+import time
+
+import requests
+from django.http import JsonResponse
+from django.http import StreamingHttpResponse
+from jupyterjsc_tunneling.retry import DeadlineExceededError
+from jupyterjsc_tunneling.retry import remaining_time
+from jupyterjsc_tunneling.settings import LOGGER_NAME
+
+from .fanout import get_pod_timeout
+from .sessions import pod_request
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+"""
+FORWARDER_MODE=proxy: instead of a 307 redirect to the responsible tunnel
+pod, the forwarder sends the request to the pod itself (over the pooled
+session of the pod, see sessions.py) and streams the response back. The
+client needs one round trip per operation.
+
+Method, path, query, body and end-to-end headers (including the
+client's Authorization) are relayed unchanged, as are status, headers
+and body of the response. The whole relay must finish within the
+request's deadline, which includes streaming the response body:
+ - response head after the deadline: 504, nothing of it is relayed
+ - body not done at the deadline: the stream raises, so the WSGI server
+   aborts the connection. Content-Length is not relayed (the body is
+   sent chunked), a client never takes a cut body for a complete one.
+"""
+
+# Only valid for one connection, never relayed
+hop_by_hop_headers = [
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+    "host",
+    "content-length",
+]
+
+
+def get_forwarder_mode():
+    return os.environ.get("FORWARDER_MODE", "redirect").lower()
+
+
+def get_relay_headers(headers):
+    return {
+        key: value
+        for key, value in headers.items()
+        if key.lower() not in hop_by_hop_headers
+    }
+
+
+def stream_body(response, expires_at, chunk_size=65536):
+    try:
+        # Undecoded, the Content-Encoding header is relayed as well
+        for chunk in response.raw.stream(chunk_size, decode_content=False):
+            if time.monotonic() > expires_at:
+                log.warning(
+                    "Relay deadline exceeded, abort response body",
+                    extra={"url": response.url},
+                )
+                raise DeadlineExceededError("Relay deadline exceeded")
+            yield chunk
+    finally:
+        response.close()
+
+
+def relay_request(request, url):
+    start = time.monotonic()
+    remaining = remaining_time()
+    if remaining is None:
+        remaining = float(os.environ.get("REQUEST_DEADLINE", "25"))
+    query = request.META.get("QUERY_STRING", "")
+    if query:
+        url = f"{url}?{query}"
+    try:
+        r = pod_request(
+            request.method,
+            url,
+            data=request.body or None,
+            headers=get_relay_headers(request.headers),
+            timeout=get_pod_timeout(remaining),
+            stream=True,
+            allow_redirects=False,
+        )
+    except requests.exceptions.Timeout as e:
+        log.warning(f"Relay to {url} timed out", extra={"error": str(e)})
+        return JsonResponse(
+            {"error": "Gateway Timeout", "detailed_error": str(e)}, status=504
+        )
+    except requests.exceptions.RequestException as e:
+        log.warning(f"Relay to {url} failed", extra={"error": str(e)})
+        return JsonResponse(
+            {"error": "Bad Gateway", "detailed_error": str(e)}, status=502
+        )
+    if time.monotonic() > start + remaining:
+        r.close()
+        log.warning(f"Relay to {url} exceeded the deadline")
+        return JsonResponse(
+            {"error": "Gateway Timeout", "detailed_error": "Deadline exceeded"},
+            status=504,
+        )
+    response = StreamingHttpResponse(
+        stream_body(r, start + remaining), status=r.status_code
+    )
+    for key, value in r.headers.items():
+        if key.lower() not in hop_by_hop_headers:
+            response[key] = value
+    return response
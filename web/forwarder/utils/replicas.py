@@ -0,0 +1,134 @@
+import logging
+import os
+import threading
+
+from jupyterjsc_tunneling.settings import LOGGER_NAME
+from tunnel.locks import try_lock_file
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+"""
+Cached content of ACTIVE_REPLICAS_PATH: "all" or the number of active
+tunnel pods. The file is only read again if its mtime, size or inode
+changed (a ConfigMap update replaces the file), otherwise one stat per
+call is enough.
+
+on_shrink(callback) registers callback(old, new) for a smaller set of
+active pods. Only the polling thread (start()) calls it, in one worker
+per pod: the one holding an exclusive flock on ACTIVE_REPLICAS_LOCK_FILE.
+It looks at the file every ACTIVE_REPLICAS_POLL_INTERVAL seconds. The
+first poll calls it with old=None, unless all pods are active.
+"""
+
+
+def parse_active_replicas(content):
+    content = content.strip()
+    if content == "all":
+        return content
+    return int(content)
+
+
+def is_shrink(old, new):
+    # Unknown before the first poll: a shrink may have happened before
+    # this worker started, the listeners compare with the database.
+    if new == "all":
+        return False
+    return old is None or old == "all" or new < old
+
+
+class ReplicasWatcher:
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self.interval = float(os.environ.get("ACTIVE_REPLICAS_POLL_INTERVAL", "5"))
+        self.lock_file = os.environ.get(
+            "ACTIVE_REPLICAS_LOCK_FILE", "/tmp/tunnel-replicas-watcher.lock"
+        )
+        self._lock = threading.Lock()
+        self._stat = None
+        self._value = None
+        self._notified = None
+        self._listeners = []
+        self._stop = threading.Event()
+        self._lock_fd = None
+        self.thread = None
+
+    def get(self):
+        st = os.stat(self.path)
+        key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        with self._lock:
+            if key != self._stat:
+                with open(self.path) as f:
+                    content = f.read()
+                try:
+                    self._value = parse_active_replicas(content)
+                except ValueError:
+                    if self._value is None:
+                        raise
+                    log.warning(
+                        f"Invalid content in {self.path}, keep {self._value}",
+                        extra={"content": content},
+                    )
+                self._stat = key
+            return self._value
+
+    def on_shrink(self, callback):
+        self._listeners.append(callback)
+
+    def poll(self):
+        value = self.get()
+        old, self._notified = self._notified, value
+        if is_shrink(old, value):
+            if old is None:
+                log.info("Check for inactive tunnel pods", extra={"new": value})
+            else:
+                log.info("Active tunnel pods reduced", extra={"old": old, "new": value})
+            for callback in self._listeners:
+                try:
+                    callback(old, value)
+                except:
+                    log.exception("Active replicas listener failed")
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self.run, name="replicas-watcher", daemon=True
+            )
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        while not self._stop.is_set():
+            self._lock_fd = try_lock_file(self.lock_file)
+            if self._lock_fd is not None:
+                break
+            self._stop.wait(self.interval)
+        else:
+            return
+        try:
+            while not self._stop.is_set():
+                try:
+                    self.poll()
+                except (OSError, ValueError):
+                    log.warning(f"Could not read {self.path}", exc_info=True)
+                self._stop.wait(self.interval)
+        finally:
+            os.close(self._lock_fd)
+
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+def get_replicas_watcher():
+    path = os.environ.get("ACTIVE_REPLICAS_PATH", "/mnt/replicas/desired_replicas")
+    with _watchers_lock:
+        watcher = _watchers.get(path, None)
+        if watcher is None or watcher.pid != os.getpid():
+            watcher = ReplicasWatcher(path)
+            _watchers[path] = watcher
+        return watcher
@@ -0,0 +1,85 @@
+import logging
+import os
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from jupyterjsc_tunneling.settings import LOGGER_NAME
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .common import get_request_properties
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+"""
+Keep-alive HTTPS sessions for the requests of the forwarder to the
+tunnel pods. Each gunicorn worker keeps one requests.Session per pod
+(scheme, host and port of the URL). Its connections stay open, so only
+the first request to a pod pays for the TCP connect and the TLS
+handshake. The auth header and the CA path are read once per session.
+
+Connection errors are retried FORWARDER_RETRIES times for all methods,
+502, 503 and 504 answers only for idempotent methods, with a backoff
+of FORWARDER_RETRY_BACKOFF seconds (doubled for each retry).
+Each session keeps up to FORWARDER_POOL_MAXSIZE connections, enough
+for the concurrent requests of one worker to one pod.
+"""
+
+_sessions = {}
+_sessions_pid = None
+_sessions_lock = threading.Lock()
+
+
+def get_retry():
+    retries = int(os.environ.get("FORWARDER_RETRIES", "2"))
+    return Retry(
+        total=retries,
+        connect=retries,
+        read=0,
+        status=retries,
+        backoff_factor=float(os.environ.get("FORWARDER_RETRY_BACKOFF", "0.2")),
+        status_forcelist=[502, 503, 504],
+        raise_on_status=False,
+    )
+
+
+def create_session():
+    request_properties = get_request_properties()
+    session = requests.Session()
+    session.headers.update(request_properties["headers"])
+    session.verify = request_properties["ca"]
+    pool_maxsize = int(os.environ.get("FORWARDER_POOL_MAXSIZE", "10"))
+    adapter = HTTPAdapter(
+        pool_connections=1, pool_maxsize=pool_maxsize, max_retries=get_retry()
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session(url):
+    """Session for the pod of url, shared by all threads of this worker"""
+    global _sessions_pid
+    split_url = urlsplit(url)
+    key = (split_url.scheme, split_url.netloc)
+    with _sessions_lock:
+        if _sessions_pid != os.getpid():
+            # Sockets inherited from the gunicorn master must not be shared
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+        if key not in _sessions:
+            _sessions[key] = create_session()
+        return _sessions[key]
+
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def pod_request(method, url, **kwargs):
+    return get_session(url).request(method, url, **kwargs)
@@ -1,81 +1,129 @@
+import io
 import json
 import logging
-from json import JSONDecodeError
+import os
+import time
 
-import requests
-from django.forms.models import model_to_dict
+from django.http import StreamingHttpResponse
+from jupyterjsc_tunneling import metrics
 from jupyterjsc_tunneling.decorators import request_decorator
+from jupyterjsc_tunneling.permissions import HasGroupPermission
+from jupyterjsc_tunneling.retry import remaining_time
 from jupyterjsc_tunneling.settings import LOGGER_NAME
 from kubernetes.client.exceptions import ApiException as K8sApiException
 from rest_framework import status
 from rest_framework.exceptions import ValidationError
 from rest_framework.generics import GenericAPIView
 from rest_framework.response import Response
+from tunnel.jobs import get_job
+from tunnel.jobs import job_to_dict
+from tunnel.jobs import start_job
 from tunnel.models import TunnelModel
+from tunnel.proxy import get_routing_mode
 from tunnel.serializers import TunnelSerializer
+from tunnel.views import TunnelViewSet
 
-from .utils.common import get_least_tunnel_pod_url
-from .utils.common import get_request_properties
 from .utils.common import get_responsible_pod_url
 from .utils.common import get_service_url
+from .utils.drain import drain_pod
+from .utils.fanout import fan_out
+from .utils.fanout import get_fan_out_deadline
+from .utils.fanout import get_pod_timeout
+from .utils.fanout import request_pod
 from .utils.k8s import edit_service_selector
 from .utils.k8s import get_tunnel_sts_pod_names
+from .utils.migrate import get_old_instances
+from .utils.migrate import PodRequestError
+from .utils.migrate import start_tunnel_on_pod
+from .utils.migrate import teardown_tunnel
+from .utils.placement import choose_pod
+from .utils.relay import get_forwarder_mode
+from .utils.relay import relay_request
 
 log = logging.getLogger(LOGGER_NAME)
 assert log.__class__.__name__ == "ExtraLoggerClass"
 
+local_tunnel_view = TunnelViewSet.as_view(
+    {"get": "retrieve", "post": "create", "delete": "destroy"}
+)
+
 
 class RestartForwarderViewSet(GenericAPIView):
     required_groups = ["access_to_webservice_restart"]
 
+    def restart_pod(self, pod, data, timeout):
+        return request_pod(
+            pod, "POST", get_service_url(pod, endpoint="restart"), timeout, data=data
+        )
+
     @request_decorator
     def post(self, request, *args, **kwargs):
-        request_properties = get_request_properties()
-
-        # This needs to be forwarded to all pods
+        # This needs to be forwarded to all pods, concurrently
         tunnel_pods = get_tunnel_sts_pod_names()
-        _errors = {}
-        for pod in tunnel_pods:
-            url = get_service_url(pod, endpoint="restart")
-            try:
-                r = requests.post(
-                    url,
-                    data=request.data,
-                    headers=request_properties["headers"],
-                    verify=request_properties["ca"],
-                )
-                r.raise_for_status()
-            except requests.exceptions.HTTPError:
-                try:
-                    details = r.json()
-                    _errors[pod] = details
-                    log.info(
-                        f"Could not restart tunnels on {pod}",
-                        extra={**request.data, **{"error": details}},
-                    )
-                except JSONDecodeError:
-                    details = {"detail": "Request response could not be serialized"}
-                    log.info(
-                        f"Could not restart tunnels on {pod}",
-                        extra={
-                            **request.data,
-                            **{
-                                "request_url": r.url,
-                                "status_code": r.status_code,
-                                "request_text": r.text,
-                            },
-                        },
-                    )
-                    _errors[pod] = f"{r.status_code} {r.text}"
-            except Exception as e:
-                _errors[pod] = str(e)
+        deadline = get_fan_out_deadline()
+        timeout = get_pod_timeout(deadline)
+        data = request.data
+        results = fan_out(
+            tunnel_pods,
+            lambda pod: self.restart_pod(pod, data, timeout),
+            deadline=deadline,
+        )
+
+        def log_result(result):
+            if result["status"] != "ok":
                 log.info(
-                    f"Could not restart tunnels on {pod}",
-                    extra={**request.data, **{"error": str(e)}},
+                    f"Could not restart tunnels on {result['pod']}",
+                    extra={**data, **result},
                 )
-        if _errors:
-            return Response(json.dumps(_errors), status=status.HTTP_200_OK)
-        return Response(status=status.HTTP_200_OK)
+
+        if str(request.query_params.get("stream", "false")).lower() == "true":
+            # One JSON line per pod, as soon as it answered
+            def stream():
+                for result in results:
+                    log_result(result)
+                    yield json.dumps(result) + "\n"
+
+            return StreamingHttpResponse(stream(), content_type="application/x-ndjson")
+
+        start = time.monotonic()
+        pods = {}
+        for result in results:
+            log_result(result)
+            pods[result.pop("pod")] = result
+        report = {
+            "pods": pods,
+            "failed": sorted(k for k, v in pods.items() if v["status"] != "ok"),
+            "duration": round(time.monotonic() - start, 3),
+        }
+        return Response(report, status=status.HTTP_200_OK)
+
+
+class DrainForwarderViewSet(GenericAPIView):
+    permission_classes = [HasGroupPermission]
+    required_groups = ["access_to_webservice_restart"]
+
+    @request_decorator
+    def get(self, request, *args, **kwargs):
+        job_id = kwargs.get("job_id", None)
+        job = get_job(job_id, "drain")
+        if job is None:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        return Response(job_to_dict(job), status=status.HTTP_200_OK)
+
+    @request_decorator
+    def post(self, request, *args, **kwargs):
+        source = request.data.get("pod", None)
+        if not source:
+            raise ValidationError("Missing key in request data: pod")
+        uuidcode = request.data.get("uuidcode", "Drain")
+        # Draining thousands of tunnels takes longer than the gunicorn
+        # timeout. Return the job id, the client can poll it.
+        job = start_job("drain", drain_pod, source, uuidcode=uuidcode)
+        return Response(
+            job_to_dict(job),
+            status=status.HTTP_202_ACCEPTED,
+            headers={"Location": f"{request.path.rstrip('/')}/{job.job_id}/"},
+        )
 
 
 class TunnelForwarderViewSet(GenericAPIView):
@@ -90,97 +138,143 @@ class TunnelForwarderViewSet(GenericAPIView):
             queryset = TunnelModel.objects.filter(jhub_credential=self.request.user)
         return queryset
 
+    def forward(self, request, url, pod=None):
+        """
+        Redirect to the responsible pod, or relay it (FORWARDER_MODE=proxy).
+        Requests for this pod are handled in-process by TunnelViewSet.
+        """
+        if pod and pod == os.environ.get("HOSTNAME", "drf-tunnel-0"):
+            if os.environ.get("FORWARDER_LOCAL", "true").lower() == "true":
+                log.debug(f"Handling tunnel {request.method} request locally")
+                return self.forward_local(request)
+        if get_forwarder_mode() == "proxy":
+            log.debug(f"Relaying tunnel {request.method} request to {url}")
+            return relay_request(request, url)
+        log.debug(f"Redirecting tunnel {request.method} request to {url}")
+        return Response(
+            status=status.HTTP_307_TEMPORARY_REDIRECT,
+            headers={"Location": url},
+        )
+
+    def forward_local(self, request):
+        # Authenticated already, the same user is passed on
+        request._request._force_auth_user = request.user
+        request._request._force_auth_token = request.auth
+        if request._request._read_started:
+            # The body was parsed here already, let the view read it again
+            request._request._stream = io.BytesIO(request._request.body)
+        return local_tunnel_view(request._request, *self.args, **self.kwargs)
+
     @request_decorator
     def get(self, request, *args, **kwargs):
         if "servername" in kwargs:
             instance = self.get_object()
             redirect_url = get_responsible_pod_url(instance, suffix=instance.servername)
-        else:
-            redirect_url = get_service_url()
-        log.debug(f"Redirecting tunnel POST request to {redirect_url}")
-        return Response(
-            status=status.HTTP_307_TEMPORARY_REDIRECT,
-            headers={"Location": redirect_url},
-        )
+            return self.forward(request, redirect_url, pod=instance.tunnel_pod)
+        return self.forward(request, get_service_url())
 
     @request_decorator
     def put(self, request, *args, **kwargs):
         instance = self.get_object()
         if "new_pod" not in request.data:
             raise ValidationError("Missing key in request data: new_pod")
-
-        old_tunnel_pod = instance.tunnel_pod
-        request_properties = get_request_properties()
-        # Create tunnel on new pod
         new_tunnel_pod = request.data["new_pod"]
-        new_tunnel_url = get_service_url(new_tunnel_pod, suffix=instance.servername)
-        new_tunnel_data = model_to_dict(instance)
-        new_tunnel_data["tunnel_pod"] = new_tunnel_pod
-        new_tunnel_data.update(
-            {"start_tunnel": True, "uuidcode": "StartTunnel via PUT"}
-        )
-        try:
-            new_tunnel_request = requests.put(
-                new_tunnel_url,
-                data=new_tunnel_data,
-                headers=request_properties["headers"],
-                verify=request_properties["ca"],
-            )
-            new_tunnel_request.raise_for_status()
-        except requests.exceptions.HTTPError:
-            return Response(
-                new_tunnel_request.json(), status=new_tunnel_request.status_code
+        moved = instance.tunnel_pod != new_tunnel_pod
+        durations = {}
+
+        # Create tunnel on new pod. If it is there already (e.g. a retried
+        # request), only the service is patched.
+        step_start = time.monotonic()
+        if moved:
+            try:
+                new_tunnel_request = start_tunnel_on_pod(
+                    instance, new_tunnel_pod, get_pod_timeout(remaining_time())
+                )
+            except PodRequestError as e:
+                return Response(e.response.json(), status=e.response.status_code)
+            except Exception as e:
+                return Response(str(e), status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            # Stopped after the service patch, a retry still knows about it
+            old_forwards = instance.old_forwards + [
+                {"pod": instance.tunnel_pod, "local_port": instance.local_port}
+            ]
+            TunnelModel.objects.filter(servername=instance.servername).update(
+                old_forwards=old_forwards
             )
-        except Exception as e:
-            return Response(str(e), status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-        # Patch service to use new pod
-        new_instance = self.get_object()
-        try:
-            edit_service_selector(
-                new_instance.svc_name, new_instance.tunnel_pod, new_instance.local_port
+            new_instance = self.get_object()
+            data = new_tunnel_request.json()
+        else:
+            new_instance = instance
+            data = self.get_serializer(instance).data
+        # Never stop the forward the users are moved to
+        new_instance.old_forwards = [
+            forward
+            for forward in new_instance.old_forwards
+            if (forward["pod"], forward["local_port"])
+            != (new_instance.tunnel_pod, new_instance.local_port)
+        ]
+        durations["start"] = time.monotonic() - step_start
+
+        # Patch service to use new pod, the old tunnel keeps running until
+        # then. The target port stays if the new pod kept the local port.
+        # In proxy mode there is no service per tunnel, the routing proxy
+        # of the new pod serves it already.
+        step_start = time.monotonic()
+        port = new_instance.local_port
+        if moved and port == instance.local_port:
+            port = None
+        if get_routing_mode() != "proxy":
+            try:
+                edit_service_selector(
+                    new_instance.svc_name, new_instance.tunnel_pod, port
+                )
+            except K8sApiException as e:
+                return Response(e.body, status=e.status)
+            durations["service"] = time.monotonic() - step_start
+
+        # Delete tunnel on old pods, users are on the new one already
+        for old_instance in get_old_instances(new_instance):
+            job = start_job(
+                "teardown",
+                teardown_tunnel,
+                old_instance,
+                get_pod_timeout(),
+                uuidcode="StopTunnel via PUT",
             )
-        except K8sApiException as e:
-            return Response(e.body, status=e.status)
-
-        # Delete tunnel on old pod
-        old_tunnel_url = get_service_url(old_tunnel_pod, suffix=instance.servername)
-        old_tunnel_data = model_to_dict(instance)
-        old_tunnel_data.update(
-            {"start_tunnel": False, "uuidcode": "StopTunnel via PUT"}
+            log.debug(f"Teardown on {old_instance.tunnel_pod} in job {job.job_id}")
+        TunnelModel.objects.filter(servername=instance.servername).update(
+            old_forwards=[]
         )
-        try:
-            old_tunnel_request = requests.put(
-                old_tunnel_url,
-                data=old_tunnel_data,
-                headers=request_properties["headers"],
-                verify=request_properties["ca"],
-            )
-            old_tunnel_request.raise_for_status()
-        except requests.exceptions.HTTPError:
-            return Response(
-                old_tunnel_request.json(), status=old_tunnel_request.status_code
-            )
-        except Exception as e:
-            return Response(str(e), status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        return Response(new_tunnel_request.json(), status=status.HTTP_200_OK)
+        for step, duration in durations.items():
+            metrics.observe("migrate_step", duration, step=step)
+        log.info(
+            f"Tunnel {instance.servername} moved to {new_tunnel_pod}",
+            extra={
+                "servername": instance.servername,
+                "old_pod": instance.tunnel_pod,
+                "new_pod": new_tunnel_pod,
+                "port_kept": port is None,
+                **{k: round(v, 3) for k, v in durations.items()},
+            },
+        )
+        server_timing = ", ".join(
+            f"{k};dur={v * 1000:.1f}" for k, v in durations.items()
+        )
+        return Response(
+            data, status=status.HTTP_200_OK, headers={"Server-Timing": server_timing}
+        )
 
     @request_decorator
     def post(self, request, *args, **kwargs):
-        redirect_url = get_least_tunnel_pod_url()
-        log.debug(f"Redirecting tunnel POST request to {redirect_url}")
-        return Response(
-            status=status.HTTP_307_TEMPORARY_REDIRECT,
-            headers={"Location": redirect_url},
-        )
+        # Read the raw body before request.data, the relay and the local
+        # view need it afterwards
+        request.body
+        pod = choose_pod(servername=request.data.get("servername", None))
+        return self.forward(request, get_service_url(pod), pod=pod)
 
     @request_decorator
     def delete(self, request, *args, **kwargs):
         instance = self.get_object()
         redirect_url = get_responsible_pod_url(instance, suffix=instance.servername)
-        log.debug(f"Redirecting tunnel POST request to {redirect_url}")
-        return Response(
-            status=status.HTTP_307_TEMPORARY_REDIRECT,
-            headers={"Location": redirect_url},
-        )
+        return self.forward(request, redirect_url, pod=instance.tunnel_pod)
@@ -191,6 +191,22 @@ access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"
 #       A callable that takes a server instance as the sole argument.
 #
 
+
+def post_worker_init(worker):
+    # Start the k8s service reconciler, the load reporter and the
+    # replicas watcher. Only one worker per pod will run each of them.
+    # The metrics logger runs in every worker, metrics are per process.
+    from forwarder.utils.drain import start_auto_drain
+    from jupyterjsc_tunneling.metrics import start_metrics_logger
+    from tunnel.load import start_load_reporter
+    from tunnel.reconciler import start_reconciler
+
+    start_reconciler()
+    start_load_reporter()
+    start_auto_drain()
+    start_metrics_logger()
+
+
 # Max Requests used to reduce memory consumption
 max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 0))
 max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", 0))
@@ -7,6 +7,7 @@ from logs.utils import create_logging_handler
 from logs.utils import remove_logging_handler
 from rest_framework.response import Response
 
+from .retry import deadline_scope
 from .settings import LOGGER_NAME
 
 
@@ -52,7 +53,9 @@ def request_decorator(func):
 
     def catch_all_exceptions(*args, **kwargs):
         try:
-            return update_logging_handler(*args, **kwargs)
+            # All nested calls share the time budget of this request
+            with deadline_scope():
+                return update_logging_handler(*args, **kwargs)
         except Exception as e:
             if hasattr(e, "__module__") and e.__module__ in [
                 "django.http.response",
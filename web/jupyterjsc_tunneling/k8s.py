@@ -0,0 +1,107 @@
+import os
+import threading
+import time
+
+from kubernetes import client
+from kubernetes.config.incluster_config import InClusterConfigLoader
+from kubernetes.config.incluster_config import SERVICE_CERT_FILENAME
+from kubernetes.config.incluster_config import SERVICE_TOKEN_FILENAME
+
+from . import metrics
+
+"""
+Process wide Kubernetes API client. Building a CoreV1Api for each call
+means a new urllib3 pool, reading the service account token and a TLS
+handshake every time. We keep one client per process instead.
+
+gunicorn forks its workers after loading the app (preload_app), so the
+client remembers the pid it was created in and is rebuilt in a forked
+child. Sockets of the parent's pool are never shared.
+
+The projected service account token is rotated by the kubelet. When the
+token file changes, it's loaded into the existing configuration, so the
+connection pool is kept.
+"""
+
+_lock = threading.Lock()
+_client = None
+
+
+class InstrumentedApi:
+    """
+    Wraps an API object (e.g. CoreV1Api). Every call is recorded as
+    k8s_api latency with the method name as label, failed calls are
+    counted as k8s_api_errors.
+    """
+
+    def __init__(self, api):
+        self._api = api
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if not callable(attr) or name.startswith("_"):
+            return attr
+
+        def call(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return attr(*args, **kwargs)
+            except:
+                metrics.increment("k8s_api_errors", method=name)
+                raise
+            finally:
+                metrics.observe("k8s_api", time.monotonic() - start, method=name)
+
+        return call
+
+
+class K8sClient:
+    def __init__(self):
+        self.pid = os.getpid()
+        self.token_file = os.environ.get("K8S_TOKEN_FILE", SERVICE_TOKEN_FILENAME)
+        self.cert_file = os.environ.get("K8S_CA_FILE", SERVICE_CERT_FILENAME)
+        self.loader = InClusterConfigLoader(
+            token_filename=self.token_file,
+            cert_filename=self.cert_file,
+            try_refresh_token=False,
+        )
+        self.configuration = client.Configuration()
+        self.token_mtime = self._token_mtime()
+        self.loader.load_and_set(self.configuration)
+        self.api_client = client.ApiClient(self.configuration)
+        # Use the raw api for long running watches, they'd spoil the latencies
+        self.core_v1_raw = client.CoreV1Api(self.api_client)
+        self.core_v1 = InstrumentedApi(self.core_v1_raw)
+
+    def _token_mtime(self):
+        try:
+            return os.stat(self.token_file).st_mtime
+        except OSError:
+            return None
+
+    def refresh_token(self):
+        mtime = self._token_mtime()
+        if mtime is not None and mtime != self.token_mtime:
+            self.loader.load_and_set(self.configuration)
+            self.token_mtime = mtime
+            metrics.increment("k8s_token_reloads")
+
+
+def get_k8s_client():
+    global _client
+    with _lock:
+        if _client is None or _client.pid != os.getpid():
+            _client = K8sClient()
+        else:
+            _client.refresh_token()
+        return _client
+
+
+def get_core_v1_api():
+    return get_k8s_client().core_v1
+
+
+def reset_k8s_client():
+    global _client
+    with _lock:
+        _client = None
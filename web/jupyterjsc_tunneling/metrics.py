@@ -0,0 +1,122 @@
+import copy
+import logging
+import os
+import threading
+
+from .settings import LOGGER_NAME
+
+"""
+Small in-process metrics store. Latencies are kept as count / sum / max
+and a histogram with fixed buckets (seconds), counters as plain numbers.
+Values are per gunicorn worker process.
+
+They can be read with GET /api/logs/metrics/ (the answering worker only)
+and each worker logs a summary every METRICS_LOG_INTERVAL seconds
+(default 60, 0 disables it), see start_metrics_logger.
+"""
+
+BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+_lock = threading.Lock()
+_latencies = {}
+_counters = {}
+
+
+def _key(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{k}={v}" for k, v in sorted(labels.items())) + "}"
+
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    with _lock:
+        if key not in _latencies:
+            _latencies[key] = {
+                "count": 0,
+                "sum": 0.0,
+                "max": 0.0,
+                "buckets": {str(b): 0 for b in BUCKETS + ["inf"]},
+            }
+        entry = _latencies[key]
+        entry["count"] += 1
+        entry["sum"] += seconds
+        entry["max"] = max(entry["max"], seconds)
+        for bucket in BUCKETS:
+            if seconds <= bucket:
+                entry["buckets"][str(bucket)] += 1
+                break
+        else:
+            entry["buckets"]["inf"] += 1
+
+
+def increment(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def snapshot():
+    with _lock:
+        return {
+            "latencies": copy.deepcopy(_latencies),
+            "counters": copy.deepcopy(_counters),
+        }
+
+
+def reset():
+    with _lock:
+        _latencies.clear()
+        _counters.clear()
+
+
+def summary():
+    """snapshot without histograms, small enough for one log line"""
+    data = snapshot()
+    return {
+        "latencies": {
+            key: {
+                "count": entry["count"],
+                "avg": round(entry["sum"] / entry["count"], 4),
+                "max": round(entry["max"], 4),
+            }
+            for key, entry in data["latencies"].items()
+        },
+        "counters": data["counters"],
+    }
+
+
+class MetricsLogger(threading.Thread):
+    def __init__(self, interval):
+        super().__init__(name="metrics-logger", daemon=True)
+        self.interval = interval
+        self.pid = os.getpid()
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        # Not at import, the logger class is set up by the django apps
+        log = logging.getLogger(LOGGER_NAME)
+        while not self._stop.wait(self.interval):
+            try:
+                log.info("Metrics", extra={"pid": self.pid, **summary()})
+            except:
+                log.warning("Could not log metrics", exc_info=True)
+
+
+_logger = None
+_logger_lock = threading.Lock()
+
+
+def start_metrics_logger():
+    global _logger
+    interval = float(os.environ.get("METRICS_LOG_INTERVAL", "60"))
+    if interval <= 0:
+        return None
+    with _logger_lock:
+        if _logger is None or _logger.pid != os.getpid():
+            _logger = MetricsLogger(interval)
+            _logger.start()
+        return _logger
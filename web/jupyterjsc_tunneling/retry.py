@@ -0,0 +1,97 @@
+import contextvars
+import os
+import random
+import time
+from contextlib import contextmanager
+
+"""
+Every request gets a time budget (REQUEST_DEADLINE seconds, default 25,
+below gunicorn's 30 seconds timeout). The deadline is stored in a
+contextvar, so nested calls (ssh commands, retries, Kubernetes calls)
+can ask how much time is left without passing it around explicitly.
+Thread pools must run their tasks in a copy of the caller's context
+(contextvars.copy_context().run) to inherit the deadline.
+"""
+
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceededError(Exception):
+    pass
+
+
+@contextmanager
+def deadline_scope(seconds=None):
+    if seconds is None:
+        seconds = float(os.environ.get("REQUEST_DEADLINE", "25"))
+    expires_at = time.monotonic() + seconds
+    current = _deadline.get()
+    if current is not None and current < expires_at:
+        # A nested scope may only shorten the budget
+        expires_at = current
+    token = _deadline.set(expires_at)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_time():
+    """Seconds left until the deadline, None if there is no deadline."""
+    expires_at = _deadline.get()
+    if expires_at is None:
+        return None
+    return max(expires_at - time.monotonic(), 0)
+
+
+def check_deadline(msg="Deadline exceeded"):
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceededError(msg)
+    return remaining
+
+
+def bounded_timeout(timeout):
+    """Reduce timeout to the remaining time of the current deadline."""
+    remaining = check_deadline()
+    if remaining is None:
+        return timeout
+    return min(timeout, remaining)
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with jitter. The delay before attempt n+1 is
+    base_delay * 2**(n-1), capped at max_delay, plus up to jitter * delay.
+    Attempts stop early, if the deadline would be reached while waiting.
+    """
+
+    def __init__(self, max_attempts=1, base_delay=None, max_delay=None, jitter=None):
+        if base_delay is None:
+            base_delay = float(os.environ.get("RETRY_BASE_DELAY", "0.1"))
+        if max_delay is None:
+            max_delay = float(os.environ.get("RETRY_MAX_DELAY", "2"))
+        if jitter is None:
+            jitter = float(os.environ.get("RETRY_JITTER", "0.5"))
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        delay = min(self.base_delay * 2 ** (attempt - 1), self.max_delay)
+        return delay + random.uniform(0, self.jitter * delay)
+
+    def wait(self, attempt):
+        """
+        Sleep before the next attempt. Returns False if there's no next
+        attempt, because max_attempts or the deadline was reached.
+        """
+        if attempt >= self.max_attempts:
+            return False
+        delay = self.delay(attempt)
+        remaining = remaining_time()
+        if remaining is not None and remaining <= delay:
+            return False
+        time.sleep(delay)
+        return True
@@ -28,6 +28,7 @@ urlpatterns = [
     path("api/remote/", RemoteViewSet.as_view(), name="remote"),
     path("api/remotecheck/", RemoteCheckViewSet.as_view(), name="remotecheck"),
     path("api/restart/", RestartViewSet.as_view(), name="restart"),
+    path("api/restart/<job_id>/", RestartViewSet.as_view(), name="restartjob"),
     path("api/health/", lambda r: HttpResponse()),
     path("api/logs/", include("logs.urls")),
     path("api-auth/", include("rest_framework.urls")),
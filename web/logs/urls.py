@@ -19,10 +19,12 @@ from rest_framework.routers import DefaultRouter
 
 from .views import HandlerViewSet
 from .views import LogTestViewSet
+from .views import MetricsViewSet
 
 
 router = DefaultRouter()
 router.register("handler", HandlerViewSet, basename="handler")
 router.register("logtest", LogTestViewSet, basename="logtest")
+router.register("metrics", MetricsViewSet, basename="metrics")
 
 urlpatterns = [path("", include(router.urls))]
@@ -1,6 +1,8 @@
 # Create your views here.
 import logging
+import os
 
+from jupyterjsc_tunneling import metrics
 from jupyterjsc_tunneling.decorators import request_decorator
 from jupyterjsc_tunneling.permissions import HasGroupPermission
 from jupyterjsc_tunneling.settings import LOGGER_NAME
@@ -39,3 +41,18 @@ class LogTestViewSet(viewsets.GenericViewSet):
             extra={"Extra1": "message1", "mesg": "msg1", "filename": "forbidden"},
         )
         return Response(status=200)
+
+
+class MetricsViewSet(viewsets.GenericViewSet):
+    permission_classes = [HasGroupPermission]
+    required_groups = ["access_to_logging"]
+
+    @request_decorator
+    def list(self, request, *args, **kwargs):
+        # Metrics are per worker process, this is the answering one
+        data = {
+            "pod": os.environ.get("HOSTNAME", "drf-tunnel-0"),
+            "pid": os.getpid(),
+            **metrics.snapshot(),
+        }
+        return Response(data, status=200)
@@ -0,0 +1,65 @@
+import subprocess
+import time
+from unittest import mock
+
+from rest_framework.test import APITestCase
+from tunnel import utils
+from tunnel.executor import get_executor
+
+from tests.tunnel.mocks import mocked_slow_popen_init
+
+"""
+Create throughput of ssh tunnels: every create runs `-O check` and
+`-O forward`. Each mocked ssh command takes SlowPopenMocked.latency seconds.
+
+Run with:
+  pytest -c web/tests/benchmarks/pytest.ini web/tests/benchmarks/executor_bench.py
+"""
+
+TUNNELS = 200
+
+
+def legacy_run(cmd, timeout):
+    # previous implementation of run_popen_cmd: one blocking Popen per call
+    p = subprocess.Popen(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+    stdout, stderr = p.communicate(timeout=timeout)
+    return p.returncode, stdout, stderr
+
+
+def tunnel_kwargs(i):
+    return {
+        "hostname": "hostname",
+        "local_port": 30000 + i,
+        "target_node": "targetnode",
+        "target_port": 34567,
+    }
+
+
+class ExecutorBenchmark(APITestCase):
+    def report(self, name, duration):
+        print(
+            f"\n{name:<10} {TUNNELS} creates in {duration:.2f}s "
+            f"({TUNNELS / duration:.1f} creates/s)"
+        )
+
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_slow_popen_init,
+    )
+    def test_create_throughput(self, mocked_slow_popen_init):
+        start = time.monotonic()
+        for i in range(TUNNELS):
+            for action in ["check", "forward"]:
+                legacy_run(utils.get_tunnel_cmd(action, **tunnel_kwargs(i)), 3)
+        self.report("before", time.monotonic() - start)
+
+        executor = get_executor()
+        start = time.monotonic()
+        futures = []
+        for i in range(TUNNELS):
+            for action in ["check", "forward"]:
+                cmd = utils.get_tunnel_cmd(action, **tunnel_kwargs(i))
+                futures.append(executor.submit(cmd, 3))
+        returncodes = [f.result()[0] for f in futures]
+        self.report("after", time.monotonic() - start)
+        self.assertEqual(returncodes, [0] * 2 * TUNNELS)
@@ -0,0 +1,96 @@
+import os
+import tempfile
+import time
+from unittest import mock
+
+from django.db import connection
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext
+from forwarder.utils import placement
+from rest_framework.test import APITestCase
+from tunnel.models import TunnelModel
+
+from tests.forwarder.placement_tests import create_tunnels
+
+"""
+Placement of a new tunnel with many tunnels in the database. The pod
+with the least tunnels is the last active one, so the previous
+implementation had to exclude every other pod one query at a time.
+
+Run with:
+  pytest -c web/tests/benchmarks/pytest.ini web/tests/benchmarks/placement_bench.py
+"""
+
+PODS = [f"drf-tunnel-{i}" for i in range(10)]
+TUNNELS_PER_POD = 2200
+PLACEMENTS = 200
+
+
+def legacy_get_pod_with_least_tunnels():
+    # previous implementation (distinct() instead of the postgres-only
+    # distinct("tunnel_pod"))
+    query_set = TunnelModel.objects.values("tunnel_pod")
+    db_tunnel_pods = list(
+        query_set.values_list("tunnel_pod", flat=True).order_by().distinct()
+    )
+    sts_tunnel_pods = placement.get_tunnel_sts_pod_names()
+    active_tunnel_pods = placement.get_active_replicas()
+    if active_tunnel_pods == "all":
+        available_pods = sts_tunnel_pods
+    else:
+        available_pods = sts_tunnel_pods[0 : int(active_tunnel_pods)]
+    for pod in available_pods:
+        if pod not in db_tunnel_pods:
+            return pod
+    min_tunnel_pod_query = query_set.annotate(count=Count("tunnel_pod")).order_by(
+        "count"
+    )
+    min_tunnel_pod = min_tunnel_pod_query.first()["tunnel_pod"]
+    while min_tunnel_pod not in available_pods:
+        min_tunnel_pod_query = min_tunnel_pod_query.exclude(tunnel_pod=min_tunnel_pod)
+        min_tunnel_pod = min_tunnel_pod_query.first()["tunnel_pod"]
+    return min_tunnel_pod
+
+
+class PlacementBenchmark(APITestCase):
+    def setUp(self):
+        # Inactive pods (scaled down) keep few tunnels, the last active
+        # pod has the least tunnels of all active ones
+        counts = {pod: TUNNELS_PER_POD for pod in PODS}
+        for i, pod in enumerate(PODS[5:]):
+            counts[pod] = 10 + i
+        counts[PODS[4]] = TUNNELS_PER_POD - 1
+        create_tunnels(counts)
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        replicas_path = os.path.join(tmpdir.name, "desired_replicas")
+        with open(replicas_path, "w") as f:
+            f.write("5")
+        for patcher in [
+            mock.patch.dict(os.environ, {"ACTIVE_REPLICAS_PATH": replicas_path}),
+            mock.patch(
+                "forwarder.utils.placement.get_tunnel_sts_pod_names",
+                return_value=PODS,
+            ),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return super().setUp()
+
+    def measure(self, name, func):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.monotonic()
+            for _ in range(PLACEMENTS):
+                pod = func()
+            duration = time.monotonic() - start
+        print(
+            f"\n{name:<7} {TunnelModel.objects.count()} tunnels: "
+            f"{duration / PLACEMENTS * 1000:.2f}ms per placement, "
+            f"{len(queries) / PLACEMENTS:.0f} queries per placement"
+        )
+        return pod
+
+    def test_placement(self):
+        before = self.measure("before", legacy_get_pod_with_least_tunnels)
+        after = self.measure("after", placement.get_pod_with_least_tunnels)
+        self.assertEqual(before, after)
@@ -0,0 +1,155 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from unittest import mock
+
+from jupyterjsc_tunneling.k8s import InstrumentedApi
+from kubernetes import client
+from rest_framework.test import APITestCase
+from tunnel import utils
+from tunnel.proxy import RouteTable
+from tunnel.proxy import RoutingProxy
+
+from tests.tunnel.mocks import mocked_popen_init
+from tests.tunnel.proxy_tests import Backend
+from tests.tunnel.proxy_tests import read_response
+
+"""
+Service-per-tunnel mode vs. routing proxy mode (TUNNEL_ROUTING_MODE=proxy).
+
+Request latency: keep-alive GET requests straight to the local port (what
+a k8s service forwards to) vs. through the routing proxy.
+
+Create latency: start_tunnel + k8s_svc("create") like perform_create.
+In service mode k8s_svc uses a real CoreV1Api (serialization, urllib3
+pool, response parsing) against a local HTTP server, which answers like
+the API server after K8S_API_LATENCY seconds (the create of a service,
+incl. the etcd write). Run once with 0 for the client's own overhead.
+In proxy mode k8s_svc returns without a K8s API call, the new route is
+read from the database by the first request instead (route lookup of
+request latency).
+
+Run with:
+  pytest -c web/tests/benchmarks/pytest.ini web/tests/benchmarks/proxy_bench.py
+"""
+
+REQUESTS = 2000
+TUNNELS = 200
+K8S_API_LATENCY = float(os.environ.get("BENCH_K8S_API_LATENCY", "0.01"))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+class FakeK8sApi(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Head and body in one packet, no delayed ACK stalls
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    latency = 0
+    created = 0
+
+    def do_POST(self):
+        FakeK8sApi.created += 1
+        service = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(self.latency)
+        service["metadata"]["uid"] = "uid"
+        body = json.dumps(service).encode()
+        self.send_response(201)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ProxyBenchmark(APITestCase):
+    def report(self, name, latencies):
+        print(
+            f"\n{name:<28} avg {sum(latencies) / len(latencies) * 1000:.3f}ms "
+            f"p99 {percentile(latencies, 0.99) * 1000:.3f}ms"
+        )
+
+    def test_request_latency(self):
+        async def measure(port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            latencies = []
+            for _ in range(REQUESTS):
+                start = time.perf_counter()
+                writer.write(
+                    b"GET /user/alice/one/api/status HTTP/1.1\r\nHost: proxy\r\n\r\n"
+                )
+                await read_response(reader)
+                latencies.append(time.perf_counter() - start)
+            writer.close()
+            return latencies
+
+        async def main():
+            backend = await Backend("one").start()
+            routes = RouteTable(loader=lambda: {"one": backend.port}, ttl=60)
+            server = await RoutingProxy(routes=routes).start_server("127.0.0.1", 0)
+            proxy_port = server.sockets[0].getsockname()[1]
+            direct = await measure(backend.port)
+            proxied = await measure(proxy_port)
+            server.close()
+            backend.server.close()
+            return direct, proxied
+
+        direct, proxied = asyncio.run(main())
+        self.report("request, direct (service)", direct)
+        self.report("request, routing proxy", proxied)
+
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_popen_init,
+    )
+    def test_create_latency(self, mocked_popen_init):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), FakeK8sApi)
+        self.addCleanup(server.server_close)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        configuration = client.Configuration()
+        configuration.host = f"http://127.0.0.1:{server.server_port}"
+        api = InstrumentedApi(client.CoreV1Api(client.ApiClient(configuration)))
+
+        runs = [
+            ("create, service mode, API 0ms", "service", 0),
+            (
+                f"create, service mode, API {K8S_API_LATENCY * 1000:g}ms",
+                "service",
+                K8S_API_LATENCY,
+            ),
+            ("create, proxy mode", "proxy", 0),
+        ]
+        for name, mode, latency in runs:
+            FakeK8sApi.latency = latency
+            latencies = []
+            with mock.patch.dict(os.environ, {"TUNNEL_ROUTING_MODE": mode}), mock.patch(
+                "tunnel.utils.k8s_get_client", return_value=api
+            ):
+                for i in range(TUNNELS):
+                    kwargs = {
+                        "uuidcode": f"servername-{i}",
+                        "hostname": "hostname",
+                        "servername": f"servername-{i}",
+                        "local_port": 30000 + i,
+                        "svc_name": f"svc-{i}",
+                        "svc_port": 8080,
+                        "target_node": "targetnode",
+                        "target_port": 34567,
+                    }
+                    start = time.perf_counter()
+                    utils.start_tunnel(**kwargs)
+                    utils.k8s_svc("create", raise_exception=True, **kwargs)
+                    latencies.append(time.perf_counter() - start)
+            self.report(name, latencies)
+        # Every create in service mode went through the API client
+        self.assertEqual(FakeK8sApi.created, 2 * TUNNELS)
@@ -0,0 +1,41 @@
+import time
+
+import requests
+from forwarder.utils import sessions
+from rest_framework.test import APITestCase
+
+from tests.forwarder.sessions_tests import start_server
+
+"""
+Bare requests calls (one TCP connect per request, like the forwarder
+did before) vs. the pooled keep-alive session of forwarder/utils/sessions.
+Plain HTTP on localhost, so the saved TLS handshake is not included.
+
+Run with:
+  pytest -c web/tests/benchmarks/pytest.ini web/tests/benchmarks/sessions_bench.py
+"""
+
+REQUESTS = 500
+
+
+class PodSessionBenchmark(APITestCase):
+    def measure(self, name, server, func):
+        connections = server.connections
+        start = time.perf_counter()
+        for i in range(REQUESTS):
+            func()
+        duration = time.perf_counter() - start
+        print(
+            f"\n{name:<8} {duration / REQUESTS * 1000:.3f}ms per request, "
+            f"{server.connections - connections} connections"
+        )
+
+    def test_requests(self):
+        server = start_server()
+        self.addCleanup(server.shutdown)
+        self.addCleanup(sessions.close_sessions)
+        url = f"http://127.0.0.1:{server.server_address[1]}/api/health/"
+        self.measure("bare", server, lambda: requests.get(url, timeout=5))
+        self.measure(
+            "session", server, lambda: sessions.pod_request("GET", url, timeout=5)
+        )
@@ -0,0 +1,156 @@
+import os
+import tempfile
+from unittest import mock
+
+from forwarder.utils import drain
+from tests.tunnel.mocks import SynchronousThread
+from tests.user_credentials import UserCredentials
+
+from .placement_tests import create_tunnels
+
+
+def mocked_pod_request(method, url, data=None, **kwargs):
+    response = mock.MagicMock()
+    response.ok = True
+    response.status_code = 200
+    if data["servername"] == "drf-tunnel-2-3" and data["start_tunnel"]:
+        response.ok = False
+        response.status_code = 500
+        response.text = "Unexpected Error"
+    elif data["start_tunnel"]:
+        response.json.return_value = {"local_port": 50000 + data["local_port"] % 100}
+    else:
+        response.status_code = 204
+    return response
+
+
+def mocked_edit_service_selectors(services, pod_name):
+    return {
+        name: "409 Conflict" if name == "svc-drf-tunnel-2-5" else None
+        for name, _ in services
+    }
+
+
+@mock.patch.dict(os.environ, {"DRAIN_BATCH_SIZE": "4"})
+@mock.patch("tunnel.jobs.connection")
+# Only the job's thread, the pools of the drain need real threads
+@mock.patch("tunnel.jobs.threading", mock.MagicMock(Thread=SynchronousThread))
+@mock.patch(
+    "forwarder.utils.placement.get_tunnel_sts_pod_names",
+    return_value=["drf-tunnel-0", "drf-tunnel-1", "drf-tunnel-2"],
+)
+@mock.patch(
+    "forwarder.utils.drain.edit_service_selectors",
+    side_effect=mocked_edit_service_selectors,
+)
+@mock.patch("forwarder.utils.migrate.pod_request", side_effect=mocked_pod_request)
+class DrainForwarderViewTests(UserCredentials):
+    url = "/api/forwarder/drain/"
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        replicas_path = os.path.join(tmpdir.name, "desired_replicas")
+        with open(replicas_path, "w") as f:
+            f.write("all")
+        patcher = mock.patch.dict(os.environ, {"ACTIVE_REPLICAS_PATH": replicas_path})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        create_tunnels({"drf-tunnel-0": 2, "drf-tunnel-2": 6})
+        return super().setUp()
+
+    def test_drain(self, mocked_request, mocked_edit, mocked_pods, mocked_connection):
+        response = self.client.post(self.url, data={"pod": "drf-tunnel-2"})
+        self.assertEqual(response.status_code, 202)
+        job_id = response.data["job_id"]
+        response = self.client.get(f"{self.url}{job_id}/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["status"], "finished")
+        result = response.data["result"]
+        self.assertEqual(result["total"], 6)
+        self.assertEqual(result["done"], 6)
+        self.assertEqual(result["moved"], 4)
+        self.assertEqual(result["failed"], ["drf-tunnel-2-3", "drf-tunnel-2-5"])
+        self.assertEqual(result["tunnels"]["drf-tunnel-2-3"]["step"], "start")
+        self.assertEqual(result["tunnels"]["drf-tunnel-2-5"]["step"], "service")
+        # Still running on the drained pod, a retried move stops it
+        tunnel = drain.TunnelModel.objects.get(servername="drf-tunnel-2-5")
+        self.assertEqual(tunnel.old_forwards[0]["pod"], "drf-tunnel-2")
+        # Spread over the other pods, the empty one first
+        targets = [result["tunnels"][f"drf-tunnel-2-{i}"]["pod"] for i in range(6)]
+        self.assertEqual(targets.count("drf-tunnel-0"), 2)
+        self.assertEqual(targets.count("drf-tunnel-1"), 4)
+        # Two batches, one patch call per new pod and batch
+        self.assertEqual(mocked_edit.call_count, 4)
+        stopped = [
+            call[0][1]
+            for call in mocked_request.call_args_list
+            if not call[1]["data"]["start_tunnel"]
+        ]
+        self.assertEqual(len(stopped), 4)
+        self.assertTrue(all("drf-tunnel-2." in url for url in stopped))
+
+    @mock.patch.dict(os.environ, {"TUNNEL_ROUTING_MODE": "proxy"})
+    def test_drain_proxy_mode(
+        self, mocked_request, mocked_edit, mocked_pods, mocked_connection
+    ):
+        # No services to patch, the tunnels are stopped on the old pod
+        response = self.client.post(self.url, data={"pod": "drf-tunnel-2"})
+        job_id = response.data["job_id"]
+        result = self.client.get(f"{self.url}{job_id}/").data["result"]
+        self.assertEqual(result["moved"], 5)
+        self.assertEqual(result["failed"], ["drf-tunnel-2-3"])
+        mocked_edit.assert_not_called()
+        stopped = [
+            call[0][1]
+            for call in mocked_request.call_args_list
+            if not call[1]["data"]["start_tunnel"]
+        ]
+        self.assertEqual(len(stopped), 5)
+
+    def test_drain_invalid_response(
+        self, mocked_request, mocked_edit, mocked_pods, mocked_connection
+    ):
+        # E.g. an error page of a proxy: only this tunnel fails
+        def pod_request(method, url, data=None, **kwargs):
+            response = mocked_pod_request(method, url, data=data, **kwargs)
+            if data["servername"] == "drf-tunnel-2-1" and data["start_tunnel"]:
+                response.json.side_effect = ValueError("Expecting value")
+            return response
+
+        mocked_request.side_effect = pod_request
+        response = self.client.post(self.url, data={"pod": "drf-tunnel-2"})
+        job_id = response.data["job_id"]
+        response = self.client.get(f"{self.url}{job_id}/")
+        self.assertEqual(response.data["status"], "finished")
+        result = response.data["result"]
+        self.assertEqual(result["moved"], 3)
+        self.assertEqual(
+            result["failed"], ["drf-tunnel-2-1", "drf-tunnel-2-3", "drf-tunnel-2-5"]
+        )
+        tunnel = result["tunnels"]["drf-tunnel-2-1"]
+        self.assertEqual(tunnel["step"], "start")
+        self.assertIn("Expecting value", tunnel["error"])
+
+    def test_drain_forbidden(
+        self, mocked_request, mocked_edit, mocked_pods, mocked_connection
+    ):
+        job = drain.JobModel.objects.create(job_id="1", kind="drain")
+        for credentials, status_code in [
+            (self.credentials_unauthorized, 403),
+            ({}, 401),
+        ]:
+            self.client.credentials(**credentials)
+            response = self.client.post(self.url, data={"pod": "drf-tunnel-2"})
+            self.assertEqual(response.status_code, status_code)
+            response = self.client.get(f"{self.url}{job.job_id}/")
+            self.assertEqual(response.status_code, status_code)
+        self.client.credentials(**self.credentials_authorized)
+        self.assertEqual(drain.JobModel.objects.count(), 1)
+        mocked_request.assert_not_called()
+
+    def test_drain_missing_pod(self, *args):
+        response = self.client.post(self.url, data={})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(f"{self.url}unknown/")
+        self.assertEqual(response.status_code, 404)
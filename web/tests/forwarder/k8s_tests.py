@@ -0,0 +1,136 @@
+from types import SimpleNamespace
+from unittest import mock
+
+from forwarder.utils import k8s
+from kubernetes.client.exceptions import ApiException
+from rest_framework.test import APITestCase
+
+
+def pod(name, ready=True, uid=None, sts=True):
+    labels = {"app": "drf-tunnel"}
+    if sts:
+        labels[k8s.STS_POD_NAME_LABEL] = name
+    condition = SimpleNamespace(type="Ready", status="True" if ready else "False")
+    return SimpleNamespace(
+        metadata=SimpleNamespace(uid=uid or name, labels=labels),
+        status=SimpleNamespace(conditions=[condition]),
+    )
+
+
+class PodInformerTests(APITestCase):
+    def test_events_ordered_by_ordinal(self):
+        informer = k8s.PodInformer()
+        for name in ["drf-tunnel-10", "drf-tunnel-2", "drf-tunnel-0"]:
+            informer.handle_event({"type": "ADDED", "object": pod(name)})
+        informer.handle_event(
+            {"type": "ADDED", "object": pod("drf-tunnel-downscaler", sts=False)}
+        )
+        informer.handle_event(
+            {"type": "MODIFIED", "object": pod("drf-tunnel-2", ready=False)}
+        )
+        self.assertEqual(
+            informer.pods(),
+            [("drf-tunnel-0", True), ("drf-tunnel-2", False), ("drf-tunnel-10", True)],
+        )
+        informer.handle_event({"type": "DELETED", "object": pod("drf-tunnel-10")})
+        self.assertEqual(
+            [name for name, _ in informer.pods()], ["drf-tunnel-0", "drf-tunnel-2"]
+        )
+
+    def test_relist_after_expired_watch(self):
+        informer = k8s.PodInformer()
+
+        def watch(resource_version):
+            if resource_version == "1":
+                raise ApiException(status=410)
+            informer.stop()
+
+        with mock.patch.object(
+            informer, "list", side_effect=["1", "2"]
+        ) as mocked_list, mock.patch.object(
+            informer, "watch", side_effect=watch
+        ) as mocked_watch:
+            informer.run()
+        self.assertEqual(mocked_list.call_count, 2)
+        self.assertEqual(mocked_watch.call_args_list[1][0][0], "2")
+
+    @mock.patch("forwarder.utils.k8s._k8s_get_client_core")
+    def test_fallback_list_when_unhealthy(self, mocked_client):
+        mocked_client.return_value.list_namespaced_pod.return_value = SimpleNamespace(
+            items=[pod("drf-tunnel-1"), pod("drf-tunnel-0")]
+        )
+        informer = k8s.PodInformer()
+        with mock.patch("forwarder.utils.k8s.get_pod_informer", return_value=informer):
+            self.assertEqual(
+                k8s.get_tunnel_sts_pod_names(), ["drf-tunnel-0", "drf-tunnel-1"]
+            )
+            informer.handle_event({"type": "ADDED", "object": pod("drf-tunnel-0")})
+            with mock.patch.object(
+                k8s.PodInformer, "healthy", new_callable=mock.PropertyMock
+            ) as healthy:
+                healthy.return_value = True
+                self.assertEqual(k8s.get_tunnel_sts_pod_names(), ["drf-tunnel-0"])
+        self.assertEqual(mocked_client.return_value.list_namespaced_pod.call_count, 1)
+
+
+class EditServiceSelectorTests(APITestCase):
+    @mock.patch("forwarder.utils.k8s._k8s_get_client_core")
+    def test_single_patch(self, mocked_client):
+        k8s.edit_service_selector("svc", "drf-tunnel-1", "40000")
+        v1 = mocked_client.return_value
+        self.assertEqual(v1.read_namespaced_service.call_count, 0)
+        name, namespace, body = v1.patch_namespaced_service.call_args[0]
+        self.assertEqual(name, "svc")
+        self.assertEqual(
+            body,
+            [
+                {
+                    "op": "add",
+                    "path": "/spec/selector/statefulset.kubernetes.io~1pod-name",
+                    "value": "drf-tunnel-1",
+                },
+                {"op": "replace", "path": "/spec/ports/0/targetPort", "value": 40000},
+            ],
+        )
+
+    @mock.patch("forwarder.utils.k8s._k8s_get_client_core")
+    def test_selector_only(self, mocked_client):
+        k8s.edit_service_selector("svc", "drf-tunnel-1")
+        name, namespace, body = (
+            mocked_client.return_value.patch_namespaced_service.call_args[0]
+        )
+        self.assertEqual(
+            body,
+            [
+                {
+                    "op": "add",
+                    "path": "/spec/selector/statefulset.kubernetes.io~1pod-name",
+                    "value": "drf-tunnel-1",
+                }
+            ],
+        )
+
+    @mock.patch.dict("os.environ", {"RETRY_BASE_DELAY": "0"})
+    @mock.patch("forwarder.utils.k8s._k8s_get_client_core")
+    def test_retry_on_conflict(self, mocked_client):
+        v1 = mocked_client.return_value
+        v1.patch_namespaced_service.side_effect = [ApiException(status=409), "ok"]
+        self.assertEqual(k8s.edit_service_selector("svc", "drf-tunnel-1", 1), "ok")
+        v1.patch_namespaced_service.side_effect = ApiException(status=422)
+        with self.assertRaises(ApiException):
+            k8s.edit_service_selector("svc", "drf-tunnel-1", 1)
+        self.assertEqual(v1.patch_namespaced_service.call_count, 3)
+
+    @mock.patch("forwarder.utils.k8s._k8s_get_client_core")
+    def test_batch(self, mocked_client):
+        def patch(name, namespace, body):
+            if name == "svc-bad":
+                raise ApiException(status=404)
+
+        mocked_client.return_value.patch_namespaced_service.side_effect = patch
+        results = k8s.edit_service_selectors(
+            [("svc-1", 40001), ("svc-bad", 40002), ("svc-3", 40003)], "drf-tunnel-1"
+        )
+        self.assertEqual(results["svc-1"], None)
+        self.assertEqual(results["svc-3"], None)
+        self.assertIn("404", results["svc-bad"])
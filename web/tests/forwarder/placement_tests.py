@@ -0,0 +1,161 @@
+import datetime
+import os
+import tempfile
+from unittest import mock
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from forwarder.utils import placement
+from rest_framework.test import APITestCase
+from tunnel.models import PodLoadModel
+from tunnel.models import TunnelModel
+
+
+def create_tunnels(counts):
+    TunnelModel.objects.bulk_create(
+        [
+            TunnelModel(
+                servername=f"{pod}-{i}",
+                hostname="hostname",
+                local_port=40000 + i,
+                svc_name=f"svc-{pod}-{i}",
+                svc_port=8080,
+                target_node="targetnode",
+                target_port=34567,
+                tunnel_pod=pod,
+            )
+            for pod, count in counts.items()
+            for i in range(count)
+        ]
+    )
+
+
+class PlacementTests(APITestCase):
+    pods = ["drf-tunnel-0", "drf-tunnel-1", "drf-tunnel-2"]
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.replicas_path = os.path.join(self.tmpdir.name, "desired_replicas")
+        self.set_active_replicas("all")
+        for patcher in [
+            mock.patch.dict(os.environ, {"ACTIVE_REPLICAS_PATH": self.replicas_path}),
+            mock.patch(
+                "forwarder.utils.placement.get_tunnel_sts_pod_names",
+                return_value=self.pods,
+            ),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return super().setUp()
+
+    def set_active_replicas(self, value):
+        with open(self.replicas_path, "w") as f:
+            f.write(value)
+
+    def test_tunnel_counts(self):
+        create_tunnels({"drf-tunnel-0": 3, "drf-tunnel-1": 1})
+        with CaptureQueriesContext(connection) as queries:
+            counts = placement.get_tunnel_counts()
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(counts, {"drf-tunnel-0": 3, "drf-tunnel-1": 1})
+
+    def test_empty_pod_first(self):
+        create_tunnels({"drf-tunnel-0": 3, "drf-tunnel-2": 1})
+        self.assertEqual(placement.get_pod_with_least_tunnels(), "drf-tunnel-1")
+
+    def test_least_loaded(self):
+        create_tunnels({"drf-tunnel-0": 3, "drf-tunnel-1": 2, "drf-tunnel-2": 2})
+        self.assertEqual(placement.get_pod_with_least_tunnels(), "drf-tunnel-1")
+
+    def test_only_active_replicas(self):
+        create_tunnels({"drf-tunnel-0": 3, "drf-tunnel-1": 2})
+        self.set_active_replicas("2\n")
+        self.assertEqual(placement.get_pod_with_least_tunnels(), "drf-tunnel-1")
+
+    def test_no_pod(self):
+        with self.assertRaises(placement.NoPodAvailableError):
+            placement.choose_least_loaded([], {})
+
+    def set_load_reports(self, reports):
+        for pod, report in reports.items():
+            PodLoadModel.objects.create(pod=pod, report=report)
+
+    def test_weighted(self):
+        create_tunnels({"drf-tunnel-0": 3, "drf-tunnel-1": 2, "drf-tunnel-2": 4})
+        self.set_load_reports(
+            {
+                "drf-tunnel-0": {"connections": 0, "cpu": 0.1},
+                "drf-tunnel-1": {"connections": 40, "cpu": 1.5},
+                "drf-tunnel-2": {"connections": 2, "cpu": 0.2},
+            }
+        )
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(placement.choose_pod(), "drf-tunnel-0")
+        self.assertEqual(len(queries), 2)
+        with mock.patch.dict(os.environ, {"TUNNEL_PLACEMENT_POLICY": "least_tunnels"}):
+            self.assertEqual(placement.choose_pod(), "drf-tunnel-1")
+        with mock.patch.dict(os.environ, {"TUNNEL_PLACEMENT_WEIGHTS": "tunnels=1"}):
+            self.assertEqual(placement.choose_pod(), "drf-tunnel-1")
+
+    def test_weighted_ignores_old_reports(self):
+        create_tunnels({"drf-tunnel-0": 3, "drf-tunnel-1": 2, "drf-tunnel-2": 4})
+        self.set_load_reports({"drf-tunnel-1": {"cpu": 2}})
+        PodLoadModel.objects.filter(pod="drf-tunnel-1").update(
+            updated_at=timezone.now() - datetime.timedelta(seconds=120)
+        )
+        self.assertEqual(placement.choose_pod(), "drf-tunnel-1")
+
+    def test_weighted_pod_without_report(self):
+        # Silent pods are scored pessimistically, not as idle
+        create_tunnels({"drf-tunnel-0": 3, "drf-tunnel-1": 3, "drf-tunnel-2": 3})
+        self.set_load_reports(
+            {
+                "drf-tunnel-0": {"connections": 10, "cpu": 0.5},
+                "drf-tunnel-1": {"connections": 4, "cpu": 0.6},
+            }
+        )
+        self.assertEqual(placement.choose_pod(), "drf-tunnel-1")
+        reports = placement.get_load_reports()
+        fallback = placement.get_fallback_report(
+            placement.get_available_pods(), reports
+        )
+        self.assertEqual(fallback, {"connections": 10, "cpu": 0.6})
+
+    def test_unknown_policy(self):
+        with mock.patch.dict(os.environ, {"TUNNEL_PLACEMENT_POLICY": "random"}):
+            self.assertIs(
+                placement.get_placement_policy(), placement.least_tunnels_policy
+            )
+
+    def test_rendezvous(self):
+        pods = [f"drf-tunnel-{i}" for i in range(5)]
+        servernames = [f"servername-{i}" for i in range(1000)]
+        owners = {name: placement.rendezvous_pod(name, pods) for name in servernames}
+        # Clients compute the same owner, the hash must never change
+        self.assertEqual(owners["servername-1"], "drf-tunnel-0")
+        # Spread over all pods
+        self.assertEqual(set(owners.values()), set(pods))
+        # Only the tunnels of the removed pod move
+        smaller = {
+            name: placement.rendezvous_pod(name, pods[:4]) for name in servernames
+        }
+        moved = [name for name in servernames if owners[name] != smaller[name]]
+        self.assertEqual(
+            moved, [name for name in servernames if owners[name] == "drf-tunnel-4"]
+        )
+
+    @mock.patch.dict(os.environ, {"TUNNEL_PLACEMENT_POLICY": "rendezvous"})
+    def test_rendezvous_policy(self):
+        create_tunnels({"drf-tunnel-0": 1, "drf-tunnel-1": 1})
+        with CaptureQueriesContext(connection) as queries:
+            pod = placement.choose_pod(servername="servername-1")
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(pod, placement.rendezvous_pod("servername-1", self.pods))
+        # Without a servername, the pod with the least tunnels
+        self.assertEqual(placement.choose_pod(), "drf-tunnel-2")
+        self.assertEqual(
+            placement.assign_pods(["a", "b"], self.pods),
+            [placement.rendezvous_pod(name, self.pods) for name in ["a", "b"]],
+        )
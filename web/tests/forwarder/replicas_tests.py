@@ -0,0 +1,165 @@
+import os
+import tempfile
+from unittest import mock
+
+from forwarder.utils import drain
+from forwarder.utils import replicas
+from rest_framework.test import APITestCase
+
+from .placement_tests import create_tunnels
+
+
+class ReplicasWatcherTests(APITestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, "desired_replicas")
+        self.mtime_ns = 1_000_000_000_000_000_000
+        self.set_active_replicas("3\n")
+        self.watcher = replicas.ReplicasWatcher(self.path)
+        return super().setUp()
+
+    def set_active_replicas(self, value):
+        with open(self.path, "w") as f:
+            f.write(value)
+        # A new mtime for each write, even within the fs timestamp resolution
+        self.mtime_ns += 1_000_000
+        os.utime(self.path, ns=(self.mtime_ns, self.mtime_ns))
+
+    def test_parse(self):
+        self.assertEqual(replicas.parse_active_replicas("all\n"), "all")
+        self.assertEqual(replicas.parse_active_replicas(" 2\n"), 2)
+        with self.assertRaises(ValueError):
+            replicas.parse_active_replicas("two")
+
+    def test_cached(self):
+        self.assertEqual(self.watcher.get(), 3)
+        with mock.patch("builtins.open") as mocked_open:
+            self.assertEqual(self.watcher.get(), 3)
+        mocked_open.assert_not_called()
+
+    def test_changed(self):
+        self.assertEqual(self.watcher.get(), 3)
+        self.set_active_replicas("all")
+        self.assertEqual(self.watcher.get(), "all")
+        self.set_active_replicas("5\n")
+        self.assertEqual(self.watcher.get(), 5)
+
+    def test_invalid_keeps_value(self):
+        self.assertEqual(self.watcher.get(), 3)
+        self.set_active_replicas("")
+        self.assertEqual(self.watcher.get(), 3)
+
+    def test_invalid_without_value(self):
+        self.set_active_replicas("three")
+        with self.assertRaises(ValueError):
+            self.watcher.get()
+
+    def test_on_shrink(self):
+        events = []
+        self.watcher.on_shrink(lambda old, new: events.append((old, new)))
+        self.watcher.poll()
+        # First poll, compared with the database by the listener
+        self.assertEqual(events, [(None, 3)])
+        events.clear()
+        self.set_active_replicas("4")
+        self.watcher.poll()
+        self.assertEqual(events, [])
+        self.set_active_replicas("2")
+        self.watcher.poll()
+        self.watcher.poll()
+        self.set_active_replicas("all")
+        self.watcher.poll()
+        self.set_active_replicas("1")
+        self.watcher.poll()
+        self.assertEqual(events, [(4, 2), ("all", 1)])
+
+    def test_on_shrink_after_get(self):
+        # Requests of the same worker may read the change first
+        events = []
+        self.watcher.on_shrink(lambda old, new: events.append((old, new)))
+        self.watcher.poll()
+        self.set_active_replicas("2")
+        self.assertEqual(self.watcher.get(), 2)
+        self.watcher.poll()
+        self.assertEqual(events, [(None, 3), (3, 2)])
+
+    def test_listener_fails(self):
+        events = []
+        self.watcher.on_shrink(mock.MagicMock(side_effect=Exception("failed")))
+        self.watcher.on_shrink(lambda old, new: events.append((old, new)))
+        self.watcher.poll()
+        self.set_active_replicas("2")
+        self.watcher.poll()
+        self.assertEqual(events, [(None, 3), (3, 2)])
+
+    def test_first_poll_all(self):
+        events = []
+        self.watcher.on_shrink(lambda old, new: events.append((old, new)))
+        self.set_active_replicas("all")
+        self.watcher.poll()
+        self.assertEqual(events, [])
+
+    def test_singleton(self):
+        with mock.patch.dict(os.environ, {"ACTIVE_REPLICAS_PATH": self.path}):
+            watcher = replicas.get_replicas_watcher()
+            self.assertIs(replicas.get_replicas_watcher(), watcher)
+            with mock.patch("os.getpid", return_value=-1):
+                self.assertIsNot(replicas.get_replicas_watcher(), watcher)
+
+
+@mock.patch.dict(os.environ, {"HOSTNAME": "drf-tunnel-0"})
+@mock.patch(
+    "forwarder.utils.drain.get_tunnel_sts_pod_names",
+    return_value=["drf-tunnel-0", "drf-tunnel-1", "drf-tunnel-2", "drf-tunnel-3"],
+)
+@mock.patch("forwarder.utils.drain.start_job")
+class DrainRemovedPodsTests(APITestCase):
+    def test_drain_removed_pods(self, mocked_start_job, mocked_pods):
+        create_tunnels({"drf-tunnel-0": 1, "drf-tunnel-1": 2, "drf-tunnel-2": 1})
+        drain.drain_removed_pods(4, 1)
+        self.assertEqual(
+            [c.args[2] for c in mocked_start_job.call_args_list],
+            ["drf-tunnel-1", "drf-tunnel-2"],
+        )
+
+    def test_from_all(self, mocked_start_job, mocked_pods):
+        create_tunnels({"drf-tunnel-2": 1, "drf-tunnel-3": 1})
+        drain.drain_removed_pods("all", 3)
+        self.assertEqual(
+            [c.args[2] for c in mocked_start_job.call_args_list], ["drf-tunnel-3"]
+        )
+
+    def test_running_drain(self, mocked_start_job, mocked_pods):
+        create_tunnels({"drf-tunnel-2": 1, "drf-tunnel-3": 1})
+        drain.JobModel.objects.create(
+            job_id="1", kind="drain", result={"source": "drf-tunnel-3"}
+        )
+        drain.drain_removed_pods(4, 2)
+        self.assertEqual(
+            [c.args[2] for c in mocked_start_job.call_args_list], ["drf-tunnel-2"]
+        )
+
+    def test_first_poll(self, mocked_start_job, mocked_pods):
+        # Shrunk before the watcher started: pods 2 and 3 still own tunnels
+        create_tunnels({"drf-tunnel-0": 1, "drf-tunnel-2": 1, "drf-tunnel-3": 2})
+        drain.drain_removed_pods(None, 2)
+        self.assertEqual(
+            [c.args[2] for c in mocked_start_job.call_args_list],
+            ["drf-tunnel-2", "drf-tunnel-3"],
+        )
+
+    def test_missed_shrink(self, mocked_start_job, mocked_pods):
+        # 4 -> 3 was missed, 3 -> 2 must drain drf-tunnel-3 as well
+        create_tunnels({"drf-tunnel-2": 1, "drf-tunnel-3": 1})
+        drain.drain_removed_pods(3, 2)
+        self.assertEqual(
+            [c.args[2] for c in mocked_start_job.call_args_list],
+            ["drf-tunnel-2", "drf-tunnel-3"],
+        )
+
+    @mock.patch.dict(os.environ, {"HOSTNAME": "drf-tunnel-1"})
+    def test_only_first_pod(self, mocked_start_job, mocked_pods):
+        create_tunnels({"drf-tunnel-2": 1})
+        drain.drain_removed_pods(3, 2)
+        mocked_start_job.assert_not_called()
@@ -0,0 +1,87 @@
+import os
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from unittest import mock
+
+from forwarder.utils import sessions
+from rest_framework.test import APITestCase
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # Headers and body are sent separately, don't wait for the ACK
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(
+            (self.path, self.headers.get("Authorization", None))
+        )
+        body = b"ok"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.connections = 0
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@mock.patch.dict(
+    os.environ,
+    {"TUNNEL_AUTHENTICATION_TOKEN": "secret", "CERTIFICATE_PATH": "/tmp/ca.pem"},
+)
+class PodSessionTests(APITestCase):
+    def setUp(self):
+        sessions.close_sessions()
+        self.addCleanup(sessions.close_sessions)
+        return super().setUp()
+
+    def test_session_per_pod(self):
+        url = "https://drf-tunnel-0.drf-tunnel.default.svc:8443/api/"
+        session = sessions.get_session(f"{url}tunnel/")
+        self.assertIs(sessions.get_session(f"{url}restart/"), session)
+        self.assertIsNot(
+            sessions.get_session("https://drf-tunnel-1.drf-tunnel.default.svc:8443/"),
+            session,
+        )
+        self.assertEqual(session.headers["Authorization"], "secret")
+        self.assertEqual(session.verify, "/tmp/ca.pem")
+
+    def test_new_sessions_after_fork(self):
+        session = sessions.get_session("https://drf-tunnel-0:8443/")
+        with mock.patch("forwarder.utils.sessions.os.getpid", return_value=-1):
+            self.assertIsNot(
+                sessions.get_session("https://drf-tunnel-0:8443/"), session
+            )
+
+    def test_keep_alive(self):
+        server = start_server()
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        for i in range(5):
+            r = sessions.pod_request("GET", f"{url}/api/{i}/", timeout=5)
+            self.assertEqual(r.text, "ok")
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(server.requests[-1], ("/api/4/", "secret"))
+
+    def test_retry(self):
+        with mock.patch.dict(os.environ, {"FORWARDER_RETRIES": "3"}):
+            retry = sessions.get_retry()
+        self.assertEqual(retry.connect, 3)
+        self.assertEqual(retry.read, 0)
+        self.assertFalse(retry.is_retry("POST", 503))
+        self.assertTrue(retry.is_retry("PUT", 503))
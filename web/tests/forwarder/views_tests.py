@@ -0,0 +1,385 @@
+import json
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer
+from unittest import mock
+
+import requests
+from forwarder.utils import sessions
+from jupyterjsc_tunneling.retry import DeadlineExceededError
+from kubernetes.client.exceptions import ApiException as K8sApiException
+from tests.user_credentials import UserCredentials
+from tunnel.models import JobModel
+from tunnel.models import TunnelModel
+
+from tests.tunnel.mocks import mocked_popen_init
+from tests.tunnel.mocks import SynchronousThread
+
+from .sessions_tests import Handler
+
+
+def mocked_restart_request(method, url, **kwargs):
+    response = mock.MagicMock()
+    if "drf-tunnel-1." in url:
+        time.sleep(1)
+        raise requests.exceptions.ReadTimeout("Read timed out")
+    if "drf-tunnel-2." in url:
+        time.sleep(0.2)
+        response.ok = False
+        response.status_code = 500
+        response.content = b'{"error": "Unexpected Error"}'
+        response.json.return_value = {"error": "Unexpected Error"}
+        return response
+    time.sleep(0.2)
+    response.ok = True
+    response.status_code = 200
+    response.content = b""
+    return response
+
+
+@mock.patch.dict(os.environ, {"FORWARDER_FANOUT_DEADLINE": "0.5"})
+@mock.patch(
+    "forwarder.views.get_tunnel_sts_pod_names",
+    return_value=["drf-tunnel-0", "drf-tunnel-1", "drf-tunnel-2"],
+)
+@mock.patch("forwarder.utils.fanout.pod_request", side_effect=mocked_restart_request)
+class RestartForwarderViewTests(UserCredentials):
+    url = "/api/forwarder/restart/"
+
+    def test_restart_report(self, mocked_request, mocked_pods):
+        start = time.monotonic()
+        response = self.client.post(
+            self.url, data={"hostname": "demo_hostname"}, format="json"
+        )
+        duration = time.monotonic() - start
+        self.assertEqual(response.status_code, 200)
+        # Concurrent, the hung pod only costs the deadline
+        self.assertLess(duration, 0.9)
+        self.assertEqual(mocked_request.call_count, 3)
+        self.assertEqual(mocked_request.call_args[1]["timeout"][1], 0.5)
+        pods = response.data["pods"]
+        self.assertEqual(response.data["failed"], ["drf-tunnel-1", "drf-tunnel-2"])
+        self.assertEqual(pods["drf-tunnel-0"]["status"], "ok")
+        self.assertEqual(pods["drf-tunnel-1"]["status"], "timeout")
+        self.assertEqual(pods["drf-tunnel-2"]["status"], "error")
+        self.assertEqual(pods["drf-tunnel-2"]["status_code"], 500)
+        self.assertEqual(pods["drf-tunnel-2"]["detail"], {"error": "Unexpected Error"})
+
+    def test_restart_stream(self, mocked_request, mocked_pods):
+        response = self.client.post(
+            f"{self.url}?stream=true", data={"hostname": "demo_hostname"}, format="json"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        results = [json.loads(line) for line in lines]
+        self.assertEqual(len(results), 3)
+        # The hung pod comes last
+        self.assertEqual(results[-1]["pod"], "drf-tunnel-1")
+        self.assertEqual(results[-1]["status"], "timeout")
+
+
+class EchoHandler(Handler):
+    """Answers with the method, path, auth header, uuidcode and body"""
+
+    def echo(self, status):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.dumps(
+            {
+                "method": self.command,
+                "path": self.path,
+                "authorization": self.headers.get("Authorization", None),
+                "uuidcode": self.headers.get("uuidcode", None),
+                "body": self.rfile.read(length).decode(),
+            }
+        ).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.echo(200)
+
+    def do_POST(self):
+        self.echo(201)
+
+    def do_DELETE(self):
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class TunnelForwarderViewTests(UserCredentials):
+    url = "/api/forwarder/tunnel/"
+
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), EchoHandler)
+        self.server.connections = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(sessions.close_sessions)
+        self.pod_url = f"http://127.0.0.1:{self.server.server_address[1]}/api/tunnel/"
+        for patcher in [
+            mock.patch("forwarder.views.choose_pod", return_value="drf-tunnel-1"),
+            mock.patch(
+                "forwarder.views.get_service_url",
+                side_effect=lambda pod=None: self.pod_url,
+            ),
+            mock.patch(
+                "forwarder.views.get_responsible_pod_url",
+                side_effect=lambda instance, suffix: f"{self.pod_url}{suffix}/",
+            ),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        TunnelModel.objects.create(
+            servername="servername",
+            hostname="hostname",
+            local_port=40000,
+            svc_name="svc",
+            svc_port=8080,
+            target_node="targetnode",
+            target_port=34567,
+            tunnel_pod="drf-tunnel-1",
+            jhub_credential=self.user_authorized_username,
+        )
+
+    def test_redirect(self):
+        response = self.client.post(self.url, data={"servername": "servername"})
+        self.assertEqual(response.status_code, 307)
+        self.assertEqual(response["Location"], self.pod_url)
+
+    @mock.patch.dict(os.environ, {"FORWARDER_MODE": "proxy"})
+    def test_proxy(self):
+        response = self.client.post(
+            f"{self.url}?x=1",
+            data={"servername": "servername"},
+            format="json",
+            HTTP_UUIDCODE="abc",
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            json.loads(b"".join(response.streaming_content)),
+            {
+                "method": "POST",
+                "path": "/api/tunnel/?x=1",
+                "authorization": self.credentials_authorized["HTTP_AUTHORIZATION"],
+                "uuidcode": "abc",
+                "body": '{"servername":"servername"}',
+            },
+        )
+        response = self.client.get(f"{self.url}servername/")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header("Content-Length"))
+        body = json.loads(b"".join(response.streaming_content))
+        self.assertEqual(body["path"], "/api/tunnel/servername/")
+        response = self.client.delete(f"{self.url}servername/")
+        self.assertEqual(response.status_code, 204)
+        # All relayed over one keep-alive connection
+        self.assertEqual(self.server.connections, 1)
+
+    @mock.patch.dict(os.environ, {"FORWARDER_MODE": "proxy", "FORWARDER_RETRIES": "0"})
+    def test_proxy_unreachable(self):
+        self.server.shutdown()
+        self.server.server_close()
+        response = self.client.post(self.url, data={"servername": "servername"})
+        self.assertEqual(response.status_code, 502)
+
+    @mock.patch.dict(os.environ, {"FORWARDER_MODE": "proxy"})
+    @mock.patch("forwarder.utils.relay.remaining_time", return_value=0.05)
+    @mock.patch("forwarder.utils.relay.pod_request")
+    def test_proxy_deadline_head(self, mocked_pod_request, mocked_remaining_time):
+        # Nothing relayed, if the pod answered too late
+        r = mocked_pod_request.return_value
+
+        def slow_request(*args, **kwargs):
+            time.sleep(0.1)
+            return r
+
+        mocked_pod_request.side_effect = slow_request
+        response = self.client.get(f"{self.url}servername/")
+        self.assertEqual(response.status_code, 504)
+        r.raw.stream.assert_not_called()
+        r.close.assert_called_once_with()
+
+    @mock.patch.dict(os.environ, {"FORWARDER_MODE": "proxy"})
+    @mock.patch("forwarder.utils.relay.remaining_time", return_value=0.05)
+    @mock.patch("forwarder.utils.relay.pod_request")
+    def test_proxy_deadline_body(self, mocked_pod_request, mocked_remaining_time):
+        # The stream fails, the WSGI server aborts the connection
+        def stream(*args, **kwargs):
+            yield b'{"servername":'
+            time.sleep(0.1)
+            yield b'"servername"}'
+
+        r = mocked_pod_request.return_value
+        r.status_code = 200
+        r.headers = {"Content-Type": "application/json", "Content-Length": "27"}
+        r.raw.stream.side_effect = stream
+        response = self.client.get(f"{self.url}servername/")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header("Content-Length"))
+        content = iter(response.streaming_content)
+        self.assertEqual(next(content), b'{"servername":')
+        with self.assertRaises(DeadlineExceededError):
+            next(content)
+        r.close.assert_called_once_with()
+
+    @mock.patch.dict(os.environ, {"HOSTNAME": "drf-tunnel-1"})
+    @mock.patch("forwarder.utils.relay.pod_request")
+    @mock.patch("tunnel.executor.subprocess.Popen", side_effect=mocked_popen_init)
+    def test_local(self, mocked_popen_init, mocked_pod_request):
+        for mode in ["redirect", "proxy"]:
+            with mock.patch.dict(os.environ, {"FORWARDER_MODE": mode}):
+                response = self.client.get(f"{self.url}servername/")
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.data["servername"], "servername")
+        data = {
+            "servername": "servername2",
+            "hostname": "hostname",
+            "svc_name": "svc2",
+            "svc_port": 8080,
+            "target_node": "targetnode",
+            "target_port": 34567,
+        }
+        response = self.client.post(self.url, data=data, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            TunnelModel.objects.get(servername="servername2").tunnel_pod,
+            "drf-tunnel-1",
+        )
+        response = self.client.delete(f"{self.url}servername2/")
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(TunnelModel.objects.filter(servername="servername2").exists())
+        self.assertEqual(mocked_pod_request.call_count, 0)
+        self.assertEqual(self.server.connections, 0)
+
+
+def mocked_migrate_request(method, url, data=None, **kwargs):
+    # The new pod keeps the local port, unless told otherwise
+    response = mock.MagicMock()
+    response.ok = True
+    if data["start_tunnel"]:
+        local_port = data.get("new_local_port", data["local_port"])
+        TunnelModel.objects.filter(servername=data["servername"]).update(
+            tunnel_pod=data["tunnel_pod"], local_port=local_port
+        )
+        response.status_code = 200
+        response.json.return_value = {
+            "servername": data["servername"],
+            "local_port": local_port,
+        }
+    else:
+        response.status_code = 204
+    return response
+
+
+@mock.patch("tunnel.jobs.connection")
+@mock.patch("tunnel.jobs.threading", mock.MagicMock(Thread=SynchronousThread))
+@mock.patch("forwarder.views.edit_service_selector")
+@mock.patch("forwarder.utils.migrate.pod_request", side_effect=mocked_migrate_request)
+class MigrateForwarderViewTests(UserCredentials):
+    url = "/api/forwarder/tunnel/servername/"
+
+    def setUp(self):
+        super().setUp()
+        TunnelModel.objects.create(
+            servername="servername",
+            hostname="hostname",
+            local_port=40000,
+            svc_name="svc",
+            svc_port=8080,
+            target_node="targetnode",
+            target_port=34567,
+            tunnel_pod="drf-tunnel-1",
+            jhub_credential=self.user_authorized_username,
+        )
+
+    def test_port_kept(self, mocked_request, mocked_edit, mocked_connection):
+        response = self.client.put(self.url, data={"new_pod": "drf-tunnel-2"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["local_port"], 40000)
+        # Selector only
+        mocked_edit.assert_called_once_with("svc", "drf-tunnel-2", None)
+        methods = [
+            (call[1]["data"]["start_tunnel"], call[0][1])
+            for call in mocked_request.call_args_list
+        ]
+        self.assertEqual(len(methods), 2)
+        self.assertTrue(methods[0][0] and "drf-tunnel-2." in methods[0][1])
+        self.assertTrue(not methods[1][0] and "drf-tunnel-1." in methods[1][1])
+        job = JobModel.objects.get(kind="teardown")
+        self.assertEqual(job.status, "finished")
+        self.assertEqual(job.result["pod"], "drf-tunnel-1")
+        self.assertIn("start;dur=", response["Server-Timing"])
+        self.assertIn("service;dur=", response["Server-Timing"])
+
+    def test_new_port(self, mocked_request, mocked_edit, mocked_connection):
+        mocked_request.side_effect = lambda method, url, data, **kwargs: (
+            mocked_migrate_request(
+                method, url, data=dict(data, new_local_port=40001), **kwargs
+            )
+        )
+        response = self.client.put(self.url, data={"new_pod": "drf-tunnel-2"})
+        self.assertEqual(response.status_code, 200)
+        mocked_edit.assert_called_once_with("svc", "drf-tunnel-2", 40001)
+
+    def test_already_moved(self, mocked_request, mocked_edit, mocked_connection):
+        # E.g. retried after a failed service patch: only the service
+        response = self.client.put(self.url, data={"new_pod": "drf-tunnel-1"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["servername"], "servername")
+        mocked_edit.assert_called_once_with("svc", "drf-tunnel-1", 40000)
+        self.assertEqual(mocked_request.call_count, 0)
+        self.assertFalse(JobModel.objects.filter(kind="teardown").exists())
+
+    @mock.patch.dict(os.environ, {"TUNNEL_ROUTING_MODE": "proxy"})
+    def test_proxy_mode(self, mocked_request, mocked_edit, mocked_connection):
+        # No service per tunnel, the routing proxy of the new pod serves it
+        response = self.client.put(self.url, data={"new_pod": "drf-tunnel-2"})
+        self.assertEqual(response.status_code, 200)
+        mocked_edit.assert_not_called()
+        self.assertEqual(mocked_request.call_count, 2)
+        job = JobModel.objects.get(kind="teardown")
+        self.assertEqual(job.status, "finished")
+        self.assertNotIn("service;dur=", response["Server-Timing"])
+
+    def test_start_failed(self, mocked_request, mocked_edit, mocked_connection):
+        response = mock.MagicMock(ok=False, status_code=500, text="error")
+        response.json.return_value = {"error": "error"}
+        mocked_request.side_effect = None
+        mocked_request.return_value = response
+        response = self.client.put(self.url, data={"new_pod": "drf-tunnel-2"})
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(mocked_edit.call_count, 0)
+        self.assertEqual(mocked_request.call_count, 1)
+
+    def test_service_failed_retry(self, mocked_request, mocked_edit, mocked_connection):
+        mocked_edit.side_effect = K8sApiException(status=409, reason="Conflict")
+        response = self.client.put(self.url, data={"new_pod": "drf-tunnel-2"})
+        self.assertEqual(response.status_code, 409)
+        # Users are still on the old forward, it keeps running
+        self.assertEqual(mocked_request.call_count, 1)
+        self.assertFalse(JobModel.objects.filter(kind="teardown").exists())
+        instance = TunnelModel.objects.get(servername="servername")
+        self.assertEqual(instance.tunnel_pod, "drf-tunnel-2")
+        self.assertEqual(
+            instance.old_forwards, [{"pod": "drf-tunnel-1", "local_port": 40000}]
+        )
+
+        # The retry finds the tunnel on the new pod, the old one is stopped
+        mocked_edit.side_effect = None
+        response = self.client.put(self.url, data={"new_pod": "drf-tunnel-2"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mocked_request.call_count, 2)
+        stop = mocked_request.call_args
+        self.assertEqual(stop[1]["data"]["start_tunnel"], False)
+        self.assertIn("drf-tunnel-1.", stop[0][1])
+        job = JobModel.objects.get(kind="teardown")
+        self.assertEqual(job.result["pod"], "drf-tunnel-1")
+        instance.refresh_from_db()
+        self.assertEqual(instance.old_forwards, [])
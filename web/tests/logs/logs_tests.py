@@ -1,7 +1,11 @@
 import copy
 import logging
+import os
+import time
+from unittest import mock
 
 from django.urls import reverse
+from jupyterjsc_tunneling import metrics
 from jupyterjsc_tunneling.settings import LOGGER_NAME
 from logs import utils
 from logs.models import HandlerModel
@@ -112,3 +116,40 @@ class LogsUnitTest(UserCredentials):
         response = self.client.delete(f"{url}stream/", format="json")
         self.client.get(logtest_url)
         self.assertEqual(len(log.handlers), 0)
+
+
+class MetricsUnitTest(UserCredentials):
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        return super().setUp()
+
+    def test_get(self):
+        metrics.increment("mux_calls", action="check")
+        metrics.observe("k8s_api", 0.02, method="patch")
+        response = self.client.get(reverse("metrics-list"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["pid"], os.getpid())
+        self.assertEqual(response.data["counters"], {"mux_calls{action=check}": 1})
+        self.assertEqual(
+            response.data["latencies"]["k8s_api{method=patch}"]["count"], 1
+        )
+
+    def test_get_forbidden(self):
+        self.client.credentials(**self.credentials_unauthorized)
+        response = self.client.get(reverse("metrics-list"))
+        self.assertEqual(response.status_code, 403)
+
+    @mock.patch.dict(os.environ, {"METRICS_LOG_INTERVAL": "0.05"})
+    def test_logger(self):
+        metrics.increment("mux_calls", action="check")
+        with self.assertLogs(LOGGER_NAME, level="INFO") as logs:
+            logger = metrics.start_metrics_logger()
+            time.sleep(0.2)
+            logger.stop()
+        record = [r for r in logs.records if r.getMessage() == "Metrics"][0]
+        self.assertEqual(record.counters, {"mux_calls{action=check}": 1})
+
+    @mock.patch.dict(os.environ, {"METRICS_LOG_INTERVAL": "0"})
+    def test_logger_disabled(self):
+        self.assertIsNone(metrics.start_metrics_logger())
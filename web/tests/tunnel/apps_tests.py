@@ -0,0 +1,141 @@
+import threading
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+from unittest import mock
+
+from django.apps import apps
+from rest_framework.test import APITestCase
+from tunnel.models import TunnelModel
+from tunnel.pool import run_grouped
+from tunnel.utils import invalidate_connection_health
+
+from .mocks import mocked_popen_init
+from .mocks import mocked_popen_init_forward_fail
+
+
+def service(name, port, target_port, pod):
+    return SimpleNamespace(
+        metadata=SimpleNamespace(name=name),
+        spec=SimpleNamespace(
+            ports=[SimpleNamespace(port=port, target_port=target_port)],
+            selector={"statefulset.kubernetes.io/pod-name": pod},
+        ),
+    )
+
+
+class RunGroupedTests(APITestCase):
+    def test_limits(self):
+        lock = threading.Lock()
+        running = defaultdict(int)
+        max_running = defaultdict(int)
+
+        def func(item):
+            with lock:
+                running[item[0]] += 1
+                running["all"] += 1
+                max_running[item[0]] = max(max_running[item[0]], running[item[0]])
+                max_running["all"] = max(max_running["all"], running["all"])
+            time.sleep(0.01)
+            with lock:
+                running[item[0]] -= 1
+                running["all"] -= 1
+            if item[1] == 0:
+                raise Exception("failed")
+
+        items = ((host, i) for host in ["a", "b", "c"] for i in range(20))
+        total, failed = run_grouped(
+            items, key=lambda x: x[0], func=func, max_workers=5, max_per_key=2
+        )
+        self.assertEqual(total, 60)
+        self.assertEqual(failed, 3)
+        self.assertLessEqual(max_running["all"], 5)
+        for host in ["a", "b", "c"]:
+            self.assertLessEqual(max_running[host], 2)
+
+
+class StartTunnelsInDBTests(APITestCase):
+    def setUp(self):
+        invalidate_connection_health()
+        return super().setUp()
+
+    def create_tunnels(self, hostnames, count):
+        for hostname in hostnames:
+            for i in range(count):
+                TunnelModel.objects.create(
+                    servername=f"{hostname}-{i}",
+                    hostname=hostname,
+                    local_port=40000 + i,
+                    svc_name=f"svc-{hostname}-{i}",
+                    svc_port=8080,
+                    target_node="targetnode",
+                    target_port=34567,
+                )
+
+    def mock_k8s_client(self, services=[]):
+        client = mock.MagicMock()
+        client.list_namespaced_service.return_value = SimpleNamespace(
+            items=services,
+            metadata=SimpleNamespace(_continue=None, resource_version="1"),
+        )
+        patcher = mock.patch("tunnel.services.k8s_get_client", return_value=client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return client
+
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_popen_init,
+    )
+    def test_start_tunnels_in_db(self, mocked_popen_init):
+        client = self.mock_k8s_client()
+        self.create_tunnels(["host1", "host2"], 10)
+        apps.get_app_config("tunnel").start_tunnels_in_db()
+        forward_calls = [
+            x[0][0] for x in mocked_popen_init.call_args_list if "forward" in x[0][0]
+        ]
+        # One ssh command per host, forwarding all ports of this host
+        self.assertEqual(len(forward_calls), 2)
+        self.assertEqual(sum(x.count("-L") for x in forward_calls), 20)
+        self.assertEqual(client.list_namespaced_service.call_count, 1)
+        self.assertEqual(client.create_namespaced_service.call_count, 20)
+
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_popen_init,
+    )
+    def test_start_tunnels_in_db_services_exist(self, mocked_popen_init):
+        self.create_tunnels(["host1"], 3)
+        client = self.mock_k8s_client(
+            [
+                service("svc-host1-0", 8080, 40000, "drf-tunnel-0"),
+                service("svc-host1-1", 8080, 40001, "drf-tunnel-1"),
+                service("svc-host1-2", 8080, 40002, "drf-tunnel-0"),
+                service("svc-gone", 8080, 40003, "drf-tunnel-0"),
+            ]
+        )
+        apps.get_app_config("tunnel").start_tunnels_in_db()
+        self.assertEqual(client.create_namespaced_service.call_count, 0)
+        self.assertEqual(
+            [x[0][0] for x in client.patch_namespaced_service.call_args_list],
+            ["svc-host1-1"],
+        )
+        self.assertEqual(
+            [x[1]["name"] for x in client.delete_namespaced_service.call_args_list],
+            ["svc-gone"],
+        )
+
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_popen_init_forward_fail,
+    )
+    def test_start_tunnels_in_db_forward_fail(self, mocked_popen_init):
+        self.create_tunnels(["host1"], 3)
+        client = self.mock_k8s_client(
+            [
+                service(f"svc-host1-{i}", 8080, 40000 + i, "drf-tunnel-0")
+                for i in range(3)
+            ]
+        )
+        apps.get_app_config("tunnel").start_tunnels_in_db()
+        self.assertEqual(client.delete_namespaced_service.call_count, 3)
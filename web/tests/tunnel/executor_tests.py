@@ -0,0 +1,150 @@
+import asyncio
+import os
+import time
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from unittest import mock
+
+from jupyterjsc_tunneling.retry import deadline_scope
+from rest_framework.test import APITestCase
+from tunnel import utils
+from tunnel.executor import ExecutorQueueFullError
+from tunnel.executor import ExecutorQueueTimeoutError
+from tunnel.executor import get_executor
+from tunnel.executor import SSHCommandExecutor
+
+from .mocks import mocked_popen_init
+from .mocks import mocked_slow_popen_init
+from .mocks import mocked_timeout_popen_init
+from .mocks import SlowPopenMocked
+
+
+class BlockingPopenMocked(SlowPopenMocked):
+    latency = 0.5
+
+
+class SSHCommandExecutorTests(APITestCase):
+    cmd = ["ssh", "-O", "check", "tunnel_hostname"]
+
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_popen_init,
+    )
+    def test_run(self, mocked_popen_init):
+        returncode, stdout, stderr = get_executor().run(self.cmd, 3)
+        self.assertEqual(returncode, 0)
+        self.assertEqual(stdout, b"stdout")
+        self.assertEqual(mocked_popen_init.call_args_list[0][0][0], self.cmd)
+
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_timeout_popen_init,
+    )
+    def test_run_timeout(self, mocked_timeout_popen_init):
+        returncode, stdout, stderr = get_executor().run(self.cmd, 1)
+        self.assertEqual(returncode, 124)
+        self.assertEqual(stdout, b"timeout")
+
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_popen_init,
+    )
+    def test_submit_async(self, mocked_popen_init):
+        async def run_all():
+            return await asyncio.gather(
+                *[get_executor().submit_async(self.cmd, 3) for _ in range(10)]
+            )
+
+        results = asyncio.run(run_all())
+        self.assertEqual([x[0] for x in results], [0] * 10)
+        self.assertEqual(mocked_popen_init.call_count, 10)
+
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_slow_popen_init,
+    )
+    def test_queue_full(self, mocked_slow_popen_init):
+        executor = SSHCommandExecutor(max_procs=1, queue_size=1)
+        try:
+            futures = [executor.submit(self.cmd, 3) for _ in range(5)]
+            exceptions = [f.exception(timeout=5) for f in futures]
+        finally:
+            executor.stop()
+        self.assertIsNone(exceptions[0])
+        self.assertTrue(any(isinstance(e, ExecutorQueueFullError) for e in exceptions))
+
+    @mock.patch("tunnel.executor.subprocess.Popen", side_effect=BlockingPopenMocked)
+    def test_queue_timeout(self, mocked_popen_init):
+        executor = SSHCommandExecutor(max_procs=1)
+        try:
+            first = executor.submit(self.cmd, 3)
+            second = executor.submit(self.cmd, 3, queue_timeout=0.1)
+            self.assertEqual(first.result(timeout=5)[0], 0)
+            self.assertIsInstance(
+                second.exception(timeout=5), ExecutorQueueTimeoutError
+            )
+        finally:
+            executor.stop()
+        self.assertEqual(mocked_popen_init.call_count, 1)
+
+    @mock.patch("tunnel.executor.subprocess.Popen", side_effect=BlockingPopenMocked)
+    def test_callable_shares_slots(self, mocked_popen_init):
+        func = mock.MagicMock(return_value=(0, b"", b""))
+        executor = SSHCommandExecutor(max_procs=1)
+        try:
+            executor.submit(self.cmd, 3)
+            second = executor.submit(func, 3, queue_timeout=0.1)
+            self.assertIsInstance(
+                second.exception(timeout=5), ExecutorQueueTimeoutError
+            )
+            self.assertEqual(executor.run(func, 3), (0, b"", b""))
+        finally:
+            executor.stop()
+        func.assert_called_once_with(timeout=3)
+        self.assertEqual(mocked_popen_init.call_count, 1)
+
+    @mock.patch("tunnel.executor.subprocess.Popen", side_effect=BlockingPopenMocked)
+    def test_run_timeout_cancels(self, mocked_popen_init):
+        executor = SSHCommandExecutor(max_procs=1)
+        futures = []
+
+        def submit(*args, **kwargs):
+            futures.append(SSHCommandExecutor.submit(executor, *args, **kwargs))
+            return futures[-1]
+
+        try:
+            executor.submit(self.cmd, 3)
+            with mock.patch.object(executor, "submit", side_effect=submit):
+                with self.assertRaises(FuturesTimeoutError):
+                    executor.run(self.cmd, 0.05, queue_timeout=0.05)
+            self.assertTrue(futures[0].cancelled())
+            time.sleep(1)
+        finally:
+            executor.stop()
+        self.assertEqual(mocked_popen_init.call_count, 1)
+
+    @mock.patch("tunnel.executor.subprocess.Popen", side_effect=BlockingPopenMocked)
+    def test_budget(self, mocked_popen_init):
+        executor = SSHCommandExecutor(max_procs=1)
+        try:
+            executor.submit(self.cmd, 3)
+            start = time.monotonic()
+            with self.assertRaises((FuturesTimeoutError, ExecutorQueueTimeoutError)):
+                executor.run(self.cmd, 3, queue_timeout=5, budget=0.1)
+            self.assertLess(time.monotonic() - start, 0.4)
+            time.sleep(1)
+        finally:
+            executor.stop()
+        self.assertEqual(mocked_popen_init.call_count, 1)
+
+    def test_budget_from_deadline(self):
+        with mock.patch("tunnel.utils.get_executor") as mocked_executor:
+            mocked_executor.return_value.run.return_value = (0, b"", b"")
+            with deadline_scope(2):
+                utils.run_popen_cmd("remote", "status", "status", hostname="host")
+        kwargs = mocked_executor.return_value.run.call_args[1]
+        self.assertTrue(0 < kwargs["budget"] <= 2)
+
+    @mock.patch.dict(os.environ, {"SSHTIMEOUT": "5", "SSHTIMEOUT_CREATE": "20"})
+    def test_ssh_timeout_per_action(self):
+        self.assertEqual(utils.get_ssh_timeout("create"), 20)
+        self.assertEqual(utils.get_ssh_timeout("forward"), 5)
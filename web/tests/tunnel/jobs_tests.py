@@ -0,0 +1,83 @@
+import datetime
+import os
+from unittest import mock
+
+from django.utils import timezone
+from rest_framework.test import APITestCase
+from tunnel import jobs
+from tunnel.models import JobModel
+
+from .mocks import SynchronousThread
+
+
+class JobTests(APITestCase):
+    def create_job(self, job_id, owner="drf-tunnel-1:1234", age=0):
+        job = JobModel.objects.create(job_id=job_id, kind="restart", owner=owner)
+        JobModel.objects.filter(job_id=job_id).update(
+            updated_at=timezone.now() - datetime.timedelta(seconds=age)
+        )
+        return job
+
+    @mock.patch("tunnel.jobs.start_job_heartbeat")
+    @mock.patch("tunnel.jobs.connection")
+    @mock.patch("tunnel.jobs.threading", mock.MagicMock(Thread=SynchronousThread))
+    def test_owner(self, mocked_connection, mocked_heartbeat):
+        with mock.patch.dict(os.environ, {"HOSTNAME": "drf-tunnel-2"}):
+            job = jobs.start_job("restart", lambda job: {"done": True})
+        self.assertEqual(job.owner, f"drf-tunnel-2:{os.getpid()}")
+        self.assertEqual(jobs.get_job(job.job_id, "restart").status, "finished")
+        mocked_heartbeat.assert_called_once()
+
+    @mock.patch.dict(os.environ, {"JOB_HEARTBEAT_TIMEOUT": "60"})
+    def test_orphaned_when_polled(self):
+        self.create_job("alive", age=10)
+        self.create_job("orphaned", age=120)
+        self.assertEqual(jobs.get_job("alive", "restart").status, "running")
+        job = jobs.get_job("orphaned", "restart")
+        self.assertEqual(job.status, "failed")
+        self.assertIn("Orphaned", job.result["error"])
+        self.assertIsNone(jobs.get_job("orphaned", "drain"))
+
+    @mock.patch.dict(os.environ, {"JOB_RETENTION_HOURS": "1"})
+    @mock.patch("tunnel.jobs.start_job_heartbeat")
+    @mock.patch("tunnel.jobs.connection")
+    @mock.patch("tunnel.jobs.threading", mock.MagicMock(Thread=SynchronousThread))
+    def test_retention(self, mocked_connection, mocked_heartbeat):
+        for job_id, status in [("old-1", "finished"), ("old-2", "failed")]:
+            self.create_job(job_id, age=7200)
+            JobModel.objects.filter(job_id=job_id).update(status=status)
+        self.create_job("recent", age=60)
+        JobModel.objects.filter(job_id="recent").update(status="finished")
+        # Running without heartbeat: failed first, deleted an hour later
+        self.create_job("orphaned", age=7200)
+        job = jobs.start_job("restart", lambda job: None)
+        self.assertEqual(
+            sorted(JobModel.objects.values_list("job_id", flat=True)),
+            sorted([job.job_id, "orphaned", "recent"]),
+        )
+        self.assertEqual(JobModel.objects.get(job_id="orphaned").status, "failed")
+
+    def test_fail_jobs_of_pod(self):
+        self.create_job("job-1", owner="drf-tunnel-1:1")
+        self.create_job("job-11", owner="drf-tunnel-11:1")
+        failed = jobs.fail_jobs_of_pod("drf-tunnel-1")
+        self.assertEqual([job.job_id for job in failed], ["job-1"])
+        self.assertEqual(JobModel.objects.get(job_id="job-11").status, "running")
+
+    @mock.patch.dict(os.environ, {"JOB_HEARTBEAT_INTERVAL": "0.01"})
+    def test_heartbeat(self):
+        heartbeat = jobs.JobHeartbeat()
+        self.create_job("job", owner=heartbeat.owner, age=120)
+        updated = []
+
+        def update(**kwargs):
+            updated.append(kwargs)
+            # Stops once this worker has no running jobs left
+            return 1 if len(updated) < 3 else 0
+
+        with mock.patch("tunnel.jobs.JobModel.objects.filter") as mocked_filter:
+            mocked_filter.return_value.update.side_effect = update
+            with mock.patch("tunnel.jobs.connection"):
+                heartbeat.run()
+        mocked_filter.assert_called_with(owner=heartbeat.owner, status="running")
+        self.assertEqual(len(updated), 3)
@@ -0,0 +1,80 @@
+import os
+import tempfile
+from unittest import mock
+
+from jupyterjsc_tunneling import k8s
+from jupyterjsc_tunneling import metrics
+from rest_framework.test import APITestCase
+
+
+class K8sClientTests(APITestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.token_file = os.path.join(self.tmpdir.name, "token")
+        cert_file = os.path.join(self.tmpdir.name, "ca.crt")
+        self.write_token("token1")
+        with open(cert_file, "w") as f:
+            f.write("cert")
+        patcher = mock.patch.dict(
+            os.environ,
+            {
+                "KUBERNETES_SERVICE_HOST": "10.0.0.1",
+                "KUBERNETES_SERVICE_PORT": "443",
+                "K8S_TOKEN_FILE": self.token_file,
+                "K8S_CA_FILE": cert_file,
+            },
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        k8s.reset_k8s_client()
+        self.addCleanup(k8s.reset_k8s_client)
+        metrics.reset()
+        return super().setUp()
+
+    def write_token(self, token, mtime=None):
+        with open(self.token_file, "w") as f:
+            f.write(token)
+        if mtime:
+            os.utime(self.token_file, (mtime, mtime))
+
+    def test_client_reused(self):
+        first = k8s.get_k8s_client()
+        self.assertIs(k8s.get_k8s_client(), first)
+        self.assertEqual(first.configuration.host, "https://10.0.0.1:443")
+        self.assertEqual(first.configuration.api_key["authorization"], "bearer token1")
+
+    def test_client_rebuilt_after_fork(self):
+        first = k8s.get_k8s_client()
+        with mock.patch("os.getpid", return_value=first.pid + 1):
+            second = k8s.get_k8s_client()
+        self.assertIsNot(first, second)
+
+    def test_token_rotation(self):
+        first = k8s.get_k8s_client()
+        api_client = first.api_client
+        self.write_token("token2", mtime=first.token_mtime + 10)
+        second = k8s.get_k8s_client()
+        self.assertIs(first, second)
+        self.assertIs(second.api_client, api_client)
+        self.assertEqual(second.configuration.api_key["authorization"], "bearer token2")
+        self.assertEqual(metrics.snapshot()["counters"]["k8s_token_reloads"], 1)
+
+    def test_latency_recorded(self):
+        api = k8s.get_core_v1_api()
+        with mock.patch.object(
+            api._api, "list_namespaced_pod", return_value="pods"
+        ), mock.patch.object(
+            api._api, "delete_namespaced_service", side_effect=Exception("gone")
+        ):
+            self.assertEqual(api.list_namespaced_pod(namespace="default"), "pods")
+            with self.assertRaises(Exception):
+                api.delete_namespaced_service(name="svc", namespace="default")
+        snapshot = metrics.snapshot()
+        self.assertEqual(
+            snapshot["latencies"]["k8s_api{method=list_namespaced_pod}"]["count"], 1
+        )
+        self.assertEqual(
+            snapshot["counters"]["k8s_api_errors{method=delete_namespaced_service}"],
+            1,
+        )
@@ -0,0 +1,90 @@
+import os
+import tempfile
+from unittest import mock
+
+from rest_framework.test import APITestCase
+from tunnel.load import count_established_connections
+from tunnel.load import count_open_fds
+from tunnel.load import get_cpu_usage
+from tunnel.load import LoadReporter
+from tunnel.models import PodLoadModel
+from tunnel.models import TunnelModel
+
+tcp_table = """  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 00000000:9C40 00000000:0000 0A 00000000:00000000 00:00000000 00000000  1000        0 1 1 0000000000000000 100 0 0 10 0
+   1: 0100007F:9C40 0100007F:D431 01 00000000:00000000 00:00000000 00000000  1000        0 2 1 0000000000000000 20 4 30 10 -1
+   2: 0100007F:9C40 0100007F:D432 01 00000000:00000000 00:00000000 00000000  1000        0 3 1 0000000000000000 20 4 30 10 -1
+   3: 0100007F:D431 0100007F:9C40 01 00000000:00000000 00:00000000 00000000  1000        0 4 1 0000000000000000 20 4 30 10 -1
+   4: 0100007F:9C41 0100007F:D433 06 00000000:00000000 00:00000000 00000000  1000        0 5 1 0000000000000000 20 4 30 10 -1
+"""
+
+
+class LoadReportTests(APITestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        return super().setUp()
+
+    def write(self, name, content):
+        path = os.path.join(self.tmpdir.name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def test_count_established_connections(self):
+        path = self.write("tcp", tcp_table)
+        # 0x9C40 = 40000, 0x9C41 = 40001 (TIME_WAIT)
+        self.assertEqual(count_established_connections({40000, 40001}, [path]), 2)
+        self.assertEqual(count_established_connections(set(), [path]), 0)
+        self.assertEqual(count_established_connections({40000}, ["/nonexistent"]), 0)
+
+    def test_count_open_fds(self):
+        for pid, fds in [("1", 3), ("25", 2)]:
+            for fd in range(fds):
+                self.write(os.path.join(pid, "fd", str(fd)), "")
+        self.write("self/fd/0", "")
+        self.write("version", "")
+        self.assertEqual(count_open_fds(self.tmpdir.name), 5)
+
+    def test_get_cpu_usage(self):
+        v2 = self.write("cpu.stat", "usage_usec 2500000\nuser_usec 2000000\n")
+        v1 = self.write("cpuacct.usage", "1500000000\n")
+        self.assertEqual(get_cpu_usage([v2, v1]), 2.5)
+        self.assertEqual(get_cpu_usage(["/nonexistent", v1]), 1.5)
+        self.assertEqual(get_cpu_usage(["/nonexistent"]), None)
+
+    @mock.patch("tunnel.load.count_open_fds", return_value=120)
+    @mock.patch("tunnel.load.count_established_connections", return_value=4)
+    @mock.patch("tunnel.load.count_ssh_masters", return_value=1)
+    def test_publish(self, mocked_masters, mocked_connections, mocked_fds):
+        for i in range(2):
+            TunnelModel.objects.create(
+                servername=f"servername-{i}",
+                hostname="hostname",
+                local_port=40000 + i,
+                svc_name=f"svc-{i}",
+                svc_port=8080,
+                target_node="targetnode",
+                target_port=34567,
+                tunnel_pod="drf-tunnel-1",
+            )
+        reporter = LoadReporter(podname="drf-tunnel-1")
+        with mock.patch("tunnel.load.get_cpu_usage", return_value=10.0):
+            reporter.publish()
+        with mock.patch("tunnel.load.get_cpu_usage", return_value=10.5), mock.patch(
+            "tunnel.load.time.monotonic", return_value=reporter._last_cpu[1] + 2
+        ):
+            reporter.publish()
+        self.assertEqual(mocked_masters.call_args[0][0], {"hostname"})
+        self.assertEqual(mocked_connections.call_args[0][0], {40000, 40001})
+        self.assertEqual(
+            PodLoadModel.objects.get(pod="drf-tunnel-1").report,
+            {
+                "tunnels": 2,
+                "ssh_masters": 1,
+                "connections": 4,
+                "open_fds": 120,
+                "cpu": 0.25,
+            },
+        )
@@ -1,3 +1,7 @@
+import subprocess
+import time
+
+
 def mocked_popen_init(*args, **kwargs):
     return PopenMocked(*args, **kwargs)
 
@@ -30,6 +34,14 @@ def mocked_popen_init_all_fail(*args, **kwargs):
     return PopenMockedAllFail(*args, **kwargs)
 
 
+def mocked_slow_popen_init(*args, **kwargs):
+    return SlowPopenMocked(*args, **kwargs)
+
+
+def mocked_timeout_popen_init(*args, **kwargs):
+    return TimeoutPopenMocked(*args, **kwargs)
+
+
 class PopenMocked:
     cmd = ""
 
@@ -142,3 +154,33 @@ class PopenMockedAllFail(PopenMocked):
     @property
     def returncode(self):
         return 255
+
+
+class SlowPopenMocked(PopenMocked):
+    # Roughly the duration of a ssh control command on a busy pod
+    latency = 0.02
+
+    def communicate(self, timeout=10):
+        time.sleep(self.latency)
+        return super().communicate(timeout=timeout)
+
+
+class TimeoutPopenMocked(PopenMocked):
+    killed = False
+
+    def communicate(self, timeout=10):
+        raise subprocess.TimeoutExpired(self.cmd, timeout)
+
+    def kill(self):
+        self.killed = True
+
+
+class SynchronousThread:
+    # Runs background jobs directly, so they share the test transaction
+    def __init__(self, target=None, args=(), kwargs={}, **_kwargs):
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs
+
+    def start(self):
+        self.target(*self.args, **self.kwargs)
@@ -0,0 +1,382 @@
+import getpass
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from rest_framework.test import APITestCase
+from tunnel import mux
+from tunnel import utils
+from tunnel.executor import SSHCommandExecutor
+
+from .mocks import mocked_popen_init
+
+
+class FakeControlMaster:
+    """
+    Minimal ControlMaster speaking the mux protocol on a unix socket.
+    Forwards with connect port 0 are rejected.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.forwards = set()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(5)
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.sock.close()
+
+    def recv_packet(self, conn):
+        header = conn.recv(4)
+        if len(header) < 4:
+            return None
+        (length,) = struct.unpack(">I", header)
+        data = b""
+        while len(data) < length:
+            data += conn.recv(length - len(data))
+        return data
+
+    def send_packet(self, conn, payload):
+        conn.sendall(struct.pack(">I", len(payload)) + payload)
+
+    def read_string(self, data, offset):
+        (length,) = struct.unpack(">I", data[offset : offset + 4])
+        return data[offset + 4 : offset + 4 + length].decode(), offset + 4 + length
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with conn:
+                self.send_packet(
+                    conn, struct.pack(">II", mux.MUX_MSG_HELLO, mux.SSHMUX_VER)
+                )
+                while True:
+                    packet = self.recv_packet(conn)
+                    if packet is None:
+                        break
+                    msg_type, request_id = struct.unpack(">II", packet[:8])
+                    if msg_type == mux.MUX_MSG_HELLO:
+                        continue
+                    if msg_type == mux.MUX_C_ALIVE_CHECK:
+                        self.send_packet(
+                            conn,
+                            struct.pack(">III", mux.MUX_S_ALIVE, request_id, 1234),
+                        )
+                        continue
+                    offset = 12
+                    listen_host, offset = self.read_string(packet, offset)
+                    (listen_port,) = struct.unpack(">I", packet[offset : offset + 4])
+                    connect_host, offset = self.read_string(packet, offset + 4)
+                    (connect_port,) = struct.unpack(">I", packet[offset : offset + 4])
+                    forward = (listen_host, listen_port, connect_host, connect_port)
+                    if msg_type == mux.MUX_C_OPEN_FWD and connect_port != 0:
+                        self.forwards.add(forward)
+                        reply = struct.pack(">II", mux.MUX_S_OK, request_id)
+                    elif msg_type == mux.MUX_C_CLOSE_FWD and forward in self.forwards:
+                        self.forwards.remove(forward)
+                        reply = struct.pack(">II", mux.MUX_S_OK, request_id)
+                    elif msg_type == mux.MUX_C_CLOSE_FWD:
+                        # Same reason as OpenSSH's mux master
+                        reason = b"port not found"
+                        reply = struct.pack(
+                            ">III", mux.MUX_S_FAILURE, request_id, len(reason)
+                        )
+                        reply += reason
+                    else:
+                        reason = b"port forwarding failed"
+                        reply = struct.pack(
+                            ">III", mux.MUX_S_FAILURE, request_id, len(reason)
+                        )
+                        reply += reason
+                    self.send_packet(conn, reply)
+
+
+class MuxClientTests(APITestCase):
+    def setUp(self):
+        utils.invalidate_connection_health()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.control_path = os.path.join(self.tmpdir.name, "tunnel_hostname")
+        self.config_path = os.path.join(self.tmpdir.name, "config")
+        with open(self.config_path, "w") as f:
+            f.write(
+                "Host *\n"
+                "    ControlMaster auto\n"
+                "    Port 2223\n\n"
+                "Host tunnel_hostname\n"
+                "    HostName localhost\n"
+                f"    ControlPath {self.tmpdir.name}/%n\n\n"
+                "Host tunnel_other\n"
+                "    HostName other.example.com\n"
+                f"    ControlPath {self.tmpdir.name}/%r@%h:%p\n"
+                "    User ljupyter\n"
+            )
+        patcher = mock.patch.dict(os.environ, {"SSHCONFIGFILE": self.config_path})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.master = FakeControlMaster(self.control_path)
+        self.addCleanup(self.master.close)
+        self.addCleanup(self.tmpdir.cleanup)
+        return super().setUp()
+
+    kwargs = {
+        "uuidcode": "uuidcode",
+        "hostname": "hostname",
+        "servername": "servername",
+        "local_port": 56789,
+        "target_node": "targetnode",
+        "target_port": 34567,
+    }
+
+    def test_control_path(self):
+        self.assertEqual(mux.get_control_path("tunnel_hostname"), self.control_path)
+        self.assertEqual(
+            mux.get_control_path("tunnel_other"),
+            f"{self.tmpdir.name}/ljupyter@other.example.com:2223",
+        )
+        self.assertIsNone(mux.get_control_path("tunnel_unknown"))
+
+    def test_alive_check(self):
+        with mux.MuxClient(self.control_path) as client:
+            self.assertEqual(client.alive_check(), 1234)
+
+    def test_forward_failure_reason(self):
+        tunnel = dict(self.kwargs, target_port=0)
+        returncode, stdout, stderr = mux.run_mux_cmd(
+            self.control_path, "forward", [tunnel], 3
+        )
+        self.assertEqual(returncode, 255)
+        self.assertEqual(stderr, b"port forwarding failed")
+
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_popen_init,
+    )
+    def test_start_stop_tunnel_without_ssh_process(self, mocked_popen_init):
+        utils.start_tunnel(**self.kwargs)
+        forward = ("0.0.0.0", 56789, "targetnode", 34567)
+        self.assertEqual(self.master.forwards, {forward})
+        utils.stop_tunnel(**self.kwargs)
+        self.assertEqual(self.master.forwards, set())
+        self.assertEqual(mocked_popen_init.call_count, 0)
+
+    def test_cancel_closed_forwards(self):
+        tunnels = [dict(self.kwargs, local_port=56789 + i) for i in range(3)]
+        mux.run_mux_cmd(self.control_path, "forward", tunnels, 3)
+        # The second one is gone already, the third must still be closed
+        mux.run_mux_cmd(self.control_path, "cancel", tunnels[1:2], 3)
+        returncode, stdout, stderr = mux.run_mux_cmd(
+            self.control_path, "cancel", tunnels, 3
+        )
+        self.assertEqual(returncode, 0)
+        self.assertEqual(self.master.forwards, set())
+
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_popen_init,
+    )
+    def test_executor_limits(self, mocked_popen_init):
+        # Same slots, queue timeout and deadline as the ssh processes
+        executor = SSHCommandExecutor(max_procs=1)
+        self.addCleanup(executor.stop)
+        with mock.patch("tunnel.utils.get_executor", return_value=executor):
+            with mock.patch.object(executor, "run", wraps=executor.run) as run:
+                utils.start_tunnel(**self.kwargs)
+        self.assertEqual(run.call_count, 2)
+        self.assertEqual(run.call_args.args[0].func, mux.run_mux_cmd)
+        self.assertEqual(mocked_popen_init.call_count, 0)
+
+    @mock.patch.dict(os.environ, {"SSH_MUX_CLIENT": "false"})
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_popen_init,
+    )
+    def test_disabled(self, mocked_popen_init):
+        utils.start_tunnel(**self.kwargs)
+        self.assertEqual(mocked_popen_init.call_count, 2)
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(condition, timeout=10):
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            raise TimeoutError("Condition not met in time")
+        time.sleep(0.05)
+
+
+def can_connect(port):
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=1):
+            return True
+    except OSError:
+        return False
+
+
+SSHD = shutil.which("sshd") or shutil.which("sshd", path="/usr/sbin")
+
+
+@unittest.skipUnless(SSHD and shutil.which("ssh"), "OpenSSH server not installed")
+class RealControlMasterTests(APITestCase):
+    """
+    Runs against a `ssh -M` ControlMaster, connected to a sshd on localhost.
+    Keeps the FakeControlMaster honest, e.g. the "port not found" reply.
+    """
+
+    def run_cmd(self, *cmd):
+        subprocess.run(cmd, check=True, capture_output=True, timeout=10)
+
+    def start_process(self, *cmd):
+        p = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        self.addCleanup(p.wait, timeout=5)
+        self.addCleanup(p.terminate)
+        return p
+
+    def setUp(self):
+        utils.invalidate_connection_health()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+        for name in ["host_key", "client_key"]:
+            self.run_cmd(
+                "ssh-keygen",
+                "-q",
+                "-t",
+                "ed25519",
+                "-N",
+                "",
+                "-f",
+                f"{self.tmpdir}/{name}",
+            )
+        shutil.copy(f"{self.tmpdir}/client_key.pub", f"{self.tmpdir}/authorized_keys")
+        sshd_port = get_free_port()
+        with open(f"{self.tmpdir}/sshd_config", "w") as f:
+            f.write(
+                f"Port {sshd_port}\n"
+                "ListenAddress 127.0.0.1\n"
+                f"HostKey {self.tmpdir}/host_key\n"
+                f"AuthorizedKeysFile {self.tmpdir}/authorized_keys\n"
+                f"PidFile {self.tmpdir}/sshd.pid\n"
+                "PermitRootLogin prohibit-password\n"
+                "StrictModes no\n"
+                "AllowTcpForwarding yes\n"
+            )
+        self.start_process(SSHD, "-D", "-e", "-f", f"{self.tmpdir}/sshd_config")
+        wait_for(lambda: can_connect(sshd_port))
+
+        self.config_path = f"{self.tmpdir}/config"
+        self.control_path = f"{self.tmpdir}/tunnel_hostname"
+        with open(self.config_path, "w") as f:
+            f.write(
+                "Host tunnel_hostname\n"
+                "    HostName 127.0.0.1\n"
+                f"    Port {sshd_port}\n"
+                f"    User {getpass.getuser()}\n"
+                f"    IdentityFile {self.tmpdir}/client_key\n"
+                "    BatchMode yes\n"
+                "    StrictHostKeyChecking no\n"
+                "    UserKnownHostsFile /dev/null\n"
+                "    ControlMaster auto\n"
+                f"    ControlPath {self.tmpdir}/%n\n"
+            )
+        patcher = mock.patch.dict(os.environ, {"SSHCONFIGFILE": self.config_path})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.master = self.start_process(
+            "ssh", "-F", self.config_path, "-M", "-N", "tunnel_hostname"
+        )
+        wait_for(lambda: os.path.exists(self.control_path))
+
+        # Target of the forwards: answers each connection with "pong"
+        self.target = socket.socket()
+        self.addCleanup(self.target.close)
+        self.target.bind(("127.0.0.1", 0))
+        self.target.listen()
+        threading.Thread(target=self.serve_target, daemon=True).start()
+        self.tunnel = {
+            "uuidcode": "uuidcode",
+            "hostname": "hostname",
+            "servername": "servername",
+            "local_port": get_free_port(),
+            "target_node": "127.0.0.1",
+            "target_port": self.target.getsockname()[1],
+        }
+        return super().setUp()
+
+    def serve_target(self):
+        while True:
+            try:
+                conn, _ = self.target.accept()
+            except OSError:
+                return
+            with conn:
+                conn.sendall(b"pong")
+
+    def assertForwarded(self, port):
+        with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+            self.assertEqual(sock.recv(4), b"pong")
+
+    def test_check(self):
+        self.assertEqual(mux.get_control_path("tunnel_hostname"), self.control_path)
+        returncode, stdout, stderr = mux.run_mux_cmd(self.control_path, "check", [], 3)
+        self.assertEqual(returncode, 0)
+        self.assertEqual(stdout, f"Master running (pid={self.master.pid})".encode())
+
+    def test_forward_cancel(self):
+        port = self.tunnel["local_port"]
+        returncode, _, stderr = mux.run_mux_cmd(
+            self.control_path, "forward", [self.tunnel], 3
+        )
+        self.assertEqual((returncode, stderr), (0, b""))
+        self.assertForwarded(port)
+        returncode, _, stderr = mux.run_mux_cmd(
+            self.control_path, "cancel", [self.tunnel], 3
+        )
+        self.assertEqual((returncode, stderr), (0, b""))
+        wait_for(lambda: not can_connect(port))
+        # Closed already, the master answers "port not found"
+        returncode, _, stderr = mux.run_mux_cmd(
+            self.control_path, "cancel", [self.tunnel], 3
+        )
+        self.assertEqual((returncode, stderr), (0, b""))
+
+    def test_same_result_as_ssh_cli(self):
+        forward = f"0.0.0.0:{self.tunnel['local_port']}:127.0.0.1:{self.tunnel['target_port']}"
+        mux.run_mux_cmd(self.control_path, "forward", [self.tunnel], 3)
+        # The ssh CLI sees and cancels the forward opened by the mux client
+        self.run_cmd(
+            "ssh",
+            "-F",
+            self.config_path,
+            "-O",
+            "cancel",
+            "-L",
+            forward,
+            "tunnel_hostname",
+        )
+        wait_for(lambda: not can_connect(self.tunnel["local_port"]))
+
+    @mock.patch("tunnel.executor.subprocess.Popen")
+    def test_start_stop_tunnel(self, mocked_popen_init):
+        utils.start_tunnel(**self.tunnel)
+        self.assertForwarded(self.tunnel["local_port"])
+        utils.stop_tunnel(**self.tunnel)
+        wait_for(lambda: not can_connect(self.tunnel["local_port"]))
+        mocked_popen_init.assert_not_called()
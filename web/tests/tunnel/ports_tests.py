@@ -0,0 +1,101 @@
+import os
+import socket
+from collections import deque
+from unittest import mock
+
+from rest_framework.test import APITestCase
+from tunnel.models import PortReservationModel
+from tunnel.models import TunnelModel
+from tunnel.ports import PortAllocationError
+from tunnel.ports import PortAllocator
+
+
+class PortAllocatorTests(APITestCase):
+    tunnel = {
+        "servername": "servername",
+        "hostname": "hostname",
+        "svc_name": "svc",
+        "svc_port": 8080,
+        "target_node": "targetnode",
+        "target_port": 34567,
+        "tunnel_pod": "drf-tunnel-0",
+        "jhub_credential": "jupyterhub",
+    }
+
+    @mock.patch.dict(os.environ, {"TUNNEL_PORT_RANGE": "30100-30104"})
+    def test_allocate_unique_ports(self):
+        allocator = PortAllocator(pod="drf-tunnel-0")
+        ports = [allocator.allocate(f"server{i}") for i in range(5)]
+        self.assertEqual(sorted(ports), list(range(30100, 30105)))
+        self.assertEqual(PortReservationModel.objects.count(), 5)
+        with self.assertRaises(PortAllocationError):
+            allocator.allocate("server5")
+
+    @mock.patch.dict(os.environ, {"TUNNEL_PORT_RANGE": "30110-30111"})
+    def test_release(self):
+        allocator = PortAllocator(pod="drf-tunnel-0")
+        port_1 = allocator.allocate("server1")
+        allocator.allocate("server2")
+        allocator.release(port_1)
+        self.assertEqual(allocator.allocate("server3"), port_1)
+
+    @mock.patch.dict(os.environ, {"TUNNEL_PORT_RANGE": "30140-30149"})
+    def test_preferred(self):
+        allocator = PortAllocator(pod="drf-tunnel-0")
+        allocator.rebuild()
+        self.assertEqual(allocator.allocate("server1", preferred=30145), 30145)
+        self.assertNotIn(30145, allocator._free)
+        # Reserved on another pod only
+        PortReservationModel.objects.create(pod="drf-tunnel-1", port=30146)
+        self.assertEqual(allocator.allocate("server2", preferred=30146), 30146)
+        # Taken, or outside of the range
+        for preferred in [30145, 40000]:
+            port = allocator.allocate("server3", preferred=preferred)
+            self.assertNotIn(port, [30145, 30146])
+            self.assertIn(port, range(30140, 30150))
+
+    @mock.patch.dict(os.environ, {"TUNNEL_PORT_RANGE": "30120-30122"})
+    def test_skip_reserved_and_bound_ports(self):
+        allocator = PortAllocator(pod="drf-tunnel-0")
+        allocator.rebuild()
+        # Reserved by another worker of this pod after our rebuild
+        PortReservationModel.objects.create(pod="drf-tunnel-0", port=30120)
+        with socket.socket() as s:
+            s.bind(("", 30121))
+            self.assertEqual(allocator.allocate("server"), 30122)
+
+    @mock.patch.dict(os.environ, {"TUNNEL_PORT_RANGE": "30130-30139"})
+    def test_rebuild_cleanup(self):
+        TunnelModel.objects.create(local_port=30130, **self.tunnel)
+        TunnelModel.objects.create(
+            local_port=30131,
+            **dict(self.tunnel, servername="other", tunnel_pod="drf-tunnel-1"),
+        )
+        PortReservationModel.objects.create(pod="drf-tunnel-0", port=30135)
+        allocator = PortAllocator(pod="drf-tunnel-0")
+        allocator.rebuild(cleanup=True)
+        self.assertEqual(
+            list(
+                PortReservationModel.objects.filter(pod="drf-tunnel-0").values_list(
+                    "port", "servername"
+                )
+            ),
+            [(30130, "servername")],
+        )
+        self.assertNotIn(30130, allocator._free)
+        self.assertIn(30135, allocator._free)
+        self.assertEqual(len(allocator._free), 9)
+
+    @mock.patch.dict(os.environ, {"TUNNEL_PORT_RANGE": "30200-30219"})
+    def test_two_workers_same_free_list(self):
+        # Two gunicorn workers with the same free list must never hand out
+        # a port twice
+        workers = [PortAllocator(pod="drf-tunnel-0") for _ in range(2)]
+        for worker in workers:
+            worker.rebuild()
+            worker._free = deque(sorted(worker._free))
+        ports = []
+        for _ in range(10):
+            for worker in workers:
+                ports.append(worker.allocate("server"))
+        self.assertEqual(sorted(ports), list(range(30200, 30220)))
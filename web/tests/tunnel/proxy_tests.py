@@ -0,0 +1,175 @@
+import asyncio
+import os
+from unittest import mock
+
+from rest_framework.test import APITestCase
+from tunnel import utils
+from tunnel.proxy import read_head
+from tunnel.proxy import relay_body
+from tunnel.proxy import RouteTable
+from tunnel.proxy import RoutingProxy
+
+
+class Backend:
+    """
+    Minimal HTTP/1.1 server. Answers each request with its name, method,
+    path and body. Upgrade requests get a 101 and are echoed afterwards.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                head = await read_head(reader)
+                if head is None:
+                    break
+                lines = head.decode().split("\r\n")
+                method, path, _ = lines[0].split(" ")
+                headers = [tuple(x.split(": ", 1)) for x in lines[1:] if x]
+                if dict(headers).get("Upgrade", None) == "websocket":
+                    writer.write(
+                        b"HTTP/1.1 101 Switching Protocols\r\n"
+                        b"Upgrade: websocket\r\nConnection: Upgrade\r\n\r\n"
+                    )
+                    while True:
+                        data = await reader.read(1024)
+                        if not data:
+                            break
+                        writer.write(data)
+                        await writer.drain()
+                    break
+                body = BodyWriter()
+                await relay_body(reader, body, headers)
+                response = f"{self.name} {method} {path} {body.data.decode()}".encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s"
+                    % (len(response), response)
+                )
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+
+class BodyWriter:
+    def __init__(self):
+        self.data = b""
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+
+async def read_response(reader):
+    head = await read_head(reader)
+    headers = [x.split(": ", 1) for x in head.decode().split("\r\n")[1:] if x]
+    length = int(dict(headers)["Content-Length"])
+    return head.decode().split("\r\n")[0], (await reader.readexactly(length)).decode()
+
+
+class RoutingProxyTests(APITestCase):
+    def run_with_proxy(self, test, **proxy_kwargs):
+        async def main():
+            backends = [await Backend("one").start(), await Backend("two").start()]
+            routes = RouteTable(
+                loader=lambda: {"one": backends[0].port, "two": backends[1].port},
+                ttl=60,
+            )
+            proxy = RoutingProxy(routes=routes, **proxy_kwargs)
+            server = await proxy.start_server("127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            try:
+                return await test(reader, writer)
+            finally:
+                writer.close()
+                server.close()
+                for backend in backends:
+                    backend.server.close()
+
+        return asyncio.run(main())
+
+    def test_keep_alive_routes_each_request(self):
+        async def test(reader, writer):
+            writer.write(
+                b"GET /user/alice/one/api/status HTTP/1.1\r\nHost: proxy\r\n\r\n"
+            )
+            first = await read_response(reader)
+            writer.write(
+                b"POST /user/alice/two/api/kernels HTTP/1.1\r\nHost: proxy\r\n"
+                b"Transfer-Encoding: chunked\r\n\r\n4\r\nabcd\r\n0\r\n\r\n"
+            )
+            second = await read_response(reader)
+            return first, second
+
+        first, second = self.run_with_proxy(test)
+        self.assertEqual(
+            first, ("HTTP/1.1 200 OK", "one GET /user/alice/one/api/status ")
+        )
+        self.assertEqual(
+            second,
+            (
+                "HTTP/1.1 200 OK",
+                "two POST /user/alice/two/api/kernels 4\r\nabcd\r\n0\r\n\r\n",
+            ),
+        )
+
+    def test_unknown_servername(self):
+        async def test(reader, writer):
+            writer.write(b"GET /user/alice/three/ HTTP/1.1\r\nHost: proxy\r\n\r\n")
+            return await read_response(reader)
+
+        status, _ = self.run_with_proxy(test)
+        self.assertEqual(status, "HTTP/1.1 404 Not Found")
+
+    def test_path_regex(self):
+        def get(path, **proxy_kwargs):
+            async def test(reader, writer):
+                writer.write(b"GET %s HTTP/1.1\r\nHost: proxy\r\n\r\n" % path)
+                return await read_response(reader)
+
+            return self.run_with_proxy(test, **proxy_kwargs)
+
+        # By default the servername follows the JupyterHub user
+        self.assertEqual(get(b"/user/one/two/lab")[1], "two GET /user/one/two/lab ")
+        self.assertEqual(get(b"/two/lab")[0], "HTTP/1.1 404 Not Found")
+        self.assertEqual(
+            get(b"/two/lab", path_regex=r"^/([^/?#]+)")[1], "two GET /two/lab "
+        )
+
+    def test_route_by_host(self):
+        async def test(reader, writer):
+            writer.write(b"GET /lab HTTP/1.1\r\nHost: two.tunnel.svc:8081\r\n\r\n")
+            return await read_response(reader)
+
+        _, body = self.run_with_proxy(test, route_by="host")
+        self.assertEqual(body, "two GET /lab ")
+
+    def test_websocket_passthrough(self):
+        async def test(reader, writer):
+            writer.write(
+                b"GET /user/alice/one/api/kernels/1/channels HTTP/1.1\r\nHost: proxy\r\n"
+                b"Upgrade: websocket\r\nConnection: Upgrade\r\n\r\n"
+            )
+            head = await read_head(reader)
+            writer.write(b"\x81\x05hello")
+            await writer.drain()
+            return head, await reader.readexactly(7)
+
+        head, data = self.run_with_proxy(test)
+        self.assertTrue(head.startswith(b"HTTP/1.1 101"))
+        self.assertEqual(data, b"\x81\x05hello")
+
+    @mock.patch.dict(os.environ, {"TUNNEL_ROUTING_MODE": "proxy"})
+    def test_k8s_svc_skipped(self):
+        with mock.patch.dict(utils.k8s_func, {"create": mock.MagicMock()}):
+            utils.k8s_svc("create", svc_name="svc")
+            self.assertEqual(utils.k8s_func["create"].call_count, 0)
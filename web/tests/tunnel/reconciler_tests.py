@@ -0,0 +1,114 @@
+import os
+import tempfile
+import time
+from unittest import mock
+
+from jupyterjsc_tunneling import metrics
+from rest_framework.test import APITestCase
+from tunnel.models import TunnelModel
+from tunnel.reconciler import RateLimiter
+from tunnel.reconciler import ServiceReconciler
+
+from .apps_tests import service
+
+
+class ServiceReconcilerTests(APITestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        patcher = mock.patch.dict(
+            os.environ,
+            {
+                "SVC_RECONCILE_GRACE": "0",
+                "SVC_RECONCILE_RATE": "1000",
+                "SVC_RECONCILER_LOCK_FILE": os.path.join(self.tmpdir.name, "lock"),
+            },
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        metrics.reset()
+        for i in range(3):
+            TunnelModel.objects.create(
+                servername=f"servername-{i}",
+                hostname="hostname",
+                local_port=40000 + i,
+                svc_name=f"svc-{i}",
+                svc_port=8080,
+                target_node="targetnode",
+                target_port=34567,
+            )
+        return super().setUp()
+
+    def add_services(self, reconciler, services):
+        for svc in services:
+            reconciler.handle_event({"type": "ADDED", "object": svc})
+
+    @mock.patch("tunnel.services.k8s_get_client")
+    def test_repairs(self, mocked_client):
+        reconciler = ServiceReconciler(podname="drf-tunnel-0")
+        self.add_services(
+            reconciler,
+            [
+                service("svc-0", 8080, 40000, "drf-tunnel-0"),
+                service("svc-1", 8080, 40001, "drf-tunnel-0"),
+                service("svc-orphan", 8080, 40005, "drf-tunnel-0"),
+                service("svc-other-pod", 8080, 40006, "drf-tunnel-1"),
+            ],
+        )
+        reconciler.handle_event(
+            {"type": "DELETED", "object": service("svc-1", 8080, 40001, "drf-tunnel-0")}
+        )
+        operations = reconciler.reconcile()
+        self.assertEqual(
+            sorted(operations),
+            [("create", "svc-1"), ("create", "svc-2"), ("delete", "svc-orphan")],
+        )
+        self.assertEqual(
+            mocked_client.return_value.create_namespaced_service.call_count, 2
+        )
+        self.assertEqual(
+            metrics.snapshot()["counters"]["svc_reconcile_repairs{action=create}"], 2
+        )
+
+    @mock.patch("tunnel.services.k8s_get_client")
+    def test_grace_period(self, mocked_client):
+        reconciler = ServiceReconciler(podname="drf-tunnel-0")
+        reconciler.grace = 0.05
+        self.add_services(
+            reconciler,
+            [service(f"svc-{i}", 8080, 40000 + i, "drf-tunnel-0") for i in range(2)],
+        )
+        self.assertEqual(reconciler.reconcile(), [])
+        time.sleep(0.06)
+        self.assertEqual(reconciler.reconcile(), [("create", "svc-2")])
+        # A tunnel created meanwhile gets its own grace period. Its service
+        # shows up before the grace period is over, nothing to repair.
+        TunnelModel.objects.create(
+            servername="servername-3",
+            hostname="hostname",
+            local_port=40003,
+            svc_name="svc-3",
+            svc_port=8080,
+            target_node="targetnode",
+            target_port=34567,
+        )
+        self.assertEqual(reconciler.reconcile(), [("create", "svc-2")])
+        self.add_services(reconciler, [service("svc-3", 8080, 40003, "drf-tunnel-0")])
+        time.sleep(0.06)
+        self.assertEqual(reconciler.reconcile(), [("create", "svc-2")])
+
+    def test_single_leader(self):
+        first = ServiceReconciler(podname="drf-tunnel-0")
+        second = ServiceReconciler(podname="drf-tunnel-0")
+        self.assertTrue(first.acquire_leadership())
+        self.assertFalse(second.acquire_leadership())
+        os.close(first._lock_fd)
+        self.assertTrue(second.acquire_leadership())
+        os.close(second._lock_fd)
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(rate=100, burst=1)
+        start = time.monotonic()
+        for _ in range(5):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.035)
@@ -0,0 +1,74 @@
+from types import SimpleNamespace
+from unittest import mock
+
+from kubernetes.client.exceptions import ApiException
+from rest_framework.test import APITestCase
+from tunnel import services
+
+from .apps_tests import service
+
+
+class ServicesTests(APITestCase):
+    tunnel = {
+        "servername": "servername",
+        "svc_name": "svc",
+        "svc_port": 8080,
+        "local_port": 40000,
+    }
+
+    @mock.patch("tunnel.services.k8s_get_client")
+    def test_list_paginated(self, mocked_client):
+        mocked_client.return_value.list_namespaced_service.side_effect = [
+            SimpleNamespace(
+                items=[service("svc-1", 8080, 40001, "drf-tunnel-0")],
+                metadata=SimpleNamespace(_continue="token", resource_version="1"),
+            ),
+            SimpleNamespace(
+                items=[service("svc-2", 8080, 40002, "drf-tunnel-1")],
+                metadata=SimpleNamespace(_continue=None, resource_version="2"),
+            ),
+        ]
+        self.assertEqual(
+            services.list_managed_services(),
+            (
+                {
+                    "svc-1": (8080, 40001, "drf-tunnel-0"),
+                    "svc-2": (8080, 40002, "drf-tunnel-1"),
+                },
+                "2",
+            ),
+        )
+        calls = mocked_client.return_value.list_namespaced_service.call_args_list
+        self.assertNotIn("_continue", calls[0][1])
+        self.assertEqual(calls[1][1]["_continue"], "token")
+
+    def test_diff(self):
+        desired = {
+            "svc-new": self.tunnel,
+            "svc-same": dict(self.tunnel, local_port=40001),
+            "svc-moved": dict(self.tunnel, local_port=40002),
+        }
+        existing = {
+            "svc-same": (8080, 40001, "drf-tunnel-0"),
+            "svc-moved": (8080, 40002, "drf-tunnel-1"),
+            "svc-failed": (8080, 40003, "drf-tunnel-1"),
+            "svc-orphan": (8080, 40004, "drf-tunnel-0"),
+            "svc-other-pod": (8080, 40005, "drf-tunnel-1"),
+        }
+        creates, patches, deletes = services.diff_services(
+            desired, {"svc-failed"}, existing, "drf-tunnel-0"
+        )
+        self.assertEqual(creates, ["svc-new"])
+        self.assertEqual(patches, ["svc-moved"])
+        self.assertEqual(sorted(deletes), ["svc-failed", "svc-orphan"])
+
+    @mock.patch("tunnel.services.k8s_get_client")
+    def test_create_adopts_unlabeled_service(self, mocked_client):
+        mocked_client.return_value.create_namespaced_service.side_effect = ApiException(
+            status=409
+        )
+        services._create("svc", self.tunnel)
+        args = mocked_client.return_value.patch_namespaced_service.call_args[0]
+        self.assertEqual(args[0], "svc")
+        self.assertIn("app.kubernetes.io/managed-by", args[2]["metadata"]["labels"])
+        self.assertEqual(args[2]["spec"]["ports"][0]["targetPort"], 40000)
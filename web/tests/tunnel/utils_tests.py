@@ -3,6 +3,12 @@ import socket
 import time
 from unittest import mock
 
+from jupyterjsc_tunneling import metrics
+from jupyterjsc_tunneling.retry import deadline_scope
+from jupyterjsc_tunneling.retry import DeadlineExceededError
+from jupyterjsc_tunneling.retry import remaining_time
+from jupyterjsc_tunneling.retry import RetryPolicy
+from jupyterjsc_tunneling.settings import LOGGER_NAME
 from rest_framework.test import APITestCase
 from tunnel import utils
 
@@ -13,6 +19,10 @@ from .mocks import mocked_popen_init_check_fail
 
 
 class TunnelUtilsTests(APITestCase):
+    def setUp(self):
+        utils.invalidate_connection_health()
+        return super().setUp()
+
     def test_is_port_in_use(self):
         port = utils.get_random_open_local_port()
         self.assertFalse(utils.is_port_in_use(port), "Port is in use")
@@ -21,8 +31,17 @@ class TunnelUtilsTests(APITestCase):
             s.listen(1)
             self.assertTrue(utils.is_port_in_use(port), "Port is not in use")
 
+    def test_get_listening_ports(self):
+        port = utils.get_random_open_local_port()
+        self.assertNotIn(port, utils.get_listening_ports())
+        with socket.socket() as s:
+            s.bind(("", port))
+            s.listen(1)
+            self.assertIn(port, utils.get_listening_ports())
+        self.assertIsNone(utils.get_listening_ports(paths=["/does/not/exist"]))
+
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_popen_init,
     )
     def test_start_tunnel_all_good(self, mocked_popen_init):
@@ -56,7 +75,7 @@ class TunnelUtilsTests(APITestCase):
         self.assertEqual(mocked_popen_init.call_args_list[1][0][0], expected_args_2)
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_popen_init_check_fail,
     )
     def test_start_tunnel_check_255(self, mocked_popen_init_check_fail):
@@ -103,7 +122,7 @@ class TunnelUtilsTests(APITestCase):
         )
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_popen_init_all_fail,
     )
     def test_start_tunnel_all_255(self, mocked_popen_init_all_fail):
@@ -123,7 +142,7 @@ class TunnelUtilsTests(APITestCase):
         self.assertEqual(mocked_popen_init_all_fail.call_count, 4)
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_popen_init,
     )
     def test_stop_tunnel_all_good(self, mocked_popen_init):
@@ -157,7 +176,7 @@ class TunnelUtilsTests(APITestCase):
         self.assertEqual(mocked_popen_init.call_args_list[1][0][0], expected_args_2)
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_popen_init_check_fail,
     )
     def test_stop_tunnel_check_fail(self, mocked_popen_init_check_fail):
@@ -204,7 +223,7 @@ class TunnelUtilsTests(APITestCase):
         )
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_popen_init_all_fail,
     )
     def test_stop_tunnel_all_255(self, mocked_popen_init_all_fail):
@@ -224,7 +243,7 @@ class TunnelUtilsTests(APITestCase):
         self.assertEqual(mocked_popen_init_all_fail.call_count, 4)
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_popen_init_cancel_fail,
     )
     def test_stop_tunnel_cancel_fail(self, mocked_popen_init_cancel_fail):
@@ -237,3 +256,193 @@ class TunnelUtilsTests(APITestCase):
         }
         utils.stop_tunnel(raise_exception=False, **kwargs)
         self.assertEqual(mocked_popen_init_cancel_fail.call_count, 2)
+
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_popen_init,
+    )
+    def test_check_connection_cached(self, mocked_popen_init):
+        kwargs = {
+            "uuidcode": "uuidcode",
+            "hostname": "hostname",
+            "local_port": 56789,
+            "target_node": "targetnode",
+            "target_port": 34567,
+        }
+        utils.start_tunnel(**kwargs)
+        utils.stop_tunnel(**kwargs)
+        checks = [x for x in mocked_popen_init.call_args_list if "check" in x[0][0]]
+        self.assertEqual(len(checks), 1)
+        self.assertEqual(mocked_popen_init.call_count, 3)
+
+    @mock.patch.dict(os.environ, {"SSH_CHECK_CACHE_TTL": "0"})
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_popen_init,
+    )
+    def test_check_connection_cache_expired(self, mocked_popen_init):
+        kwargs = {
+            "uuidcode": "uuidcode",
+            "hostname": "hostname",
+            "local_port": 56789,
+            "target_node": "targetnode",
+            "target_port": 34567,
+        }
+        utils.start_tunnel(**kwargs)
+        utils.stop_tunnel(**kwargs)
+        checks = [x for x in mocked_popen_init.call_args_list if "check" in x[0][0]]
+        self.assertEqual(len(checks), 2)
+
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_popen_init_cancel_fail,
+    )
+    def test_check_connection_cache_invalidated(self, mocked_popen_init):
+        kwargs = {
+            "uuidcode": "uuidcode",
+            "hostname": "hostname",
+            "local_port": 56789,
+            "target_node": "targetnode",
+            "target_port": 34567,
+        }
+        utils.stop_tunnel(raise_exception=False, **kwargs)
+        self.assertFalse(utils.is_connection_healthy("hostname"))
+        utils.start_tunnel(**kwargs)
+        checks = [x for x in mocked_popen_init.call_args_list if "check" in x[0][0]]
+        self.assertEqual(len(checks), 2)
+
+    def batch_kwargs(self, count):
+        tunnels = [
+            {
+                "servername": f"servername-{i}",
+                "hostname": "hostname",
+                "local_port": 56789 + i,
+                "target_node": "targetnode",
+                "target_port": 34567,
+            }
+            for i in range(count)
+        ]
+        return {"uuidcode": "uuidcode", "hostname": "hostname", "tunnels": tunnels}
+
+    @mock.patch.dict(os.environ, {"SSH_FORWARD_BATCH_SIZE": "4"})
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_popen_init,
+    )
+    def test_start_tunnels_batch(self, mocked_popen_init):
+        results = utils.start_tunnels(**self.batch_kwargs(10))
+        self.assertEqual(results, {f"servername-{i}": None for i in range(10)})
+        # check + 3 chunks (4, 4, 2 forwards)
+        self.assertEqual(mocked_popen_init.call_count, 4)
+        forward_cmd = mocked_popen_init.call_args_list[1][0][0]
+        self.assertEqual(forward_cmd[3:6], ["-O", "forward", "tunnel_hostname"])
+        self.assertEqual(forward_cmd.count("-L"), 4)
+        self.assertEqual(forward_cmd[7], "0.0.0.0:56789:targetnode:34567")
+
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_popen_init_cancel_fail,
+    )
+    def test_stop_tunnels_batch_fail(self, mocked_popen_init):
+        results = utils.stop_tunnels(raise_exception=False, **self.batch_kwargs(3))
+        self.assertEqual(len(results), 3)
+        for servername, error in results.items():
+            self.assertTrue(error.startswith("unexpected returncode"))
+        # check + batch cancel + check + 3 single cancels
+        self.assertEqual(mocked_popen_init.call_count, 6)
+
+    @mock.patch("tunnel.executor.subprocess.Popen")
+    def test_stop_tunnels_batch_partially_cancelled(self, mocked_popen_init):
+        # Like ssh -O cancel: stops at the first unknown forward
+        forwards = {f"0.0.0.0:{56789 + i}:targetnode:34567" for i in range(3)}
+        forwards.remove("0.0.0.0:56790:targetnode:34567")
+
+        def popen(cmd, *args, **kwargs):
+            p = mock.MagicMock()
+            p.returncode, stderr = 0, b""
+            if "cancel" in cmd:
+                for forward in [x for x in cmd if x.startswith("0.0.0.0:")]:
+                    if forward not in forwards:
+                        p.returncode, stderr = (
+                            255,
+                            b"forwarding request failed: port not found",
+                        )
+                        break
+                    forwards.remove(forward)
+            p.communicate.return_value = (b"", stderr)
+            return p
+
+        mocked_popen_init.side_effect = popen
+        with self.assertLogs(LOGGER_NAME, level="INFO") as logs:
+            results = utils.stop_tunnels(**self.batch_kwargs(3))
+        self.assertEqual(results, {f"servername-{i}": None for i in range(3)})
+        self.assertEqual(forwards, set())
+        # Names instead of the whole tunnel dicts
+        record = [r for r in logs.records if getattr(r, "tunnels", None) == 3][0]
+        self.assertEqual(record.servernames, [f"servername-{i}" for i in range(3)])
+
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_popen_init_all_fail,
+    )
+    def test_start_tunnels_batch_system_not_available(self, mocked_popen_init):
+        with self.assertRaises(utils.TunnelExceptionError):
+            utils.start_tunnels(**self.batch_kwargs(3))
+        results = utils.start_tunnels(raise_exception=False, **self.batch_kwargs(3))
+        for servername, error in results.items():
+            self.assertTrue(error.startswith("System not available"))
+
+
+class RetryPolicyTests(APITestCase):
+    def test_backoff(self):
+        policy = RetryPolicy(max_attempts=5, base_delay=1, max_delay=4, jitter=0)
+        self.assertEqual([policy.delay(i) for i in range(1, 5)], [1, 2, 4, 4])
+        policy = RetryPolicy(max_attempts=5, base_delay=1, max_delay=4, jitter=0.5)
+        for i in range(10):
+            self.assertTrue(2 <= policy.delay(2) <= 3)
+
+    def test_wait_respects_deadline(self):
+        policy = RetryPolicy(max_attempts=3, base_delay=1, jitter=0)
+        self.assertFalse(policy.wait(3))
+        with deadline_scope(0.5):
+            self.assertFalse(policy.wait(1))
+
+    def test_nested_deadline_only_shortens(self):
+        self.assertIsNone(remaining_time())
+        with deadline_scope(1):
+            with deadline_scope(100):
+                self.assertLessEqual(remaining_time(), 1)
+        self.assertIsNone(remaining_time())
+
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_popen_init,
+    )
+    def test_deadline_exceeded_fails_fast(self, mocked_popen_init):
+        kwargs = {
+            "uuidcode": "uuidcode",
+            "hostname": "hostname",
+        }
+        with deadline_scope(0):
+            with self.assertRaises(DeadlineExceededError):
+                utils.run_popen_cmd("tunnel", "check", "check", **kwargs)
+        self.assertEqual(mocked_popen_init.call_count, 0)
+
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_popen_init_all_fail,
+    )
+    def test_attempt_latency_recorded(self, mocked_popen_init):
+        metrics.reset()
+        kwargs = {
+            "uuidcode": "uuidcode",
+            "hostname": "hostname",
+        }
+        with self.assertRaises(Exception):
+            utils.run_popen_cmd(
+                "tunnel", "create", "create", max_attempts=3, **kwargs
+            )
+        latencies = metrics.snapshot()["latencies"]
+        self.assertEqual(
+            latencies["ssh_command{action=create,prefix=tunnel}"]["count"], 3
+        )
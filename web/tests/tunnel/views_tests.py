@@ -1,9 +1,12 @@
 import copy
 import os
+import socket
 from unittest import mock
 
 from django.urls import reverse
+from rest_framework.exceptions import ValidationError
 from tests.user_credentials import UserCredentials
+from tunnel.models import PortReservationModel
 from tunnel.models import TunnelModel
 
 from .mocks import mocked_popen_init
@@ -14,6 +17,7 @@ from .mocks import mocked_popen_init_forward_fail
 from .mocks import mocked_remote_popen_init
 from .mocks import mocked_remote_popen_init_218
 from .mocks import mocked_restart_popen_init
+from .mocks import SynchronousThread
 
 
 class TunnelViewTests(UserCredentials):
@@ -96,7 +100,7 @@ class TunnelViewTests(UserCredentials):
     header = {"uuidcode": "uuidcode123", "labels": '{"test-key": "test-value"}'}
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_popen_init,
     )
     def test_create_model_created(self, mocked_popen_init):
@@ -114,7 +118,7 @@ class TunnelViewTests(UserCredentials):
         self.assertEqual(len(models), 1)
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_popen_init,
     )
     def test_create_popen_called(self, mocked_popen_init):
@@ -134,7 +138,7 @@ class TunnelViewTests(UserCredentials):
         )
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_popen_init_all_fail,
     )
     def test_create_popen_called_all_fail(self, mocked_popen_init):
@@ -175,7 +179,7 @@ class TunnelViewTests(UserCredentials):
         )
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_popen_init_forward_fail,
     )
     def test_create_popen_called_forward_fail(self, mocked_popen_init):
@@ -203,7 +207,7 @@ class TunnelViewTests(UserCredentials):
         )
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_popen_init_check_fail,
     )
     def test_create_popen_called_check_fail(self, mocked_popen_init):
@@ -218,7 +222,7 @@ class TunnelViewTests(UserCredentials):
         )
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_popen_init,
     )
     def test_cancel_popen_all_good(self, mocked_popen_init):
@@ -233,17 +237,15 @@ class TunnelViewTests(UserCredentials):
             url + f"{id}/", headers=self.header, format="json"
         )
         self.assertEqual(response_del.status_code, 204)
+        # ssh connection was checked during create, no further check required
+        self.assertEqual(mocked_popen_init.call_count, 3)
         self.assertEqual(
-            mocked_popen_init.call_args_list[2][0][0],
-            self.expected_popen_args_tunnel_check,
-        )
-        self.assertEqual(
-            mocked_popen_init.call_args_list[3][0][0][:-1],
+            mocked_popen_init.call_args_list[2][0][0][:-1],
             self.expected_popen_args_tunnel_cancel,
         )
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_popen_init_cancel_fail,
     )
     def test_cancel_popen_cancel_fail(self, mocked_popen_init):
@@ -258,25 +260,23 @@ class TunnelViewTests(UserCredentials):
             url + f"{id}/", headers=self.header, format="json"
         )
         self.assertEqual(response_del.status_code, 204)
+        # ssh connection was checked during create, no further check required
+        self.assertEqual(mocked_popen_init.call_count, 3)
         self.assertEqual(
-            mocked_popen_init.call_args_list[2][0][0],
-            self.expected_popen_args_tunnel_check,
-        )
-        self.assertEqual(
-            mocked_popen_init.call_args_list[3][0][0][:-1],
+            mocked_popen_init.call_args_list[2][0][0][:-1],
             self.expected_popen_args_tunnel_cancel,
         )
 
     def test_cancel_popen_cancel_system_unreachable_fail(self):
         url = reverse("tunnel-list")
-        self.addMock("tunnel.utils.subprocess.Popen", mocked_popen_init)
+        self.addMock("tunnel.executor.subprocess.Popen", mocked_popen_init)
         response = self.client.post(
             url, headers=self.header, data=self.tunnel_data, format="json"
         )
         self.assertEqual(response.status_code, 201)
         id = response.headers.get("Location", None)
         self.assertIsNotNone(id)
-        self.addMock("tunnel.utils.subprocess.Popen", mocked_popen_init_all_fail)
+        self.addMock("tunnel.executor.subprocess.Popen", mocked_popen_init_all_fail)
         response_del = self.client.delete(
             url + f"{id}/", headers=self.header, format="json"
         )
@@ -286,19 +286,19 @@ class TunnelViewTests(UserCredentials):
         url = reverse("tunnel-list")
         header = copy.deepcopy(self.header)
         del header["uuidcode"]
-        self.addMock("tunnel.utils.subprocess.Popen", mocked_popen_init)
+        self.addMock("tunnel.executor.subprocess.Popen", mocked_popen_init)
         response = self.client.post(
             url, headers=header, data=self.tunnel_data, format="json"
         )
         self.assertEqual(response.status_code, 201)
         id = response.headers.get("Location", None)
         self.assertIsNotNone(id)
-        self.addMock("tunnel.utils.subprocess.Popen", mocked_popen_init_all_fail)
+        self.addMock("tunnel.executor.subprocess.Popen", mocked_popen_init_all_fail)
         response_del = self.client.delete(url + f"{id}/", headers=header, format="json")
         self.assertEqual(response_del.status_code, 204)
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_popen_init,
     )
     def test_retrieve_popen_all_good_not_running(self, mocked_popen_init):
@@ -316,7 +316,29 @@ class TunnelViewTests(UserCredentials):
         self.assertFalse(response_get.data["running"])
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_popen_init,
+    )
+    def test_list_running(self, mocked_popen_init):
+        url = reverse("tunnel-list")
+        response = self.client.post(
+            url, headers=self.header, data=self.tunnel_data, format="json"
+        )
+        self.assertEqual(response.status_code, 201)
+        with mock.patch("tunnel.serializers.is_port_in_use") as mocked_in_use:
+            response_get = self.client.get(url, headers=self.header, format="json")
+            self.assertFalse(response_get.data[0]["running"])
+            with socket.socket() as s:
+                s.bind(("", response.data["local_port"]))
+                s.listen(1)
+                response_get = self.client.get(
+                    url, headers=self.header, format="json"
+                )
+            self.assertTrue(response_get.data[0]["running"])
+        self.assertEqual(mocked_in_use.call_count, 0)
+
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_popen_init,
     )
     def test_retrieve_different_credential(self, mocked_popen_init):
@@ -334,7 +356,7 @@ class TunnelViewTests(UserCredentials):
         self.assertEqual(response_get.status_code, 404)
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_popen_init,
     )
     def test_list_different_credential(self, mocked_popen_init):
@@ -351,7 +373,7 @@ class TunnelViewTests(UserCredentials):
         self.assertEqual(len(response_get.data), 0)
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_popen_init,
     )
     def test_cancel_different_credential(self, mocked_popen_init):
@@ -369,7 +391,7 @@ class TunnelViewTests(UserCredentials):
         self.assertEqual(response_del.status_code, 404)
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_popen_init,
     )
     def test_create_servername_already_exists(self, mocked_popen_init):
@@ -393,26 +415,58 @@ class TunnelViewTests(UserCredentials):
             self.expected_popen_args_tunnel_forward,
         )
 
-        # Stop first tunnel
-        self.assertEqual(
-            mocked_popen_init.call_args_list[2][0][0],
-            self.expected_popen_args_tunnel_check,
-        )
+        # Stop first tunnel, ssh connection check is cached
         self.assertEqual(
-            mocked_popen_init.call_args_list[3][0][0][:-1],
+            mocked_popen_init.call_args_list[2][0][0][:-1],
             self.expected_popen_args_tunnel_cancel,
         )
 
         # Create second tunnel
         self.assertEqual(
-            mocked_popen_init.call_args_list[4][0][0],
-            self.expected_popen_args_tunnel_check,
-        )
-        self.assertEqual(
-            mocked_popen_init.call_args_list[5][0][0][:-1],
+            mocked_popen_init.call_args_list[3][0][0][:-1],
             self.expected_popen_args_tunnel_forward,
         )
+        self.assertEqual(mocked_popen_init.call_count, 4)
 
+    @mock.patch(
+        "tunnel.serializers.TunnelSerializer.run_validators",
+        side_effect=ValidationError("invalid"),
+    )
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_popen_init,
+    )
+    def test_create_invalid_no_port_reserved(self, mocked_popen_init, mocked_validators):
+        url = reverse("tunnel-list")
+        response = self.client.post(
+            url, headers=self.header, data=self.tunnel_data, format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(PortReservationModel.objects.count(), 0)
+        self.assertEqual(mocked_popen_init.call_count, 0)
+
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_popen_init,
+    )
+    def test_update_invalid_port_released(self, mocked_popen_init):
+        response = self.client.post(
+            reverse("tunnel-list"), data=self.tunnel_data, format="json"
+        )
+        self.assertEqual(response.status_code, 201)
+        popen_calls = mocked_popen_init.call_count
+        data = {
+            "servername": self.tunnel_data["servername"],
+            "hostname": self.tunnel_data["hostname"],
+            "local_port": response.data["local_port"] + 1,
+            "start_tunnel": "True",
+        }
+        url = reverse("tunnel-detail", args=[self.tunnel_data["servername"]])
+        response = self.client.put(url, data=data)
+        self.assertEqual(response.status_code, 400)
+        # Only the reservation of the existing tunnel, nothing was started
+        self.assertEqual(PortReservationModel.objects.count(), 1)
+        self.assertEqual(mocked_popen_init.call_count, popen_calls)
 
 class RemoteViewTests(UserCredentials):
     def setUp(self):
@@ -421,7 +475,7 @@ class RemoteViewTests(UserCredentials):
     remote_data = {"hostname": "demo_site"}
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_remote_popen_init,
     )
     def test_create_data_received(self, mocked_popen_init):
@@ -430,7 +484,7 @@ class RemoteViewTests(UserCredentials):
         self.assertTrue("running" in resp.data.keys())
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_remote_popen_init,
     )
     def test_retrieve_not_existing_running(self, mocked_popen_init):
@@ -440,7 +494,7 @@ class RemoteViewTests(UserCredentials):
         self.assertTrue(resp.data["running"])
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_remote_popen_init_218,
     )
     def test_retrieve_not_existing_not_running(self, mocked_popen_init):
@@ -450,7 +504,7 @@ class RemoteViewTests(UserCredentials):
         self.assertFalse(resp.data["running"])
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_remote_popen_init_218,
     )
     def test_stop_not_existing(self, mocked_popen_init):
@@ -461,7 +515,7 @@ class RemoteViewTests(UserCredentials):
     url = "/api/restart/"
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_restart_popen_init,
     )
     def test_restart_view(self, mocked_popen_init):
@@ -471,7 +525,7 @@ class RemoteViewTests(UserCredentials):
         self.assertEqual(mocked_popen_init.call_count, 2)
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_restart_popen_init,
     )
     def test_restart_view_missing_hostname(self, mocked_popen_init):
@@ -481,7 +535,7 @@ class RemoteViewTests(UserCredentials):
         self.assertEqual(mocked_popen_init.call_count, 0)
 
     @mock.patch(
-        "tunnel.utils.subprocess.Popen",
+        "tunnel.executor.subprocess.Popen",
         side_effect=mocked_restart_popen_init,
     )
     def test_restart_view_existing_tunnels(self, mocked_popen_init):
@@ -501,8 +555,34 @@ class RemoteViewTests(UserCredentials):
         self.assertEqual(len(models), 1)
         response = self.client.post(self.url, data=data, format="json")
         self.assertEqual(response.status_code, 200)
-        # 8 Calls expected
+        # 6 Calls expected
         # check/forward to create tunnel before (1-2)
-        # check/cancel + check/forward for previously created tunnel (3-6)
-        # remote_stop / remote_start (7-8)
-        self.assertEqual(mocked_popen_init.call_count, 8)
+        # cancel + forward for previously created tunnel (3-4),
+        # the ssh connection check is cached
+        # remote_stop / remote_start (5-6)
+        self.assertEqual(mocked_popen_init.call_count, 6)
+        self.assertEqual(response.data["hostname"], data["hostname"])
+        self.assertEqual(
+            response.data["tunnels"], {"uuidcode": {"stop": None, "start": None}}
+        )
+        self.assertEqual(response.data["failed"], [])
+        self.assertEqual(response.data["remote"], {"stop": None, "start": None})
+
+    @mock.patch("tunnel.jobs.connection")
+    @mock.patch("tunnel.jobs.threading.Thread", SynchronousThread)
+    @mock.patch(
+        "tunnel.executor.subprocess.Popen",
+        side_effect=mocked_restart_popen_init,
+    )
+    def test_restart_view_async(self, mocked_popen_init, mocked_connection):
+        data = {"hostname": "demo_hostname", "async": "true"}
+        response = self.client.post(self.url, data=data, format="json")
+        self.assertEqual(response.status_code, 202)
+        job_id = response.data["job_id"]
+        self.assertEqual(response.headers["Location"], f"{self.url}{job_id}/")
+        response = self.client.get(f"{self.url}{job_id}/", format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["status"], "finished")
+        self.assertEqual(response.data["result"]["hostname"], data["hostname"])
+        response = self.client.get(f"{self.url}unknown/", format="json")
+        self.assertEqual(response.status_code, 404)
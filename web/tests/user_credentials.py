@@ -4,6 +4,7 @@ from django.contrib.auth.models import Group
 from django.contrib.auth.models import User
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APITestCase
+from tunnel.utils import invalidate_connection_health
 
 
 def mocked_k8s_svc(*args, **kwargs):
@@ -24,6 +25,7 @@ class K8sMockedTestCase(APITestCase):
         self.addCleanup(self.mock_patches[name].stop)
 
     def setUp(self):
+        invalidate_connection_health()
         self.addMock("tunnel.utils.k8s_svc", mocked_k8s_svc)
         return super().setUp()
 
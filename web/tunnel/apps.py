@@ -1,16 +1,21 @@
 import copy
 import logging
 import os
+import threading
+import time
 
 from django.apps import AppConfig
 from jupyterjsc_tunneling.settings import LOGGER_NAME
-from tunnel.utils import k8s_svc
+from tunnel.pool import run_grouped
+from tunnel.proxy import get_routing_mode
+from tunnel.services import reconcile_services
 from tunnel.utils import start_remote
 from tunnel.utils import start_remote_from_config_file
 from tunnel.utils import start_tunnel
+from tunnel.utils import start_tunnels
 from tunnel.utils import stop_and_delete
 from tunnel.utils import stop_tunnel
-from forwarder.utils.k8s import get_tunnel_sts_pod_names
+from forwarder.utils.k8s import list_tunnel_sts_pods
 
 
 log = logging.getLogger(LOGGER_NAME)
@@ -21,33 +26,101 @@ class TunnelConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "tunnel"
 
+    def start_tunnel_batch_from_db(self, tunnels):
+        kwargs = {
+            "hostname": tunnels[0]["hostname"],
+            "uuidcode": tunnels[0]["uuidcode"],
+        }
+        try:
+            results = start_tunnels(
+                tunnels=tunnels, alert_admins=True, raise_exception=False, **kwargs
+            )
+        except:
+            log.exception("Could not start ssh tunnels at StartUp", extra=kwargs)
+            results = {tunnel["servername"]: "Unexpected error" for tunnel in tunnels}
+        for tunnel in tunnels:
+            if results.get(tunnel["servername"], None):
+                log.error("Could not start ssh tunnel at StartUp", extra=tunnel)
+        return results
+
     def start_tunnels_in_db(self):
         from .models import TunnelModel
 
         podname = os.environ.get("HOSTNAME", "drf-tunnel-0")
         uuidcode = "StartUp Tunnel"
-        log.info("Start all tunnels saved in database", extra={"uuidcode": uuidcode, "pod": podname})
-        tunnels = TunnelModel.objects.filter(tunnel_pod=podname).all()
-        for tunnel in tunnels:
-            try:
+        max_workers = int(os.environ.get("STARTUP_TUNNELS_MAX_WORKERS", "32"))
+        max_per_host = int(os.environ.get("STARTUP_TUNNELS_MAX_PER_HOST", "8"))
+        chunk_size = int(os.environ.get("STARTUP_TUNNELS_CHUNK_SIZE", "500"))
+        batch_size = int(os.environ.get("SSH_FORWARD_BATCH_SIZE", "100"))
+        log_extra = {"uuidcode": uuidcode, "pod": podname}
+        log.info("Start all tunnels saved in database", extra=log_extra)
+
+        queryset = TunnelModel.objects.filter(tunnel_pod=podname)
+        total = queryset.count()
+        progress_interval = max(total // 10, 1)
+        counts = {"done": 0, "failed": 0}
+        counts_lock = threading.Lock()
+        # svc_name -> tunnel, used to reconcile the k8s services afterwards
+        started_svcs = {}
+        failed_svcs = set()
+
+        def tunnel_batches():
+            # Stream rows instead of loading all tunnels into memory.
+            # Tunnels to the same host are started with one ssh command.
+            batches = {}
+            for tunnel in queryset.iterator(chunk_size=chunk_size):
                 kwargs = {}
                 for key, value in tunnel.__dict__.items():
                     if key not in ["date", "_state"]:
                         kwargs[key] = copy.deepcopy(value)
                 kwargs["uuidcode"] = uuidcode
-                start_tunnel(**kwargs)
+                batch = batches.setdefault(kwargs["hostname"], [])
+                batch.append(kwargs)
+                if len(batch) >= batch_size:
+                    yield batches.pop(kwargs["hostname"])
+            yield from batches.values()
+
+        def progress(tunnels, results, exception):
+            with counts_lock:
+                previous = counts["done"]
+                counts["done"] += len(tunnels)
+                for tunnel in tunnels:
+                    if exception is not None or results.get(tunnel["servername"]):
+                        counts["failed"] += 1
+                        failed_svcs.add(tunnel["svc_name"])
+                    else:
+                        started_svcs[tunnel["svc_name"]] = tunnel
+                done = counts["done"]
+            if done // progress_interval != previous // progress_interval:
+                log.info(
+                    f"Start all tunnels saved in database: {done}/{total}",
+                    extra=log_extra,
+                )
+
+        start = time.monotonic()
+        run_grouped(
+            tunnel_batches(),
+            key=lambda tunnels: tunnels[0]["hostname"],
+            func=self.start_tunnel_batch_from_db,
+            max_workers=max_workers,
+            max_per_key=max_per_host,
+            callback=progress,
+        )
+        if get_routing_mode() != "proxy":
+            try:
+                reconcile_services(
+                    started_svcs, failed_svcs, podname, uuidcode=uuidcode
+                )
             except:
-                log.exception("Could not start ssh tunnel at StartUp", extra=kwargs)
-                log.debug("Delete k8s svc, if it exists", extra=kwargs)
-                try:
-                    k8s_svc("delete", alert_admins=True, **kwargs)
-                except:
-                    log.debug(
-                        "Could not delete k8s service", extra=kwargs, exc_info=True
-                    )
-                continue
-            log.debug("Create k8s svc")
-            k8s_svc("create", alert_admins=True, raise_exception=False, **kwargs)
+                log.exception("Could not reconcile k8s services", extra=log_extra)
+        log_extra.update(
+            {
+                "tunnels": counts["done"],
+                "failed": counts["failed"],
+                "duration": round(time.monotonic() - start, 3),
+            }
+        )
+        log.info("Start all tunnels saved in database done", extra=log_extra)
 
     def create_user(self, username, passwd, groups=[], superuser=False, mail=""):
         from django.contrib.auth.models import Group
@@ -125,6 +198,23 @@ class TunnelConfig(AppConfig):
         if os.environ.get("GUNICORN_START", "false").lower() == "true":
             self.setup_logger()
             self.setup_db()
+            try:
+                from .ports import get_port_allocator
+
+                get_port_allocator().rebuild(cleanup=True)
+            except:
+                log.exception(
+                    "Could not synchronize port reservations",
+                    extra={"uuidcode": "StartUp"},
+                )
+            try:
+                from .jobs import fail_jobs_of_pod
+
+                fail_jobs_of_pod(os.environ.get("HOSTNAME", "drf-tunnel-0"))
+            except:
+                log.exception(
+                    "Could not fail orphaned jobs", extra={"uuidcode": "StartUp"}
+                )
             try:
                 self.start_tunnels_in_db()
             except:
@@ -132,7 +222,8 @@ class TunnelConfig(AppConfig):
             try:
                 podname = os.environ.get("HOSTNAME", "drf-tunnel-0")
                 log.info("Get tunnel sts pod name", extra={"uuidcode": "StartUp"})
-                tunnel_pods = get_tunnel_sts_pod_names()
+                # Don't start the pod informer in gunicorn's master process
+                tunnel_pods = [name for name, _ in list_tunnel_sts_pods()]
                 log.info(f"Get tunnel sts pod name: {tunnel_pods}", extra={"uuidcode": "StartUp"})
                 # Only start remote tunnels on first pod of stateful set
                 if podname == tunnel_pods[0]:
@@ -0,0 +1,214 @@
+import asyncio
+import functools
+import logging
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+
+from jupyterjsc_tunneling.settings import LOGGER_NAME
+
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+"""
+All ssh commands of a worker process are sent through one asyncio event
+loop, running in its own thread. Callers put their command into a bounded
+queue and receive a concurrent.futures.Future, which can be waited on
+(`run`) or awaited in a coroutine (`asyncio.wrap_future`).
+
+Only `max_procs` ssh processes are alive at the same time. The blocking
+`communicate()` of each process runs in a small helper pool, so the event
+loop itself is never blocked and Popen keeps its usual semantics
+(preexec_fn, pipes, timeouts).
+
+A command that did not get a slot within SSH_EXECUTOR_QUEUE_TIMEOUT
+seconds (default 5) is not started anymore, its future fails with
+ExecutorQueueTimeoutError. So `run` never returns a failure for a
+command which is executed afterwards. With a budget (e.g. the remaining
+time of the request), waiting in the queue and running the command
+together take at most budget seconds.
+
+cmd may also be a callable, it's called with timeout=timeout in a slot
+and returns (returncode, stdout, stderr) itself. The mux client uses
+this, so it shares the limits with the ssh processes.
+
+gunicorn's preload_app forks the worker processes after the django apps
+are ready. Threads do not survive a fork, so every process gets its own
+executor (see `get_executor`).
+"""
+
+
+class ExecutorQueueFullError(Exception):
+    pass
+
+
+class ExecutorQueueTimeoutError(Exception):
+    pass
+
+
+def get_queue_timeout():
+    return float(os.environ.get("SSH_EXECUTOR_QUEUE_TIMEOUT", "5"))
+
+
+# gunicorn preload app feature does not use gunicorn user/group but
+# the current uid instead. Which is root. We don't want to run commands as root.
+def set_uid():
+    try:
+        os.setuid(1000)
+    except:
+        pass
+
+
+class SSHCommandExecutor:
+    def __init__(self, max_procs=None, queue_size=None):
+        if not max_procs:
+            max_procs = int(os.environ.get("SSH_EXECUTOR_MAX_PROCS", "16"))
+        if not queue_size:
+            queue_size = int(os.environ.get("SSH_EXECUTOR_QUEUE_SIZE", "1024"))
+        self.max_procs = max_procs
+        self.queue_size = queue_size
+        self._pid = os.getpid()
+        self._loop = asyncio.new_event_loop()
+        self._queue = None
+        self._started = threading.Event()
+        self._wait_pool = ThreadPoolExecutor(
+            max_workers=max_procs, thread_name_prefix="ssh-wait"
+        )
+        self._thread = threading.Thread(
+            target=self._run_loop, name="ssh-executor", daemon=True
+        )
+        self._thread.start()
+        self._started.wait()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        for i in range(self.max_procs):
+            self._loop.create_task(self._worker())
+        self._loop.call_soon(self._started.set)
+        self._loop.run_forever()
+        self._loop.close()
+
+    def _spawn_and_wait(self, cmd, timeout):
+        p = subprocess.Popen(
+            cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE, preexec_fn=set_uid
+        )
+        try:
+            stdout, stderr = p.communicate(timeout=timeout)
+            returncode = p.returncode
+        except subprocess.TimeoutExpired:
+            p.kill()
+            returncode = 124
+            stdout, stderr = b"timeout", b""
+        return returncode, stdout, stderr
+
+    async def _worker(self):
+        while True:
+            cmd, timeout, future, start_by, expires_at = await self._queue.get()
+            try:
+                now = time.monotonic()
+                if expires_at is not None:
+                    timeout = min(timeout, expires_at - now)
+                if now > start_by:
+                    if future.set_running_or_notify_cancel():
+                        future.set_exception(
+                            ExecutorQueueTimeoutError(
+                                "No free slot for the ssh command in time"
+                            )
+                        )
+                elif future.set_running_or_notify_cancel():
+                    if callable(cmd):
+                        func = functools.partial(cmd, timeout=timeout)
+                    else:
+                        func = functools.partial(self._spawn_and_wait, cmd, timeout)
+                    result = await self._loop.run_in_executor(self._wait_pool, func)
+                    future.set_result(result)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    def _enqueue(self, job):
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            job[2].set_exception(
+                ExecutorQueueFullError(
+                    f"Too many pending ssh commands (queue_size={self.queue_size})"
+                )
+            )
+
+    def submit(self, cmd, timeout, queue_timeout=None, budget=None):
+        """
+        Queue cmd and return a concurrent.futures.Future, which resolves
+        to (returncode, stdout, stderr). A returncode of 124 means the
+        command ran into its timeout and was killed.
+        """
+        if queue_timeout is None:
+            queue_timeout = get_queue_timeout()
+        future = Future()
+        now = time.monotonic()
+        start_by = now + queue_timeout
+        expires_at = None
+        if budget is not None:
+            expires_at = now + budget
+            start_by = min(start_by, expires_at)
+        self._loop.call_soon_threadsafe(
+            self._enqueue, (cmd, timeout, future, start_by, expires_at)
+        )
+        return future
+
+    async def submit_async(self, cmd, timeout, queue_timeout=None, budget=None):
+        return await asyncio.wrap_future(
+            self.submit(cmd, timeout, queue_timeout, budget)
+        )
+
+    def run(self, cmd, timeout, queue_timeout=None, budget=None):
+        # communicate() enforces the timeout. The extra seconds only cover
+        # the time spent waiting for a free slot in the queue.
+        if queue_timeout is None:
+            queue_timeout = get_queue_timeout()
+        wait = timeout + queue_timeout
+        if budget is not None:
+            wait = min(wait, budget)
+        future = self.submit(cmd, timeout, queue_timeout, budget)
+        try:
+            return future.result(timeout=wait)
+        except FuturesTimeoutError:
+            # Don't start it anymore, the caller treats it as failed
+            future.cancel()
+            raise
+
+    def pending(self):
+        return self._queue.qsize()
+
+    async def _shutdown(self):
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._loop.stop()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop)
+        self._thread.join(timeout=5)
+        self._wait_pool.shutdown(wait=False)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None or _executor._pid != os.getpid():
+        with _executor_lock:
+            if _executor is None or _executor._pid != os.getpid():
+                _executor = SSHCommandExecutor()
+    return _executor
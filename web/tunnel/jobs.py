@@ -0,0 +1,190 @@
+import datetime
+import logging
+import os
+import threading
+import time
+import uuid
+
+from django.db import close_old_connections
+from django.db import connection
+from django.utils import timezone
+from jupyterjsc_tunneling.settings import LOGGER_NAME
+
+from .models import JobModel
+
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+"""
+Long running operations (e.g. restarting all tunnels of a host) can run
+in a background thread. The state is stored in the database, so any
+gunicorn worker (or pod) can answer a poll request for the job id.
+
+func receives the job as first argument and may store intermediate
+progress with update_job. Its return value becomes the final result.
+
+A job dies with its gunicorn worker. Each job stores its owner
+("<pod>:<pid>") and the owner refreshes updated_at of its running jobs
+every JOB_HEARTBEAT_INTERVAL seconds. A running job without heartbeat
+for JOB_HEARTBEAT_TIMEOUT seconds is marked as failed when it is polled
+(get_job) or when another job starts. At startup, a pod fails all its
+jobs which were still running.
+
+Finished and failed jobs are kept for JOB_RETENTION_HOURS (default 24)
+after their last update, so clients can still poll them. Older ones are
+deleted whenever a new job starts.
+"""
+
+
+def get_job_owner():
+    return f"{os.environ.get('HOSTNAME', 'drf-tunnel-0')}:{os.getpid()}"
+
+
+def update_job(job, **result):
+    job.result.update(result)
+    job.save(update_fields=["result", "updated_at"])
+
+
+class JobHeartbeat(threading.Thread):
+    """Runs as long as this worker has running jobs"""
+
+    def __init__(self):
+        super().__init__(name="job-heartbeat", daemon=True)
+        self.owner = get_job_owner()
+        self.interval = float(os.environ.get("JOB_HEARTBEAT_INTERVAL", "10"))
+
+    def run(self):
+        running = True
+        try:
+            while running:
+                time.sleep(self.interval)
+                close_old_connections()
+                try:
+                    running = JobModel.objects.filter(
+                        owner=self.owner, status="running"
+                    ).update(updated_at=timezone.now())
+                except:
+                    log.warning("Could not update job heartbeat", exc_info=True)
+        finally:
+            connection.close()
+
+
+_heartbeat = None
+_heartbeat_lock = threading.Lock()
+
+
+def start_job_heartbeat():
+    global _heartbeat
+    with _heartbeat_lock:
+        if (
+            _heartbeat is None
+            or not _heartbeat.is_alive()
+            or _heartbeat.owner != get_job_owner()
+        ):
+            _heartbeat = JobHeartbeat()
+            _heartbeat.start()
+        return _heartbeat
+
+
+def fail_jobs(queryset, reason):
+    failed = []
+    for job in queryset.filter(status="running"):
+        job.status = "failed"
+        job.result["error"] = reason
+        job.save(update_fields=["status", "result", "updated_at"])
+        log.error(
+            f"Job {job.kind} failed: {reason}",
+            extra={"job_id": job.job_id, "owner": job.owner, **job.result},
+        )
+        failed.append(job)
+    return failed
+
+
+def fail_orphaned_jobs(queryset=None):
+    """Running jobs without heartbeat, their worker is gone"""
+    if queryset is None:
+        queryset = JobModel.objects.all()
+    timeout = float(os.environ.get("JOB_HEARTBEAT_TIMEOUT", "60"))
+    min_updated_at = timezone.now() - datetime.timedelta(seconds=timeout)
+    return fail_jobs(
+        queryset.filter(updated_at__lt=min_updated_at),
+        f"Orphaned, no heartbeat for {timeout:g} seconds",
+    )
+
+
+def fail_jobs_of_pod(podname):
+    """At startup: all jobs of the previous workers of this pod are gone"""
+    return fail_jobs(
+        JobModel.objects.filter(owner__startswith=f"{podname}:"),
+        f"Orphaned, {podname} was restarted",
+    )
+
+
+def delete_old_jobs():
+    hours = float(os.environ.get("JOB_RETENTION_HOURS", "24"))
+    min_updated_at = timezone.now() - datetime.timedelta(hours=hours)
+    deleted, _ = (
+        JobModel.objects.exclude(status="running")
+        .filter(updated_at__lt=min_updated_at)
+        .delete()
+    )
+    if deleted:
+        log.debug(f"Deleted {deleted} jobs older than {hours:g} hours")
+    return deleted
+
+
+def get_job(job_id, kind):
+    job = JobModel.objects.filter(job_id=job_id, kind=kind).first()
+    if job is not None and job.status == "running":
+        if fail_orphaned_jobs(JobModel.objects.filter(job_id=job_id)):
+            job.refresh_from_db()
+    return job
+
+
+def _run_job(job, func, args, kwargs):
+    try:
+        result = func(job, *args, **kwargs)
+        job.status = "finished"
+        if result is not None:
+            job.result.update(result)
+    except Exception as e:
+        log.exception(f"Job {job.kind} failed", extra={"job_id": job.job_id})
+        job.status = "failed"
+        job.result["error"] = str(e)
+    finally:
+        try:
+            job.save()
+        finally:
+            connection.close()
+
+
+def start_job(kind, func, *args, **kwargs):
+    try:
+        fail_orphaned_jobs()
+        delete_old_jobs()
+    except:
+        log.warning("Could not clean up old jobs", exc_info=True)
+    job = JobModel.objects.create(
+        job_id=uuid.uuid4().hex, kind=kind, owner=get_job_owner()
+    )
+    start_job_heartbeat()
+    thread = threading.Thread(
+        target=_run_job,
+        args=(job, func, args, kwargs),
+        name=f"job-{kind}-{job.job_id}",
+        daemon=True,
+    )
+    thread.start()
+    return job
+
+
+def job_to_dict(job):
+    return {
+        "job_id": job.job_id,
+        "kind": job.kind,
+        "status": job.status,
+        "result": job.result,
+        "created_at": job.created_at,
+        "updated_at": job.updated_at,
+    }
@@ -0,0 +1,197 @@
+import logging
+import os
+import threading
+import time
+
+from django.db import close_old_connections
+from django.db import connection
+from jupyterjsc_tunneling import metrics
+from jupyterjsc_tunneling.settings import LOGGER_NAME
+
+from .locks import try_lock_file
+from .mux import get_control_path
+
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+"""
+Load report of this tunnel pod. The forwarder uses it to place new
+tunnels (see forwarder/utils/placement.py).
+
+One gunicorn worker per pod, the one holding an exclusive flock on
+TUNNEL_LOAD_LOCK_FILE, collects the report every
+TUNNEL_LOAD_REPORT_PERIOD seconds and stores it in PodLoadModel. The
+forwarder reads the reports of all pods with one query.
+
+A report only reads /proc, the cgroup and this pod's tunnels from the
+database:
+ - tunnels: tunnels of this pod
+ - ssh_masters: ssh ControlMasters of these tunnels with a control socket
+ - connections: established TCP connections to the tunnels' local ports
+ - open_fds: open file descriptors of all readable processes in the pod
+ - cpu: CPU cores used since the previous report (cgroup usage)
+"""
+
+TCP_ESTABLISHED_STATE = "01"
+
+
+def count_established_connections(ports, paths=["/proc/net/tcp", "/proc/net/tcp6"]):
+    count = 0
+    for path in paths:
+        try:
+            with open(path, "r") as f:
+                next(f, None)  # header
+                for line in f:
+                    fields = line.split()
+                    if (
+                        len(fields) > 3
+                        and fields[3] == TCP_ESTABLISHED_STATE
+                        and int(fields[1].rsplit(":", 1)[1], 16) in ports
+                    ):
+                        count += 1
+        except OSError:
+            continue
+    return count
+
+
+def count_open_fds(proc="/proc"):
+    count = 0
+    for pid in os.listdir(proc):
+        if not pid.isdigit():
+            continue
+        try:
+            count += len(os.listdir(os.path.join(proc, pid, "fd")))
+        except OSError:
+            # Exited meanwhile or owned by another user
+            continue
+    return count
+
+
+def count_ssh_masters(hostnames):
+    count = 0
+    for hostname in hostnames:
+        control_path = get_control_path(f"tunnel_{hostname}")
+        if control_path and os.path.exists(control_path):
+            count += 1
+    return count
+
+
+def get_cpu_usage(
+    paths=["/sys/fs/cgroup/cpu.stat", "/sys/fs/cgroup/cpuacct/cpuacct.usage"]
+):
+    """CPU time of the pod's cgroup in seconds (cgroup v2 or v1), or None"""
+    for path in paths:
+        try:
+            with open(path, "r") as f:
+                content = f.read()
+        except OSError:
+            continue
+        if path.endswith("cpu.stat"):
+            for line in content.splitlines():
+                key, _, value = line.partition(" ")
+                if key == "usage_usec":
+                    return int(value) / 1e6
+        else:
+            return int(content.strip()) / 1e9
+    return None
+
+
+class LoadReporter:
+    def __init__(self, podname=None):
+        if not podname:
+            podname = os.environ.get("HOSTNAME", "drf-tunnel-0")
+        self.podname = podname
+        self.period = float(os.environ.get("TUNNEL_LOAD_REPORT_PERIOD", "10"))
+        self.lock_file = os.environ.get(
+            "TUNNEL_LOAD_LOCK_FILE", "/tmp/tunnel-load-reporter.lock"
+        )
+        self.log_extra = {"uuidcode": "LoadReporter", "pod": podname}
+        self._stop = threading.Event()
+        self._last_cpu = None  # (usage, monotonic time)
+        self._lock_fd = None
+
+    def stop(self):
+        self._stop.set()
+
+    def get_cpu(self):
+        usage = get_cpu_usage()
+        if usage is None:
+            return None
+        now = time.monotonic()
+        last, self._last_cpu = self._last_cpu, (usage, now)
+        if last is None or now <= last[1]:
+            return None
+        return round((usage - last[0]) / (now - last[1]), 3)
+
+    def collect(self):
+        from .models import TunnelModel
+
+        tunnels = list(
+            TunnelModel.objects.filter(tunnel_pod=self.podname).values_list(
+                "hostname", "local_port"
+            )
+        )
+        report = {
+            "tunnels": len(tunnels),
+            "ssh_masters": count_ssh_masters({hostname for hostname, _ in tunnels}),
+            "connections": count_established_connections({port for _, port in tunnels}),
+            "open_fds": count_open_fds(),
+        }
+        cpu = self.get_cpu()
+        if cpu is not None:
+            report["cpu"] = cpu
+        return report
+
+    def publish(self):
+        from .models import PodLoadModel
+
+        start = time.monotonic()
+        close_old_connections()
+        report = self.collect()
+        PodLoadModel.objects.update_or_create(
+            pod=self.podname, defaults={"report": report}
+        )
+        metrics.observe("load_report", time.monotonic() - start)
+        return report
+
+    def run(self):
+        while not self._stop.is_set():
+            self._lock_fd = try_lock_file(self.lock_file)
+            if self._lock_fd is not None:
+                break
+            self._stop.wait(self.period)
+        else:
+            return
+        log.info("Load reporter started", extra=self.log_extra)
+        try:
+            while not self._stop.is_set():
+                try:
+                    self.publish()
+                except:
+                    metrics.increment("load_report_errors")
+                    log.warning(
+                        "Could not publish load report",
+                        extra=self.log_extra,
+                        exc_info=True,
+                    )
+                self._stop.wait(self.period)
+        finally:
+            connection.close()
+            os.close(self._lock_fd)
+
+
+_reporter = None
+
+
+def start_load_reporter():
+    """Called in each gunicorn worker (post_worker_init)."""
+    global _reporter
+    if os.environ.get("TUNNEL_LOAD_REPORT_ENABLED", "true").lower() != "true":
+        return None
+    if _reporter is None:
+        _reporter = LoadReporter()
+        threading.Thread(
+            target=_reporter.run, name="load-reporter", daemon=True
+        ).start()
+    return _reporter
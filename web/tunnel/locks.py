@@ -0,0 +1,20 @@
+import fcntl
+import os
+
+"""
+Leader election between the gunicorn workers of a pod. Background loops
+(service reconciler, load reporter, replicas watcher) run in the one
+worker holding an exclusive flock on their lock file. The lock is
+released by the kernel when the worker exits, another one takes over.
+"""
+
+
+def try_lock_file(path):
+    """Exclusive flock on path without blocking. Returns the fd or None."""
+    fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from tunnel.proxy import run_proxy
+
+
+class Command(BaseCommand):
+    help = "Run the routing proxy for TUNNEL_ROUTING_MODE=proxy"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="0.0.0.0")
+        parser.add_argument("--port", type=int, default=None)
+
+    def handle(self, *args, **options):
+        run_proxy(host=options["host"], port=options["port"])
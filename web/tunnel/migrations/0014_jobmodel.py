@@ -0,0 +1,24 @@
+# Generated by Django 3.2.16 on 2026-10-18 14:13
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tunnel", "0013_tunnelmodel_jhub_credential"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="JobModel",
+            fields=[
+                ("job_id", models.TextField(primary_key=True, serialize=False)),
+                ("kind", models.TextField()),
+                ("status", models.TextField(default="running")),
+                ("result", models.JSONField(default=dict, verbose_name="result")),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.2.16 on 2026-10-18 14:18
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tunnel", "0014_jobmodel"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PortReservationModel",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("pod", models.TextField()),
+                ("port", models.IntegerField()),
+                ("servername", models.TextField(null=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "unique_together": {("pod", "port")},
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.16 on 2026-10-18 15:02
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tunnel", "0015_portreservationmodel"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PodLoadModel",
+            fields=[
+                ("pod", models.TextField(primary_key=True, serialize=False)),
+                ("report", models.JSONField(default=dict, verbose_name="report")),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.16 on 2026-10-18 18:40
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tunnel", "0016_podloadmodel"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="jobmodel",
+            name="owner",
+            field=models.TextField(null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.16 on 2026-10-18 20:10
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tunnel", "0017_jobmodel_owner"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="tunnelmodel",
+            name="old_forwards",
+            field=models.JSONField(default=list, verbose_name="old_forwards"),
+        ),
+    ]
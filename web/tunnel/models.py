@@ -12,6 +12,45 @@ class TunnelModel(models.Model):
     date = models.DateTimeField(auto_now_add=True)
     tunnel_pod = models.TextField(null=False, default="drf-tunnel-0")
     jhub_credential = models.TextField("jhub_credential", default="jupyterhub")
+    # [{"pod": ..., "local_port": ...}] of a move whose service patch failed.
+    # Still running, stopped once the service points to the new pod.
+    old_forwards = models.JSONField("old_forwards", null=False, default=list)
 
     def __str__(self):
         return f"{self.servername}: {self.svc_name} - ssh [...]@{self.hostname} -L {self.local_port}:{self.target_node}:{self.target_port}"
+
+
+class JobModel(models.Model):
+    job_id = models.TextField(primary_key=True)
+    kind = models.TextField(null=False)
+    status = models.TextField(null=False, default="running")
+    result = models.JSONField("result", null=False, default=dict)
+    # "<pod>:<pid>" of the gunicorn worker running the job
+    owner = models.TextField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.kind} {self.job_id}: {self.status}"
+
+
+class PortReservationModel(models.Model):
+    pod = models.TextField(null=False)
+    port = models.IntegerField(null=False)
+    servername = models.TextField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = [["pod", "port"]]
+
+    def __str__(self):
+        return f"{self.pod}:{self.port} - {self.servername}"
+
+
+class PodLoadModel(models.Model):
+    pod = models.TextField(primary_key=True)
+    report = models.JSONField("report", null=False, default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.pod}: {self.report}"
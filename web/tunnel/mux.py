@@ -0,0 +1,269 @@
+import fnmatch
+import getpass
+import logging
+import os
+import socket
+import struct
+import threading
+
+from jupyterjsc_tunneling.settings import LOGGER_NAME
+
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+"""
+Client for the OpenSSH multiplexing protocol (PROTOCOL.mux in the
+OpenSSH sources). `ssh -O check|forward|cancel` only talks to the running
+ControlMaster via its ControlPath socket. Doing this ourselves saves the
+fork / exec of a ssh process for each of these operations.
+
+Every packet is a uint32 length followed by the payload. Strings are a
+uint32 length followed by the bytes.
+"""
+
+MUX_MSG_HELLO = 0x00000001
+MUX_C_ALIVE_CHECK = 0x10000004
+MUX_C_OPEN_FWD = 0x10000006
+MUX_C_CLOSE_FWD = 0x10000007
+MUX_S_OK = 0x80000001
+MUX_S_PERMISSION_DENIED = 0x80000002
+MUX_S_FAILURE = 0x80000003
+MUX_S_ALIVE = 0x80000005
+
+MUX_FWD_LOCAL = 1
+SSHMUX_VER = 4
+
+
+class MuxError(Exception):
+    pass
+
+
+def _pack_string(value):
+    value = value.encode("utf-8")
+    return struct.pack(">I", len(value)) + value
+
+
+class MuxClient:
+    def __init__(self, control_path, timeout=3):
+        self.control_path = control_path
+        self.timeout = timeout
+        self.request_id = 0
+        self.sock = None
+
+    def __enter__(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        try:
+            self.sock.connect(self.control_path)
+            self.hello()
+        except:
+            self.sock.close()
+            raise
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.sock.close()
+
+    def _recv_exact(self, length):
+        data = b""
+        while len(data) < length:
+            chunk = self.sock.recv(length - len(data))
+            if not chunk:
+                raise MuxError("Connection closed by ControlMaster")
+            data += chunk
+        return data
+
+    def send_packet(self, payload):
+        self.sock.sendall(struct.pack(">I", len(payload)) + payload)
+
+    def recv_packet(self):
+        (length,) = struct.unpack(">I", self._recv_exact(4))
+        return self._recv_exact(length)
+
+    def hello(self):
+        self.send_packet(struct.pack(">II", MUX_MSG_HELLO, SSHMUX_VER))
+        packet = self.recv_packet()
+        msg_type, version = struct.unpack(">II", packet[:8])
+        if msg_type != MUX_MSG_HELLO:
+            raise MuxError(f"Expected hello, got message type {msg_type:#x}")
+        if version != SSHMUX_VER:
+            raise MuxError(f"Unsupported multiplexing protocol version {version}")
+
+    def request(self, msg_type, body=b""):
+        self.request_id += 1
+        self.send_packet(struct.pack(">II", msg_type, self.request_id) + body)
+        packet = self.recv_packet()
+        reply_type, reply_id = struct.unpack(">II", packet[:8])
+        if reply_id != self.request_id:
+            raise MuxError(
+                f"Reply for request {reply_id}, expected {self.request_id}"
+            )
+        if reply_type in [MUX_S_FAILURE, MUX_S_PERMISSION_DENIED]:
+            (length,) = struct.unpack(">I", packet[8:12])
+            reason = packet[12 : 12 + length].decode("utf-8", "replace")
+            raise MuxError(reason)
+        return reply_type, packet[8:]
+
+    def alive_check(self):
+        reply_type, body = self.request(MUX_C_ALIVE_CHECK)
+        if reply_type != MUX_S_ALIVE:
+            raise MuxError(f"Unexpected reply {reply_type:#x} to alive check")
+        (pid,) = struct.unpack(">I", body[:4])
+        return pid
+
+    def _forward(self, msg_type, listen_host, listen_port, connect_host, connect_port):
+        body = (
+            struct.pack(">I", MUX_FWD_LOCAL)
+            + _pack_string(listen_host)
+            + struct.pack(">I", int(listen_port))
+            + _pack_string(connect_host)
+            + struct.pack(">I", int(connect_port))
+        )
+        reply_type, body = self.request(msg_type, body)
+        if reply_type != MUX_S_OK:
+            raise MuxError(f"Unexpected reply {reply_type:#x} to forward request")
+
+    def open_forward(self, listen_host, listen_port, connect_host, connect_port):
+        self._forward(
+            MUX_C_OPEN_FWD, listen_host, listen_port, connect_host, connect_port
+        )
+
+    def close_forward(self, listen_host, listen_port, connect_host, connect_port):
+        self._forward(
+            MUX_C_CLOSE_FWD, listen_host, listen_port, connect_host, connect_port
+        )
+
+
+"""
+ControlPath lookup. We read the ssh config file (SSHCONFIGFILE) once per
+modification and take the first ControlPath of all Host blocks matching
+the alias, like ssh does. Only the tokens %%, %h, %n, %p, %r, %u, %d, %l
+and %L are supported. For anything else (e.g. %C) we return None and the
+ssh CLI is used.
+"""
+
+_config_cache = {}
+_config_cache_lock = threading.Lock()
+
+
+def _parse_ssh_config(path):
+    # List of (host patterns, {option: value})
+    blocks = [(["*"], {})]
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if "=" in line.split(None, 1)[0]:
+                key, value = line.split("=", 1)
+            else:
+                parts = line.split(None, 1)
+                key, value = parts[0], parts[1] if len(parts) > 1 else ""
+            key, value = key.strip().lower(), value.strip().strip('"')
+            if key == "host":
+                blocks.append((value.split(), {}))
+            elif key == "match":
+                # Not supported, ignore options until the next Host block
+                blocks.append(([], {}))
+            else:
+                blocks[-1][1].setdefault(key, value)
+    return blocks
+
+
+def _host_matches(patterns, alias):
+    matched = False
+    for pattern in patterns:
+        if pattern.startswith("!"):
+            if fnmatch.fnmatch(alias, pattern[1:]):
+                return False
+        elif fnmatch.fnmatch(alias, pattern):
+            matched = True
+    return matched
+
+
+def get_host_options(alias):
+    path = os.environ.get("SSHCONFIGFILE", "/home/tunnel/.ssh/config")
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return {}
+    with _config_cache_lock:
+        cached = _config_cache.get(path, None)
+        if cached is None or cached[0] != mtime:
+            try:
+                cached = (mtime, _parse_ssh_config(path))
+            except OSError:
+                return {}
+            _config_cache[path] = cached
+    options = {}
+    for patterns, block_options in cached[1]:
+        if _host_matches(patterns, alias):
+            for key, value in block_options.items():
+                options.setdefault(key, value)
+    return options
+
+
+def get_control_path(alias):
+    options = get_host_options(alias)
+    control_path = options.get("controlpath", None)
+    if not control_path or control_path.lower() == "none":
+        return None
+    local_hostname = socket.gethostname()
+    tokens = {
+        "%": "%",
+        "h": options.get("hostname", alias),
+        "n": alias,
+        "p": options.get("port", "22"),
+        "r": options.get("user", getpass.getuser()),
+        "u": getpass.getuser(),
+        "d": os.path.expanduser("~"),
+        "l": local_hostname,
+        "L": local_hostname.split(".")[0],
+    }
+    result = ""
+    i = 0
+    while i < len(control_path):
+        if control_path[i] == "%":
+            if i + 1 >= len(control_path) or control_path[i + 1] not in tokens:
+                return None
+            result += tokens[control_path[i + 1]]
+            i += 2
+        else:
+            result += control_path[i]
+            i += 1
+    return os.path.expanduser(result)
+
+
+def run_mux_cmd(control_path, action, tunnels, timeout):
+    """
+    Same result as the ssh CLI: (returncode, stdout, stderr).
+    Like `ssh -O forward` we stop at the first failing forward. Unlike
+    `ssh -O cancel`, forwards the ControlMaster doesn't know are skipped.
+    """
+    try:
+        with MuxClient(control_path, timeout=timeout) as client:
+            if action == "check":
+                pid = client.alive_check()
+                return 0, f"Master running (pid={pid})".encode("utf-8"), b""
+            for tunnel in tunnels:
+                forward = (
+                    "0.0.0.0",
+                    tunnel["local_port"],
+                    tunnel["target_node"],
+                    tunnel["target_port"],
+                )
+                if action == "forward":
+                    client.open_forward(*forward)
+                elif action == "cancel":
+                    try:
+                        client.close_forward(*forward)
+                    except MuxError as e:
+                        # Closed already, nothing left to cancel
+                        if "port not found" not in str(e):
+                            raise
+            return 0, b"", b""
+    except socket.timeout:
+        return 124, b"timeout", b""
+    except (OSError, MuxError, struct.error) as e:
+        return 255, b"", str(e).encode("utf-8")
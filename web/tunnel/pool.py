@@ -0,0 +1,95 @@
+import contextvars
+import threading
+from collections import defaultdict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def run_grouped(
+    items,
+    key,
+    func,
+    max_workers=16,
+    max_per_key=4,
+    max_pending=None,
+    callback=None,
+    on_progress=None,
+):
+    """
+    Run func(item) for every item of the (lazy) iterable items on a
+    thread pool. At most max_workers items run at the same time, and at
+    most max_per_key of them share the same key(item). A key with many
+    items does not block the pool for items of other keys.
+
+    Items are only pulled from the iterable while less than max_pending
+    items are waiting, so a streamed queryset is never loaded at once.
+
+    callback(item, result, exception) is called after each item, in the
+    pool thread. on_progress(done, total) is called in the calling thread,
+    after all items were queued, whenever items finished.
+    Returns the number of items and the number of failed items.
+    """
+    if not max_pending:
+        max_pending = max_workers * 4
+    condition = threading.Condition()
+    pending = defaultdict(deque)
+    running = defaultdict(int)
+    counts = {"pending": 0, "running": 0, "done": 0, "failed": 0}
+
+    def run_item(item_key, item):
+        result, exception = None, None
+        try:
+            result = func(item)
+        except Exception as e:
+            exception = e
+        try:
+            if callback:
+                callback(item, result, exception)
+        finally:
+            with condition:
+                running[item_key] -= 1
+                counts["running"] -= 1
+                counts["done"] += 1
+                if exception is not None:
+                    counts["failed"] += 1
+                dispatch()
+                condition.notify_all()
+
+    def dispatch():
+        # must be called with condition acquired
+        for item_key in list(pending.keys()):
+            queue = pending[item_key]
+            while (
+                queue
+                and running[item_key] < max_per_key
+                and counts["running"] < max_workers
+            ):
+                item = queue.popleft()
+                running[item_key] += 1
+                counts["running"] += 1
+                counts["pending"] -= 1
+                # Tasks inherit the caller's context (e.g. request deadline)
+                context = contextvars.copy_context()
+                pool.submit(context.run, run_item, item_key, item)
+            if not queue:
+                del pending[item_key]
+
+    total = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for item in items:
+            total += 1
+            with condition:
+                while counts["pending"] >= max_pending:
+                    condition.wait()
+                pending[key(item)].append(item)
+                counts["pending"] += 1
+                dispatch()
+        while True:
+            with condition:
+                if counts["done"] >= total:
+                    break
+                condition.wait()
+                done = counts["done"]
+            if on_progress:
+                on_progress(done, total)
+    return total, counts["failed"]
@@ -0,0 +1,194 @@
+import logging
+import os
+import random
+import socket
+import threading
+from collections import deque
+
+from django.db import IntegrityError
+from django.db import transaction
+from jupyterjsc_tunneling.settings import LOGGER_NAME
+
+from .models import PortReservationModel
+from .models import TunnelModel
+
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+"""
+Local ports for the ssh forwards are taken from TUNNEL_PORT_RANGE
+(default 20000-32767, below the kernel's ephemeral port range).
+
+A port belongs to a tunnel once a PortReservationModel row (pod, port)
+exists. The unique constraint makes the allocation atomic across all
+gunicorn workers of a pod. Each worker keeps a shuffled in-memory free
+list, so it usually finds a free port with a single INSERT.
+
+A tunnel moved to another pod asks for its previous port first. If it
+is free on the new pod, the k8s service keeps its targetPort and only
+the pod selector must be changed.
+"""
+
+
+class PortAllocationError(Exception):
+    pass
+
+
+def get_port_range():
+    port_range = os.environ.get("TUNNEL_PORT_RANGE", "20000-32767")
+    first, last = port_range.split("-")
+    return range(int(first), int(last) + 1)
+
+
+def is_port_bindable(port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        # Like ssh's forward listener, so ports of closed connections
+        # in TIME_WAIT count as free
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind(("", port))
+        except OSError:
+            return False
+    return True
+
+
+class PortAllocator:
+    def __init__(self, pod=None):
+        if not pod:
+            pod = os.environ.get("HOSTNAME", "drf-tunnel-0")
+        self.pod = pod
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._free = deque()
+
+    def used_ports(self):
+        used = set(
+            TunnelModel.objects.filter(tunnel_pod=self.pod).values_list(
+                "local_port", flat=True
+            )
+        )
+        used.update(
+            PortReservationModel.objects.filter(pod=self.pod).values_list(
+                "port", flat=True
+            )
+        )
+        return used
+
+    def rebuild(self, cleanup=False):
+        """
+        Rebuild the free list from the database. With cleanup=True (only
+        at startup, before any worker allocates ports) the reservations
+        are synchronized with the tunnels of this pod.
+        """
+        if cleanup:
+            tunnel_ports = dict(
+                TunnelModel.objects.filter(tunnel_pod=self.pod).values_list(
+                    "local_port", "servername"
+                )
+            )
+            stale = PortReservationModel.objects.filter(pod=self.pod).exclude(
+                port__in=tunnel_ports.keys()
+            )
+            stale_count, _ = stale.delete()
+            PortReservationModel.objects.bulk_create(
+                [
+                    PortReservationModel(pod=self.pod, port=port, servername=name)
+                    for port, name in tunnel_ports.items()
+                ],
+                ignore_conflicts=True,
+            )
+            log.info(
+                "Port reservations synchronized",
+                extra={
+                    "uuidcode": "StartUp",
+                    "pod": self.pod,
+                    "ports": len(tunnel_ports),
+                    "stale": stale_count,
+                },
+            )
+        used = self.used_ports()
+        free = [port for port in get_port_range() if port not in used]
+        random.shuffle(free)
+        with self._lock:
+            self._free = deque(free)
+
+    def reserve(self, port, servername=None):
+        """Reserve this port, if it's free. Returns True on success."""
+        if port not in get_port_range() or not is_port_bindable(port):
+            return False
+        try:
+            with transaction.atomic():
+                PortReservationModel.objects.create(
+                    pod=self.pod, port=port, servername=servername
+                )
+        except IntegrityError:
+            return False
+        with self._lock:
+            try:
+                self._free.remove(port)
+            except ValueError:
+                pass
+        return True
+
+    def allocate(self, servername=None, preferred=None):
+        if preferred is not None and self.reserve(preferred, servername=servername):
+            return preferred
+        refilled = False
+        while True:
+            with self._lock:
+                port = self._free.popleft() if self._free else None
+            if port is None:
+                if refilled:
+                    raise PortAllocationError(
+                        f"No free local port left in {os.environ.get('TUNNEL_PORT_RANGE', '20000-32767')}"
+                    )
+                self.rebuild()
+                refilled = True
+                continue
+            if not is_port_bindable(port):
+                # Used by something else on this pod
+                continue
+            try:
+                with transaction.atomic():
+                    PortReservationModel.objects.create(
+                        pod=self.pod, port=port, servername=servername
+                    )
+            except IntegrityError:
+                # Reserved by another worker in the meantime
+                continue
+            return port
+
+    def release(self, port, pod=None):
+        if not pod:
+            pod = self.pod
+        deleted, _ = PortReservationModel.objects.filter(pod=pod, port=port).delete()
+        if deleted and pod == self.pod and port in get_port_range():
+            with self._lock:
+                self._free.append(port)
+
+
+_allocator = None
+_allocator_lock = threading.Lock()
+
+
+def get_port_allocator():
+    global _allocator
+    if _allocator is None or _allocator._pid != os.getpid():
+        with _allocator_lock:
+            if _allocator is None or _allocator._pid != os.getpid():
+                _allocator = PortAllocator()
+    return _allocator
+
+
+def allocate_port(servername=None, preferred=None):
+    return get_port_allocator().allocate(servername=servername, preferred=preferred)
+
+
+def release_port(port, pod=None):
+    try:
+        get_port_allocator().release(int(port), pod=pod)
+    except:
+        log.warning(
+            f"Could not release local port {port}", extra={"pod": pod}, exc_info=True
+        )
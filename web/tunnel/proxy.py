@@ -0,0 +1,340 @@
+import asyncio
+import logging
+import os
+import re
+import time
+
+from jupyterjsc_tunneling import metrics
+from jupyterjsc_tunneling.settings import LOGGER_NAME
+
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+"""
+Routing proxy for TUNNEL_ROUTING_MODE=proxy. Instead of one k8s service
+per tunnel, each tunnel pod runs this asyncio reverse proxy on one port
+(TUNNEL_PROXY_PORT). Every request is routed by its servername to the
+local port of the ssh forward. The servername is taken from
+ - the path (TUNNEL_PROXY_ROUTE_BY=path, default): first group of
+   TUNNEL_PROXY_PATH_REGEX, by default the segment after the JupyterHub
+   user, e.g. "servername" in /user/<user>/servername/lab
+ - the Host header (TUNNEL_PROXY_ROUTE_BY=host): its first label
+
+Requests and responses are relayed unchanged, including the path. With
+keep-alive each request of a connection is routed on its own. After a
+101 Switching Protocols (WebSockets of the Jupyter kernels) the bytes
+are piped in both directions until one side closes.
+
+Routes (servername -> local port of this pod's tunnels) are read from
+the database and cached for TUNNEL_PROXY_ROUTE_TTL seconds. Unknown
+servernames refresh the cache at most once per second.
+"""
+
+
+def get_routing_mode():
+    return os.environ.get("TUNNEL_ROUTING_MODE", "service").lower()
+
+
+class ProxyError(Exception):
+    def __init__(self, status, reason):
+        self.status = status
+        self.reason = reason
+        super().__init__(f"{status} {reason}")
+
+
+def get_header(headers, name):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def parse_head(head):
+    lines = head[:-4].decode("latin-1").split("\r\n")
+    headers = []
+    for line in lines[1:]:
+        key, sep, value = line.partition(":")
+        if not sep:
+            raise ProxyError(400, "Bad Request")
+        headers.append((key.strip(), value.strip()))
+    return lines[0], headers
+
+
+def build_head(start_line, headers):
+    lines = [start_line] + [f"{key}: {value}" for key, value in headers]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def keep_alive(version, headers):
+    connection = (get_header(headers, "connection") or "").lower()
+    if version == "HTTP/1.0":
+        return "keep-alive" in connection
+    return "close" not in connection
+
+
+async def read_head(reader, timeout=None):
+    """Returns the head including the empty line, None on a clean EOF."""
+    try:
+        return await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial.strip():
+            return None
+        raise ProxyError(400, "Bad Request")
+    except asyncio.LimitOverrunError:
+        raise ProxyError(431, "Request Header Fields Too Large")
+
+
+async def relay_body(reader, writer, headers, until_eof=False, chunk_size=65536):
+    """
+    Copy a message body framed by chunked encoding or Content-Length.
+    Returns False if the body was delimited by the end of the connection.
+    """
+    transfer_encoding = (get_header(headers, "transfer-encoding") or "").lower()
+    content_length = get_header(headers, "content-length")
+    if "chunked" in transfer_encoding:
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            writer.write(line)
+            size = int(line.split(b";", 1)[0].strip(), 16)
+            if size == 0:
+                # Trailers end with an empty line
+                while True:
+                    line = await reader.readuntil(b"\r\n")
+                    writer.write(line)
+                    if line == b"\r\n":
+                        break
+                break
+            writer.write(await reader.readexactly(size + 2))
+            await writer.drain()
+    elif content_length is not None:
+        remaining = int(content_length)
+        while remaining > 0:
+            data = await reader.read(min(remaining, chunk_size))
+            if not data:
+                raise asyncio.IncompleteReadError(b"", remaining)
+            writer.write(data)
+            remaining -= len(data)
+            await writer.drain()
+    elif until_eof:
+        while True:
+            data = await reader.read(chunk_size)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        return False
+    await writer.drain()
+    return True
+
+
+async def pipe(reader, writer, chunk_size=65536):
+    try:
+        while True:
+            data = await reader.read(chunk_size)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        if not writer.is_closing():
+            writer.close()
+
+
+def close_writer(writer):
+    if writer is not None and not writer.is_closing():
+        writer.close()
+
+
+class RouteTable:
+    def __init__(self, podname=None, ttl=None, loader=None):
+        if not podname:
+            podname = os.environ.get("HOSTNAME", "drf-tunnel-0")
+        if ttl is None:
+            ttl = float(os.environ.get("TUNNEL_PROXY_ROUTE_TTL", "5"))
+        self.podname = podname
+        self.ttl = ttl
+        self.loader = loader or self.load_from_db
+        self.routes = {}
+        self.loaded_at = None
+        self._refresh_lock = asyncio.Lock()
+
+    def load_from_db(self):
+        from django.db import close_old_connections
+        from .models import TunnelModel
+
+        close_old_connections()
+        return dict(
+            TunnelModel.objects.filter(tunnel_pod=self.podname).values_list(
+                "servername", "local_port"
+            )
+        )
+
+    async def refresh(self, min_age):
+        async with self._refresh_lock:
+            # Another request may have refreshed it meanwhile
+            if self.loaded_at is not None and (
+                time.monotonic() - self.loaded_at < min_age
+            ):
+                return
+            loop = asyncio.get_running_loop()
+            self.routes = await loop.run_in_executor(None, self.loader)
+            self.loaded_at = time.monotonic()
+
+    async def resolve(self, servername):
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl:
+            await self.refresh(self.ttl)
+        port = self.routes.get(servername, None)
+        if port is None:
+            await self.refresh(min(self.ttl, 1))
+            port = self.routes.get(servername, None)
+        return port
+
+
+class RoutingProxy:
+    def __init__(self, routes=None, route_by=None, path_regex=None, idle_timeout=None):
+        if route_by is None:
+            route_by = os.environ.get("TUNNEL_PROXY_ROUTE_BY", "path").lower()
+        if path_regex is None:
+            path_regex = os.environ.get("TUNNEL_PROXY_PATH_REGEX", r"^/user/[^/]+/([^/?#]+)")
+        if idle_timeout is None:
+            idle_timeout = float(os.environ.get("TUNNEL_PROXY_IDLE_TIMEOUT", "300"))
+        self.routes = routes or RouteTable()
+        self.route_by = route_by
+        self.path_regex = re.compile(path_regex)
+        self.idle_timeout = idle_timeout
+        self.backend_host = os.environ.get("TUNNEL_PROXY_BACKEND_HOST", "127.0.0.1")
+
+    def get_servername(self, target, headers):
+        if self.route_by == "host":
+            host = get_header(headers, "host") or ""
+            return host.split(".", 1)[0].split(":", 1)[0] or None
+        match = self.path_regex.search(target)
+        return match.group(1) if match else None
+
+    async def send_error(self, writer, status, reason):
+        body = f"{status} {reason}\n".encode("utf-8")
+        writer.write(
+            build_head(
+                f"HTTP/1.1 {status} {reason}",
+                [
+                    ("Content-Type", "text/plain"),
+                    ("Content-Length", str(len(body))),
+                    ("Connection", "close"),
+                ],
+            )
+            + body
+        )
+        await writer.drain()
+
+    async def handle(self, client_reader, client_writer):
+        backend = None  # (port, reader, writer)
+        try:
+            while True:
+                try:
+                    head = await read_head(client_reader, self.idle_timeout)
+                except asyncio.TimeoutError:
+                    break
+                if head is None:
+                    break
+                start = time.monotonic()
+                request_line, headers = parse_head(head)
+                try:
+                    method, target, version = request_line.split(" ", 2)
+                except ValueError:
+                    raise ProxyError(400, "Bad Request")
+                servername = self.get_servername(target, headers)
+                port = await self.routes.resolve(servername) if servername else None
+                if port is None:
+                    metrics.increment("proxy_not_found")
+                    raise ProxyError(404, "Not Found")
+
+                if backend is None or backend[0] != port:
+                    if backend is not None:
+                        close_writer(backend[2])
+                    try:
+                        reader, writer = await asyncio.open_connection(
+                            self.backend_host, port
+                        )
+                    except OSError:
+                        raise ProxyError(502, "Bad Gateway")
+                    backend = (port, reader, writer)
+                _, backend_reader, backend_writer = backend
+
+                if (get_header(headers, "expect") or "").lower() == "100-continue":
+                    # Answer it here, the body is relayed right away anyway
+                    client_writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+                    headers = [(k, v) for k, v in headers if k.lower() != "expect"]
+                    head = build_head(request_line, headers)
+                backend_writer.write(head)
+                await relay_body(client_reader, backend_writer, headers)
+
+                while True:
+                    response_head = await read_head(backend_reader)
+                    if response_head is None:
+                        raise ProxyError(502, "Bad Gateway")
+                    status_line, response_headers = parse_head(response_head)
+                    status = int(status_line.split(" ", 2)[1])
+                    client_writer.write(response_head)
+                    if 100 <= status < 200 and status != 101:
+                        # Interim response, the final one follows
+                        continue
+                    break
+
+                if status == 101:
+                    await client_writer.drain()
+                    metrics.increment("proxy_upgrades")
+                    await asyncio.gather(
+                        pipe(client_reader, backend_writer),
+                        pipe(backend_reader, client_writer),
+                    )
+                    backend = None
+                    break
+
+                framed = True
+                if method != "HEAD" and status not in [204, 304]:
+                    framed = await relay_body(
+                        backend_reader, client_writer, response_headers, until_eof=True
+                    )
+                await client_writer.drain()
+                metrics.observe("proxy_request", time.monotonic() - start)
+                if not framed:
+                    break
+                if not keep_alive(version, headers) or not keep_alive(
+                    status_line.split(" ", 1)[0], response_headers
+                ):
+                    break
+        except ProxyError as e:
+            try:
+                await self.send_error(client_writer, e.status, e.reason)
+            except ConnectionError:
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        except:
+            log.exception("Unexpected error in routing proxy")
+        finally:
+            if backend is not None:
+                close_writer(backend[2])
+            close_writer(client_writer)
+
+    async def start_server(self, host="0.0.0.0", port=None):
+        if port is None:
+            port = int(os.environ.get("TUNNEL_PROXY_PORT", "8081"))
+        return await asyncio.start_server(self.handle, host, port)
+
+
+def run_proxy(host="0.0.0.0", port=None):
+    async def main():
+        server = await RoutingProxy().start_server(host, port)
+        log.info(
+            "Routing proxy started",
+            extra={"sockets": [s.getsockname() for s in server.sockets]},
+        )
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
@@ -0,0 +1,254 @@
+import logging
+import os
+import threading
+import time
+
+from django.db import close_old_connections
+from django.db import connection
+from jupyterjsc_tunneling import metrics
+from jupyterjsc_tunneling.k8s import get_k8s_client
+from jupyterjsc_tunneling.settings import LOGGER_NAME
+from kubernetes import watch
+from kubernetes.client.exceptions import ApiException
+
+from .locks import try_lock_file
+from .proxy import get_routing_mode
+from .services import diff_services
+from .services import get_managed_label_selector
+from .services import get_operations
+from .services import get_service_state
+from .services import list_managed_services
+from .services import run_operation
+from .utils import k8s_get_svc_namespace
+
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+"""
+Keeps the k8s services of this pod's tunnels in sync with TunnelModel
+after startup. Services deleted by hand are created again, services left
+behind by a failed delete are removed.
+
+Only one gunicorn worker per pod runs the reconciler: the one holding an
+exclusive flock on SVC_RECONCILER_LOCK_FILE. The others try again every
+SVC_RECONCILE_PERIOD seconds, so a new leader takes over when the
+worker is recycled.
+
+The leader lists the managed services once and then watches them from
+the list's resourceVersion. Each change of a service triggers a pass,
+otherwise a pass runs every SVC_RECONCILE_PERIOD seconds. A pass reads
+the tunnels of this pod from the database and compares them with the
+watched services, so it costs no k8s API call unless something must be
+repaired.
+
+Tunnels are created and deleted concurrently by the API (service first,
+database row afterwards). To not interfere with them, a repair is only
+done if the same difference is still there SVC_RECONCILE_GRACE seconds
+later. Repairs are limited to SVC_RECONCILE_RATE per second.
+"""
+
+
+class RateLimiter:
+    """Token bucket, rate tokens per second, up to burst tokens."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(int(rate), 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class ServiceReconciler:
+    def __init__(self, podname=None):
+        if not podname:
+            podname = os.environ.get("HOSTNAME", "drf-tunnel-0")
+        self.podname = podname
+        self.period = float(os.environ.get("SVC_RECONCILE_PERIOD", "60"))
+        self.grace = float(os.environ.get("SVC_RECONCILE_GRACE", "30"))
+        self.limiter = RateLimiter(float(os.environ.get("SVC_RECONCILE_RATE", "5")))
+        self.lock_file = os.environ.get(
+            "SVC_RECONCILER_LOCK_FILE", "/tmp/tunnel-svc-reconciler.lock"
+        )
+        self.log_extra = {"uuidcode": "ServiceReconciler", "pod": podname}
+        self._services = {}
+        self._services_lock = threading.Lock()
+        self._synced = threading.Event()
+        self._trigger = threading.Event()
+        self._stop = threading.Event()
+        self._candidates = {}
+        self._lock_fd = None
+
+    def stop(self):
+        self._stop.set()
+        self._trigger.set()
+
+    def acquire_leadership(self):
+        self._lock_fd = try_lock_file(self.lock_file)
+        return self._lock_fd is not None
+
+    def handle_event(self, event):
+        service = event["object"]
+        with self._services_lock:
+            if event["type"] == "DELETED":
+                self._services.pop(service.metadata.name, None)
+            else:
+                self._services[service.metadata.name] = get_service_state(service)
+        self._trigger.set()
+
+    def watch_services(self):
+        watch_timeout = int(os.environ.get("K8S_WATCH_TIMEOUT", "300"))
+        backoff = 1
+        while not self._stop.is_set():
+            try:
+                services, resource_version = list_managed_services()
+                with self._services_lock:
+                    self._services = services
+                self._synced.set()
+                self._trigger.set()
+                backoff = 1
+                v1 = get_k8s_client().core_v1_raw
+                while not self._stop.is_set():
+                    w = watch.Watch(return_type="V1Service")
+                    for event in w.stream(
+                        v1.list_namespaced_service,
+                        namespace=k8s_get_svc_namespace(),
+                        label_selector=get_managed_label_selector(),
+                        resource_version=resource_version,
+                        timeout_seconds=watch_timeout,
+                        _request_timeout=watch_timeout + 10,
+                    ):
+                        self.handle_event(event)
+                    resource_version = w.resource_version or resource_version
+            except Exception as e:
+                self._synced.clear()
+                if isinstance(e, ApiException) and e.status == 410:
+                    continue
+                log.warning(
+                    f"Service watch failed, retry in {backoff}s",
+                    extra=self.log_extra,
+                    exc_info=True,
+                )
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 30)
+
+    def get_desired(self):
+        from .models import TunnelModel
+
+        close_old_connections()
+        return {
+            tunnel["svc_name"]: tunnel
+            for tunnel in TunnelModel.objects.filter(tunnel_pod=self.podname).values(
+                "servername", "svc_name", "svc_port", "local_port"
+            )
+        }
+
+    def confirmed(self, operations):
+        """
+        Returns the operations which were already due for grace seconds.
+        Remembers the others for the next pass.
+        """
+        now = time.monotonic()
+        candidates = {}
+        ready = []
+        for operation in operations:
+            first_seen = self._candidates.get(operation, now)
+            candidates[operation] = first_seen
+            if now - first_seen >= self.grace:
+                ready.append(operation)
+        self._candidates = candidates
+        return ready
+
+    def reconcile(self):
+        start = time.monotonic()
+        desired = self.get_desired()
+        with self._services_lock:
+            existing = dict(self._services)
+        operations = self.confirmed(
+            get_operations(*diff_services(desired, set(), existing, self.podname))
+        )
+        for operation in operations:
+            if self._stop.is_set():
+                break
+            self.limiter.acquire()
+            try:
+                run_operation(operation, desired)
+                metrics.increment("svc_reconcile_repairs", action=operation[0])
+                log.info(
+                    f"Reconciler: {operation[0]} k8s svc {operation[1]}",
+                    extra=self.log_extra,
+                )
+            except:
+                metrics.increment("svc_reconcile_errors", action=operation[0])
+                log.warning(
+                    f"Reconciler: could not {operation[0]} k8s svc {operation[1]}",
+                    extra=self.log_extra,
+                    exc_info=True,
+                )
+        metrics.observe("svc_reconcile_pass", time.monotonic() - start)
+        return operations
+
+    def run(self):
+        while not self._stop.is_set():
+            if self.acquire_leadership():
+                break
+            self._stop.wait(self.period)
+        else:
+            return
+        log.info("Service reconciler started", extra=self.log_extra)
+        threading.Thread(
+            target=self.watch_services, name="svc-watch", daemon=True
+        ).start()
+        try:
+            while not self._stop.is_set():
+                self._trigger.wait(self.period)
+                self._trigger.clear()
+                if self._stop.is_set() or not self._synced.is_set():
+                    continue
+                try:
+                    self.reconcile()
+                except:
+                    metrics.increment("svc_reconcile_errors", action="pass")
+                    log.warning(
+                        "Reconciler pass failed", extra=self.log_extra, exc_info=True
+                    )
+                if self._candidates:
+                    # Look again, once the grace period is over
+                    self._stop.wait(min(self.grace, self.period))
+                    self._trigger.set()
+        finally:
+            connection.close()
+            os.close(self._lock_fd)
+
+
+_reconciler = None
+
+
+def start_reconciler():
+    """Called in each gunicorn worker (post_worker_init)."""
+    global _reconciler
+    if os.environ.get("SVC_RECONCILER_ENABLED", "true").lower() != "true":
+        return None
+    if get_routing_mode() == "proxy":
+        return None
+    if _reconciler is None:
+        _reconciler = ServiceReconciler()
+        threading.Thread(
+            target=_reconciler.run, name="svc-reconciler", daemon=True
+        ).start()
+    return _reconciler
@@ -10,8 +10,9 @@ from rest_framework.exceptions import ValidationError
 from rest_framework.serializers import Serializer
 
 from .models import TunnelModel
+from .ports import allocate_port
+from .ports import release_port
 from .utils import get_custom_headers
-from .utils import get_random_open_local_port
 from .utils import is_port_in_use
 from .utils import status_remote
 from .utils import stop_and_delete
@@ -85,19 +86,28 @@ class TunnelSerializer(serializers.ModelSerializer):
             kwargs["uuidcode"] = servername
             stop_and_delete(**kwargs)
             prev_model.delete()
+            release_port(prev_model.local_port, pod=prev_model.tunnel_pod)
         return super().is_valid(raise_exception=raise_exception)
 
     def to_internal_value(self, data):
         jhub_credential = self.context["request"].user.username
-        data["local_port"] = get_random_open_local_port()
         data.pop("labels", None)
         data["tunnel_pod"] = os.environ.get("HOSTNAME", "drf-tunnel-0")
         data["jhub_credential"] = jhub_credential
         return data
 
+    def validate(self, attrs):
+        # Last step of the validation, so a failed one reserves no port
+        attrs["local_port"] = allocate_port(servername=attrs.get("servername", None))
+        return attrs
+
     def to_representation(self, instance):
         ret = super().to_representation(instance)
-        ret["running"] = is_port_in_use(instance.local_port)
+        listening_ports = self.context.get("listening_ports", None)
+        if listening_ports is not None:
+            ret["running"] = instance.local_port in listening_ports
+        else:
+            ret["running"] = is_port_in_use(instance.local_port)
         return ret
     
 
@@ -106,6 +116,10 @@ class TunnelUpdateSerializer(TunnelSerializer):
         data = data.dict()
         data["local_port"] = int(data["local_port"])
         return data
+
+    def validate(self, attrs):
+        # The view reserved local_port already
+        return attrs
     
     def is_valid(self, raise_exception=False):
         required_keys = [
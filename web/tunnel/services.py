@@ -0,0 +1,177 @@
+import logging
+import os
+import time
+
+from jupyterjsc_tunneling.settings import LOGGER_NAME
+from kubernetes.client.exceptions import ApiException
+
+from .pool import run_grouped
+from .utils import k8s_get_client
+from .utils import k8s_get_managed_labels
+from .utils import k8s_get_svc_manifest
+from .utils import k8s_get_svc_namespace
+
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+"""
+Reconciliation of the Kubernetes services of this pod's tunnels.
+Instead of one create (and a 409 for every existing service) per tunnel,
+all services with our managed-by label are listed page by page, compared
+with the tunnels and only the necessary creates, patches and deletes are
+sent to the API.
+"""
+
+STS_POD_NAME_LABEL = "statefulset.kubernetes.io/pod-name"
+
+
+def get_managed_label_selector():
+    return ",".join(f"{k}={v}" for k, v in k8s_get_managed_labels().items())
+
+
+def get_service_state(service):
+    """(port, target port, pod) of a V1Service"""
+    port = service.spec.ports[0] if service.spec.ports else None
+    return (
+        port.port if port else None,
+        port.target_port if port else None,
+        (service.spec.selector or {}).get(STS_POD_NAME_LABEL, None),
+    )
+
+
+def list_managed_services():
+    """
+    Returns {name: (port, target port, pod)} of all managed services and
+    the resourceVersion of the list.
+    """
+    v1 = k8s_get_client()
+    namespace = k8s_get_svc_namespace()
+    limit = int(os.environ.get("K8S_LIST_LIMIT", "500"))
+    services = {}
+    _continue = None
+    while True:
+        kwargs = {"label_selector": get_managed_label_selector(), "limit": limit}
+        if _continue:
+            kwargs["_continue"] = _continue
+        response = v1.list_namespaced_service(namespace, **kwargs)
+        for service in response.items:
+            services[service.metadata.name] = get_service_state(service)
+        _continue = response.metadata._continue
+        if not _continue:
+            return services, response.metadata.resource_version
+
+
+def diff_services(desired, failed, existing, podname):
+    """
+    desired: {svc_name: tunnel kwargs} of running tunnels of this pod
+    failed: svc_names of tunnels of this pod which could not be started
+    existing: result of list_managed_services()
+
+    Returns the lists of svc_names to create, patch and delete.
+    """
+    creates, patches, deletes = [], [], []
+    for name, tunnel in desired.items():
+        if name not in existing:
+            creates.append(name)
+        elif existing[name] != (tunnel["svc_port"], tunnel["local_port"], podname):
+            patches.append(name)
+    for name, (_, _, pod) in existing.items():
+        if name in desired:
+            continue
+        if name in failed or pod == podname:
+            # Tunnel could not be started or is gone
+            deletes.append(name)
+    return creates, patches, deletes
+
+
+def _create(name, tunnel):
+    v1 = k8s_get_client()
+    namespace = k8s_get_svc_namespace()
+    manifest = k8s_get_svc_manifest(**tunnel)
+    try:
+        v1.create_namespaced_service(body=manifest, namespace=namespace)
+    except ApiException as e:
+        if e.status != 409:
+            raise
+        # Created before the services were labeled, adopt it
+        _patch(name, tunnel)
+
+
+def _patch(name, tunnel):
+    v1 = k8s_get_client()
+    namespace = k8s_get_svc_namespace()
+    manifest = k8s_get_svc_manifest(**tunnel)
+    body = {
+        "metadata": {"labels": manifest["metadata"]["labels"]},
+        "spec": {
+            "ports": manifest["spec"]["ports"],
+            "selector": manifest["spec"]["selector"],
+        },
+    }
+    v1.patch_namespaced_service(name, namespace, body)
+
+
+def _delete(name, tunnel):
+    v1 = k8s_get_client()
+    namespace = k8s_get_svc_namespace()
+    try:
+        v1.delete_namespaced_service(name=name, namespace=namespace)
+    except ApiException as e:
+        if e.status != 404:
+            raise
+
+
+operation_funcs = {"create": _create, "patch": _patch, "delete": _delete}
+
+
+def get_operations(creates, patches, deletes):
+    return (
+        [("create", name) for name in creates]
+        + [("patch", name) for name in patches]
+        + [("delete", name) for name in deletes]
+    )
+
+
+def run_operation(operation, desired):
+    action, name = operation
+    operation_funcs[action](name, desired.get(name, {}))
+
+
+def reconcile_services(desired, failed, podname, uuidcode="StartUp"):
+    max_workers = int(os.environ.get("K8S_RECONCILE_MAX_WORKERS", "8"))
+    log_extra = {"uuidcode": uuidcode, "pod": podname}
+    start = time.monotonic()
+    existing, _ = list_managed_services()
+    creates, patches, deletes = diff_services(desired, failed, existing, podname)
+    operations = get_operations(creates, patches, deletes)
+
+    def run(operation):
+        run_operation(operation, desired)
+
+    def collect(operation, result, exception):
+        if exception is not None:
+            log.warning(
+                f"Could not {operation[0]} k8s svc {operation[1]}",
+                extra=log_extra,
+                exc_info=exception,
+            )
+
+    _, failed_operations = run_grouped(
+        operations,
+        key=lambda operation: operation[0],
+        func=run,
+        max_workers=max_workers,
+        max_per_key=max_workers,
+        callback=collect,
+    )
+    result = {
+        "services": len(existing),
+        "create": len(creates),
+        "patch": len(patches),
+        "delete": len(deletes),
+        "failed": failed_operations,
+        "duration": round(time.monotonic() - start, 3),
+    }
+    log.info("K8s services reconciled", extra={**log_extra, **result})
+    return result
@@ -1,14 +1,25 @@
 import copy
+import functools
 import json
 import logging
 import os
 import socket
-import subprocess
+import threading
+import time
 import uuid
 
+from jupyterjsc_tunneling import metrics
+from jupyterjsc_tunneling.k8s import get_core_v1_api
+from jupyterjsc_tunneling.retry import bounded_timeout
+from jupyterjsc_tunneling.retry import DeadlineExceededError
+from jupyterjsc_tunneling.retry import remaining_time
+from jupyterjsc_tunneling.retry import RetryPolicy
 from jupyterjsc_tunneling.settings import LOGGER_NAME
-from kubernetes import client
-from kubernetes import config
+
+from .executor import get_executor
+from .mux import get_control_path
+from .mux import run_mux_cmd
+from .proxy import get_routing_mode
 
 
 log = logging.getLogger(LOGGER_NAME)
@@ -37,6 +48,33 @@ def is_port_in_use(port):
         return s.connect_ex(("localhost", port)) == 0
 
 
+TCP_LISTEN_STATE = "0A"
+
+
+def get_listening_ports(paths=["/proc/net/tcp", "/proc/net/tcp6"]):
+    """
+    Snapshot of all local ports in LISTEN state, read from the kernel's
+    socket tables. Returns None if they cannot be read, callers should
+    fall back to is_port_in_use then.
+    """
+    ports = set()
+    found = False
+    for path in paths:
+        try:
+            with open(path, "r") as f:
+                next(f, None)  # header
+                for line in f:
+                    fields = line.split()
+                    if len(fields) > 3 and fields[3] == TCP_LISTEN_STATE:
+                        ports.add(int(fields[1].rsplit(":", 1)[1], 16))
+        except OSError:
+            continue
+        found = True
+    if not found:
+        return None
+    return ports
+
+
 def get_base_cmd(verbose=False):
     base_cmd = [
         "ssh",
@@ -53,15 +91,28 @@ def get_remote_cmd(action, verbose=False, **kwargs):
     return base_cmd + [f"remote_{kwargs['hostname']}", action]
 
 
+def get_forward_specs(tunnels):
+    specs = []
+    for tunnel in tunnels:
+        specs += [
+            "-L",
+            f"0.0.0.0:{tunnel['local_port']}:{tunnel['target_node']}:{tunnel['target_port']}",
+        ]
+    return specs
+
+
 def get_tunnel_cmd(action, verbose=False, **kwargs):
     base_cmd = get_base_cmd(verbose=verbose)
-    action_cmd = [
-        "-O",
-        action,
-        f"tunnel_{kwargs['hostname']}",
-        "-L",
-        f"0.0.0.0:{kwargs['local_port']}:{kwargs['target_node']}:{kwargs['target_port']}",
-    ]
+    if action in ["cancel", "forward"]:
+        # Multiple forwards for one host can be sent in one control command
+        tunnels = kwargs.get("tunnels", [kwargs])
+        action_cmd = [
+            "-O",
+            action,
+            f"tunnel_{kwargs['hostname']}",
+        ] + get_forward_specs(tunnels)
+    else:
+        action_cmd = []
     check_cmd = [
         "-O",
         "check",
@@ -85,6 +136,12 @@ def get_cmd(prefix, action, verbose=False, **kwargs):
     return []
 
 
+def get_ssh_timeout(action):
+    # Per action timeouts, e.g. SSHTIMEOUT_CREATE=10. Fallback is SSHTIMEOUT
+    default_timeout = os.environ.get("SSHTIMEOUT", "3")
+    return int(os.environ.get(f"SSHTIMEOUT_{action.upper()}", default_timeout))
+
+
 alert_admins_log = {True: log.critical, False: log.warning}
 action_log = {
     "cancel": log.info,
@@ -97,6 +154,47 @@ action_log = {
 }
 
 
+def get_cmd_log_extra(kwargs):
+    # Batches may have thousands of tunnels, only log their names
+    log_extra = copy.deepcopy({k: v for k, v in kwargs.items() if k != "tunnels"})
+    if "tunnels" in kwargs:
+        log_extra["tunnels"] = len(kwargs["tunnels"])
+        log_extra["servernames"] = [
+            tunnel.get("servername", None) for tunnel in kwargs["tunnels"]
+        ]
+    return log_extra
+
+
+def is_already_cancelled(action, returncode, stderr, **kwargs):
+    """
+    Cancel of a single forward, which the ControlMaster doesn't know
+    ("port not found"). The forward is gone, as it should be.
+    """
+    return (
+        action == "cancel"
+        and returncode != 0
+        and "tunnels" not in kwargs
+        and b"port not found" in stderr
+    )
+
+
+def execute_cmd(prefix, action, cmd, timeout, **kwargs):
+    # check / forward / cancel only talk to the running ControlMaster.
+    # If its socket exists, we do this directly instead of running ssh.
+    use_mux = os.environ.get("SSH_MUX_CLIENT", "true").lower() == "true"
+    if use_mux and prefix == "tunnel" and action in ["cancel", "check", "forward"]:
+        control_path = get_control_path(f"tunnel_{kwargs['hostname']}")
+        if control_path and os.path.exists(control_path):
+            tunnels = kwargs.get("tunnels", [kwargs])
+            # Runs in an executor slot like ssh. set_uid is not needed: no
+            # process is started and the ControlMaster (tunnel user) opens
+            # the listeners itself. It only accepts clients of its own uid
+            # or root.
+            cmd = functools.partial(run_mux_cmd, control_path, action, tunnels)
+    # Waiting for a free ssh slot counts against the request's deadline
+    return get_executor().run(cmd, timeout, budget=remaining_time())
+
+
 def run_popen_cmd(
     prefix,
     action,
@@ -107,74 +205,137 @@ def run_popen_cmd(
     expected_returncodes=[0],
     exc_info=True,
     timeout=None,
+    retry_policy=None,
     **kwargs,
 ):
-    cmd = get_cmd(prefix, action, verbose=verbose, **kwargs)
-    log_extra = copy.deepcopy(kwargs)
-    log_extra["cmd"] = cmd
-    action_log[action](
-        f"{log_msg} ...",
-        extra=log_extra,
-    )
-
-    # gunicorn preload app feature does not use gunicorn user/group but
-    # the current uid instead. Which is root. We don't want to run commands as root.
-    def set_uid():
-        try:
-            os.setuid(1000)
-        except:
-            pass
-
     if not timeout:
-        timeout = int(os.environ.get("SSHTIMEOUT", "3"))
-    p = subprocess.Popen(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE, preexec_fn=set_uid)
-    try:
-        stdout, stderr = p.communicate(timeout=timeout)
-        returncode = p.returncode
-    except subprocess.TimeoutExpired:
-        p.kill()
-        returncode = 124
-        stdout, stderr = b"timeout", b""
-
-    log_extra["stdout"] = stdout.decode("utf-8").strip()
-    if exc_info:
-        log_extra["stderr"] = stderr.decode("utf-8").strip()
-    log_extra["returncode"] = returncode
-
-    action_log[action](
-        f"{log_msg} done",
-        extra=log_extra,
-    )
+        timeout = get_ssh_timeout(action)
+    if retry_policy is None:
+        retry_policy = RetryPolicy(max_attempts=max_attempts)
+    attempt = 0
+    while True:
+        attempt += 1
+        # Last attempt of multiple ones runs with -v, to get more information
+        attempt_verbose = verbose or (
+            attempt > 1 and attempt == retry_policy.max_attempts
+        )
+        cmd = get_cmd(prefix, action, verbose=attempt_verbose, **kwargs)
+        log_extra = get_cmd_log_extra(kwargs)
+        log_extra["cmd"] = cmd
+        log_extra["attempt"] = attempt
+        try:
+            # Fail fast, if the request has no time left
+            attempt_timeout = bounded_timeout(timeout)
+        except DeadlineExceededError:
+            log.warning(f"{log_msg} skipped. Deadline exceeded", extra=log_extra)
+            raise
+        action_log[action](
+            f"{log_msg} ...",
+            extra=log_extra,
+        )
 
-    if returncode not in expected_returncodes:
-        if max_attempts > 1:
-            return run_popen_cmd(
-                prefix,
-                action,
-                log_msg,
-                alert_admins=alert_admins,
-                max_attempts=max_attempts - 1,
-                verbose=max_attempts == 2,
-                expected_returncodes=expected_returncodes,
-                exc_info=exc_info,
-                timeout=timeout,
-                **kwargs,
+        start = time.monotonic()
+        try:
+            returncode, stdout, stderr = execute_cmd(
+                prefix, action, cmd, attempt_timeout, **kwargs
             )
-        if not action == "check":
-            # Check is expected to fail. So no extra log required
-            alert_admins_log[alert_admins](
-                f"{log_msg} failed. Action may be required",
-                extra=log_extra,
-                exc_info=exc_info
+        except Exception as e:
+            log.warning(
+                f"{log_msg} could not be executed", extra=log_extra, exc_info=True
             )
-        raise Exception(
-            f"unexpected returncode: {returncode} not in {expected_returncodes}"
+            returncode = 124
+            stdout, stderr = b"", str(e).encode("utf-8")
+        duration = time.monotonic() - start
+        metrics.observe("ssh_command", duration, prefix=prefix, action=action)
+
+        log_extra["stdout"] = stdout.decode("utf-8").strip()
+        if exc_info:
+            log_extra["stderr"] = stderr.decode("utf-8").strip()
+        log_extra["returncode"] = returncode
+        log_extra["duration"] = round(duration, 3)
+
+        action_log[action](
+            f"{log_msg} done",
+            extra=log_extra,
+        )
+
+        if is_already_cancelled(action, returncode, stderr, **kwargs):
+            # Closed before, e.g. by a batch which failed at a later forward
+            log.debug(f"{log_msg}: forward did not exist", extra=log_extra)
+            return expected_returncodes[0]
+
+        if prefix == "tunnel" and returncode in connection_error_returncodes:
+            invalidate_connection_health(kwargs["hostname"])
+
+        if returncode in expected_returncodes:
+            return returncode
+        if not retry_policy.wait(attempt):
+            break
+
+    if not action == "check":
+        # Check is expected to fail. So no extra log required
+        alert_admins_log[alert_admins](
+            f"{log_msg} failed. Action may be required",
+            extra=log_extra,
+            exc_info=exc_info
         )
-    return returncode
+    raise Exception(
+        f"unexpected returncode: {returncode} not in {expected_returncodes}"
+    )
+
+
+_connection_locks = {}
+_connection_locks_lock = threading.Lock()
+
+# Health cache of the ssh ControlMasters: a host passing `-O check` or
+# `create` is trusted for SSH_CHECK_CACHE_TTL seconds. A connection level
+# returncode drops the entry, so the next command checks it again.
+# 255: ssh could not connect / no master running, 124: timeout
+connection_error_returncodes = [124, 255]
+_connection_health = {}
+_connection_health_lock = threading.Lock()
+
+
+def is_connection_healthy(hostname):
+    ttl = float(os.environ.get("SSH_CHECK_CACHE_TTL", "5"))
+    with _connection_health_lock:
+        checked_at = _connection_health.get(hostname, None)
+    return checked_at is not None and time.monotonic() - checked_at < ttl
+
+
+def mark_connection_healthy(hostname):
+    with _connection_health_lock:
+        _connection_health[hostname] = time.monotonic()
+
+
+def invalidate_connection_health(hostname=None):
+    with _connection_health_lock:
+        if hostname is None:
+            _connection_health.clear()
+        else:
+            _connection_health.pop(hostname, None)
+
+
+def get_connection_lock(hostname):
+    # Tunnels to the same host may be started in parallel (e.g. at startup).
+    # Only one of them should check / create the ssh connection at a time.
+    with _connection_locks_lock:
+        if hostname not in _connection_locks:
+            _connection_locks[hostname] = threading.Lock()
+        return _connection_locks[hostname]
 
 
 def check_tunnel_connection(func):
     def build_up_connection(*args, **kwargs):
+        # Batch operations pass all their tunnels, not required for the check
+        connection_kwargs = {k: v for k, v in kwargs.items() if k != "tunnels"}
+        with get_connection_lock(kwargs["hostname"]):
+            build_up_connection_locked(**connection_kwargs)
+        return func(*args, **kwargs)
+
+    def build_up_connection_locked(**kwargs):
+        if is_connection_healthy(kwargs["hostname"]):
+            return
         # check if ssh connection to the node is up
         try:
             run_popen_cmd(
@@ -207,7 +368,8 @@ def check_tunnel_connection(func):
                         f"System not available: Could not connect via ssh to {kwargs['hostname']}. Request identification: {kwargs['uuidcode']}",
                         extra=kwargs,
                     )
-        return func(*args, **kwargs)
+                return
+        mark_connection_healthy(kwargs["hostname"])
 
     return build_up_connection
 
@@ -259,6 +421,111 @@ def start_tunnel(alert_admins=True, raise_exception=True, **validated_data):
             )
 
 
+def run_batch_cmd(action, log_msg, tunnels, alert_admins, max_attempts, **kwargs):
+    """
+    Run `ssh -O <action>` for many forwards of one hostname, in chunks of
+    SSH_FORWARD_BATCH_SIZE forwards per ssh process. ssh stops at the first
+    failing forward of a chunk, so a failed chunk is repeated forward by
+    forward to find out which servername failed. Forwarding an already
+    existing port again is accepted by the ControlMaster, cancelling an
+    already closed one counts as success (see is_already_cancelled).
+
+    Returns a dict servername -> None (success) or error message.
+    """
+    batch_size = int(os.environ.get("SSH_FORWARD_BATCH_SIZE", "100"))
+    results = {}
+    for i in range(0, len(tunnels), batch_size):
+        chunk = tunnels[i : i + batch_size]
+        try:
+            run_popen_cmd(
+                "tunnel",
+                action,
+                f"{log_msg} ({len(chunk)} tunnels)",
+                alert_admins=False,
+                max_attempts=1,
+                tunnels=chunk,
+                **kwargs,
+            )
+        except:
+            log.info(
+                f"{log_msg} ({len(chunk)} tunnels) failed. Retry one by one",
+                extra=kwargs,
+            )
+        else:
+            for tunnel in chunk:
+                results[tunnel["servername"]] = None
+            continue
+        try:
+            # Don't retry each forward, if the whole ssh connection is gone
+            run_popen_cmd(
+                "tunnel", "check", "SSH tunnel check connection", **kwargs
+            )
+        except Exception as e:
+            for tunnel in chunk:
+                results[tunnel["servername"]] = (
+                    f"System not available: Could not connect via ssh to {kwargs['hostname']}"
+                )
+            continue
+        for tunnel in chunk:
+            tunnel_kwargs = copy.deepcopy(tunnel)
+            tunnel_kwargs.update(kwargs)
+            try:
+                run_popen_cmd(
+                    "tunnel",
+                    action,
+                    log_msg,
+                    alert_admins=alert_admins,
+                    max_attempts=max_attempts,
+                    **tunnel_kwargs,
+                )
+                results[tunnel["servername"]] = None
+            except Exception as e:
+                results[tunnel["servername"]] = str(e)
+    return results
+
+
+@check_tunnel_connection
+def start_tunnels(tunnels, alert_admins=True, raise_exception=True, **kwargs):
+    """
+    Start all tunnels (dicts like TunnelModel) to kwargs["hostname"].
+    Returns a dict servername -> None (success) or error message.
+    """
+    results = run_batch_cmd(
+        "forward",
+        "SSH start tunnel",
+        tunnels,
+        alert_admins=alert_admins,
+        max_attempts=3,
+        **kwargs,
+    )
+    failed = {k: v for k, v in results.items() if v}
+    if failed and raise_exception:
+        raise TunnelExceptionError(
+            "Could not forward port to system via ssh tunnel", json.dumps(failed)
+        )
+    return results
+
+
+@check_tunnel_connection
+def stop_tunnels(tunnels, alert_admins=True, raise_exception=True, **kwargs):
+    """
+    Stop all tunnels (dicts like TunnelModel) to kwargs["hostname"].
+    Returns a dict servername -> None (success) or error message.
+    """
+    results = run_batch_cmd(
+        "cancel",
+        "SSH stop tunnel",
+        tunnels,
+        alert_admins=alert_admins,
+        max_attempts=1,
+        **kwargs,
+    )
+    failed = {k: v for k, v in results.items() if v}
+    if failed and raise_exception:
+        raise TunnelExceptionError("Could not stop ssh tunnel", json.dumps(failed))
+    return results
+
+
 def start_remote(alert_admins=True, raise_exception=True, exc_info=True, timeout=None, **validated_data):
     try:
         run_popen_cmd(
@@ -324,23 +591,27 @@ def stop_remote(alert_admins=True, raise_exception=True, **data):
 
 
 def k8s_get_client():
-    config.load_incluster_config()
-    return client.CoreV1Api()
+    return get_core_v1_api()
 
 
 def k8s_get_svc_namespace():
     return os.environ.get("DEPLOYMENT_NAMESPACE", "default")
 
 
-def k8s_create_svc(**kwargs):
-    v1 = k8s_get_client()
+def k8s_get_managed_labels():
+    """Labels of all services created by this deployment."""
+    deployment_name = os.environ.get("DEPLOYMENT_NAME", "tunneling")
+    return {"app.kubernetes.io/managed-by": deployment_name}
+
+
+def k8s_get_svc_manifest(**kwargs):
     deployment_name = os.environ.get("DEPLOYMENT_NAME", "tunneling")
     pod_name = os.environ.get("HOSTNAME", "drf-tunnel-0")
     name = kwargs["svc_name"]
-    namespace = k8s_get_svc_namespace()
     labels = {"name": name}
     if kwargs.get("labels", {}):
         labels.update(json.loads(kwargs["labels"]))
+    labels.update(k8s_get_managed_labels())
     service_manifest = {
         "apiVersion": "v1",
         "kind": "Service",
@@ -364,6 +635,13 @@ def k8s_create_svc(**kwargs):
             },
         },
     }
+    return service_manifest
+
+
+def k8s_create_svc(**kwargs):
+    v1 = k8s_get_client()
+    namespace = k8s_get_svc_namespace()
+    service_manifest = k8s_get_svc_manifest(**kwargs)
     return v1.create_namespaced_service(
         body=service_manifest, namespace=namespace
     ).to_dict()
@@ -398,6 +676,10 @@ k8s_func = {
 
 def k8s_svc(action, alert_admins=False, raise_exception=True, **kwargs):
     log_extra = copy.deepcopy(kwargs)
+    if get_routing_mode() == "proxy":
+        # The routing proxy of this pod serves all tunnels, no svc needed
+        log.debug(f"Routing proxy mode, skip K8s API to {action} svc", extra=log_extra)
+        return
     log.debug(f"Call K8s API to {action} svc ...", extra=log_extra)
     try:
         response = k8s_func[action](**kwargs)
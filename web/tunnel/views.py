@@ -2,6 +2,8 @@
 import copy
 import logging
 import os
+import threading
+import time
 
 from django.forms.models import model_to_dict
 from jupyterjsc_tunneling.decorators import request_decorator
@@ -16,11 +18,17 @@ from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
 
 from . import utils
+from .jobs import get_job
+from .jobs import job_to_dict
+from .jobs import start_job
+from .jobs import update_job
 from .models import TunnelModel
+from .pool import run_grouped
+from .ports import allocate_port
+from .ports import release_port
 from .serializers import RemoteSerializer
 from .serializers import TunnelSerializer
 from .serializers import TunnelUpdateSerializer
-from .utils import get_random_open_local_port
 
 
 log = logging.getLogger(LOGGER_NAME)
@@ -32,6 +40,97 @@ class RestartViewSet(GenericAPIView):
     permission_classes = [HasGroupPermission]
     required_groups = ["access_to_webservice_restart"]
 
+    def restart(self, job, hostname, tunnels_kwargs, custom_headers):
+        """
+        Stop and start all tunnels of hostname, batch by batch in parallel.
+        Afterwards the remote tunnel is restarted.
+        Returns a summary with the results for each servername.
+        """
+        max_workers = int(os.environ.get("RESTART_MAX_WORKERS", "8"))
+        batch_size = int(os.environ.get("SSH_FORWARD_BATCH_SIZE", "100"))
+        batches = [
+            tunnels_kwargs[i : i + batch_size]
+            for i in range(0, len(tunnels_kwargs), batch_size)
+        ]
+        tunnels = {}
+        tunnels_lock = threading.Lock()
+
+        def restart_batch(batch):
+            stopped = utils.stop_tunnels(
+                tunnels=batch,
+                alert_admins=True,
+                raise_exception=False,
+                **custom_headers,
+            )
+            started = utils.start_tunnels(
+                tunnels=batch,
+                alert_admins=True,
+                raise_exception=False,
+                **custom_headers,
+            )
+            return stopped, started
+
+        def collect(batch, result, exception):
+            with tunnels_lock:
+                for tunnel in batch:
+                    servername = tunnel["servername"]
+                    if exception is not None:
+                        tunnels[servername] = {"stop": None, "start": str(exception)}
+                    else:
+                        tunnels[servername] = {
+                            "stop": result[0].get(servername, None),
+                            "start": result[1].get(servername, None),
+                        }
+
+        def progress(done, total):
+            if job:
+                update_job(job, done=done, total=total)
+
+        start = time.monotonic()
+        run_grouped(
+            batches,
+            key=lambda batch: hostname,
+            func=restart_batch,
+            max_workers=max_workers,
+            max_per_key=max_workers,
+            callback=collect,
+            on_progress=progress,
+        )
+
+        remote = {}
+        for action, func in [("stop", utils.stop_remote), ("start", utils.start_remote)]:
+            try:
+                func(alert_admins=True, raise_exception=True, **custom_headers)
+                remote[action] = None
+            except Exception as e:
+                remote[action] = str(e)
+
+        summary = {
+            "hostname": hostname,
+            "tunnels": tunnels,
+            "failed": sorted(k for k, v in tunnels.items() if v["start"]),
+            "remote": remote,
+            "duration": round(time.monotonic() - start, 3),
+        }
+        log.info(
+            f"Restart for all tunnels for {hostname} done",
+            extra={
+                **custom_headers,
+                "tunnels": len(tunnels),
+                "failed": len(summary["failed"]),
+                "duration": summary["duration"],
+            },
+        )
+        return summary
+
+    @request_decorator
+    def get(self, request, *args, **kwargs):
+        job_id = kwargs.get("job_id", None)
+        job = get_job(job_id, "restart")
+        if job is None:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        return Response(job_to_dict(job), status=status.HTTP_200_OK)
+
     @request_decorator
     def post(self, request, *args, **kwargs):
         podname = os.environ.get("HOSTNAME", "drf-tunnel-0")
@@ -43,21 +142,28 @@ class RestartViewSet(GenericAPIView):
             f"Restart for all tunnels requested for {hostname}", extra=custom_headers
         )
         tunnels = self.queryset_tunnel.filter(hostname=hostname, tunnel_pod=podname).all()
+        tunnels_kwargs = []
         for tunnel in tunnels:
             kwargs = {}
             for key, value in tunnel.__dict__.items():
                 if key not in ["date", "_state"]:
                     kwargs[key] = copy.deepcopy(value)
-
-            kwargs.update(custom_headers)
-            log.debug(f"Restart tunnel for {hostname}", extra=kwargs)
-            utils.stop_tunnel(alert_admins=True, raise_exception=False, **kwargs)
-            utils.start_tunnel(alert_admins=True, raise_exception=False, **kwargs)
+            tunnels_kwargs.append(kwargs)
 
         custom_headers["hostname"] = hostname
-        utils.stop_remote(alert_admins=True, raise_exception=False, **custom_headers)
-        utils.start_remote(alert_admins=True, raise_exception=False, **custom_headers)
-        return Response(status=status.HTTP_200_OK)
+        if str(request.data.get("async", "false")).lower() == "true":
+            # Restarting thousands of tunnels may take longer than the
+            # gunicorn timeout. Return the job id, the client can poll it.
+            job = start_job(
+                "restart", self.restart, hostname, tunnels_kwargs, custom_headers
+            )
+            return Response(
+                job_to_dict(job),
+                status=status.HTTP_202_ACCEPTED,
+                headers={"Location": f"{request.path.rstrip('/')}/{job.job_id}/"},
+            )
+        summary = self.restart(None, hostname, tunnels_kwargs, custom_headers)
+        return Response(summary, status=status.HTTP_200_OK)
 
 
 class RemoteCheckViewSet(GenericAPIView):
@@ -93,6 +199,13 @@ class TunnelViewSet(
             queryset = TunnelModel.objects.filter(jhub_credential=self.request.user)
         return queryset
 
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.action == "list":
+            # One look at the socket table instead of one connect per tunnel
+            context["listening_ports"] = utils.get_listening_ports()
+        return context
+
     def perform_create(self, serializer):
         data = copy.deepcopy(serializer.validated_data)
         data["uuidcode"] = data["servername"]
@@ -102,6 +215,7 @@ class TunnelViewSet(
             utils.k8s_svc("create", alert_admins=True, raise_exception=True, **data)
         except Exception as e:
             utils.stop_tunnel(alert_admins=False, raise_exception=False, **data)
+            release_port(data["local_port"])
             raise e
 
         return super().perform_create(serializer)
@@ -113,6 +227,7 @@ class TunnelViewSet(
                 data[key] = copy.deepcopy(value)
         data.update(utils.get_custom_headers(self.request._request.META))
         utils.stop_and_delete(alert_admins=True, raise_exception=False, **data)
+        release_port(instance.local_port, pod=instance.tunnel_pod)
         return super().perform_destroy(instance)
 
     def get_object(self):
@@ -153,13 +268,31 @@ class TunnelViewSet(
         start_tunnel = request.data["start_tunnel"]
         if start_tunnel == "True":
             data = request.data.copy()
-            data["local_port"] = get_random_open_local_port()
-            utils.start_tunnel(alert_admins=True, raise_exception=True, **data.dict())
-            instance = self.get_object()
-            serializer_class = TunnelUpdateSerializer
-            serializer = serializer_class(instance, data=data, context=self.get_serializer_context())        
-            serializer.is_valid(raise_exception=True)
-            self.perform_update(serializer)
+            # A moved tunnel keeps its port if possible, so the service
+            # only needs a new pod selector
+            preferred = data.get("local_port", None)
+            data["local_port"] = allocate_port(
+                servername=data.get("servername", None),
+                preferred=int(preferred) if preferred else None,
+            )
+            # The new reservation is released if anything fails before
+            # the tunnel is stored with it
+            try:
+                instance = self.get_object()
+                old_forward = (instance.tunnel_pod, instance.local_port)
+                serializer_class = TunnelUpdateSerializer
+                serializer = serializer_class(instance, data=data, context=self.get_serializer_context())
+                serializer.is_valid(raise_exception=True)
+                utils.start_tunnel(
+                    alert_admins=True, raise_exception=True, **data.dict()
+                )
+                self.perform_update(serializer)
+            except:
+                release_port(data["local_port"])
+                raise
+            podname = os.environ.get("HOSTNAME", "drf-tunnel-0")
+            if old_forward != (podname, data["local_port"]):
+                release_port(old_forward[1], pod=old_forward[0])
             return Response(serializer.data)
         elif start_tunnel == "False":  # stop tunnel
             utils.stop_tunnel(alert_admins=True, raise_exception=True, **request.data.dict())